@@ -15,10 +15,17 @@ from magellan.core.catalog import get_key, set_key
 
 from magellan.io.parsers import read_csv_metadata, to_csv_metadata
 from magellan.io.pickles import load_object, load_table_metadata, save_object, save_table_metadata
+from magellan.io.sinks import CandsetSink, CsvSink, BinarySink, CallbackSink, LazySink, read_candset_chunks
+from magellan.core.lazy_candset import LazyCandset
 
 
 # blockers
 from magellan.blocker.attr_equiv_blocker import AttrEquivalenceBlocker
+from magellan.blocker.block_keys import lower_key, prefix_key, soundex_key
+from magellan.blocker.blocker_pipeline import BlockerPipeline
+from magellan.blocker.candset_ops import union_candsets, intersect_candsets, diff_candsets
+from magellan.blocker.decision_cache import DecisionCache
+from magellan.blocker.inverted_index import InvertedIndex
 
 
 
@@ -28,4 +35,7 @@ logging.basicConfig(level=logging.INFO)
 
 
 # helper functions
-from magellan.utils.helperfunctions import get_install_path
\ No newline at end of file
+from magellan.utils.helperfunctions import get_install_path
+from magellan.utils.normalizer import Normalizer
+from magellan.utils.stats import BlockerStats, add_stats_callback, remove_stats_callback, log_stats
+from magellan.utils.tokencache import TokenCache, get_token_cache
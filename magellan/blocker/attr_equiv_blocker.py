@@ -1,5 +1,12 @@
 import logging
 import logging.config
+import itertools
+import math
+import numbers
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
 import pandas as pd
 import pyprind
 import numpy as np
@@ -7,9 +14,12 @@ import numpy as np
 import magellan.utils.helperfunctions
 
 from magellan.blocker.blocker import Blocker
+from magellan.blocker.inverted_index import gather, get_offsets
 import magellan.core.catalog as cg
+from magellan.core.lazy_candset import LazyCandset
 # import magellan.utils.metadata as utils
 import magellan.utils.helperfunctions as helper
+from magellan.utils.stats import record_stats
 
 
 logging.config.fileConfig(helper.get_install_path()+'/configs/logging.ini')
@@ -18,102 +28,178 @@ logger = logging.getLogger(__name__)
 
 
 class AttrEquivalenceBlocker(Blocker):
+    def __init__(self):
+        self.heavy_keys = OrderedDict()
+        self.heavy_key_output = None
+        super(AttrEquivalenceBlocker, self).__init__()
+
+    @record_stats
     def block_tables(self, ltable, rtable, l_block_attr, r_block_attr,
                      l_output_attrs=None, r_output_attrs=None,
                      l_output_prefix='ltable_', r_output_prefix='rtable_',
-                     verbose=True):
-
-        self.validate_block_attrs(ltable, rtable, l_block_attr, r_block_attr)
-        self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
-
-        # ----------------------------------- metadata related stuff----------------------------------------------
-
-        # required metadata: keys for the input tables.
-        helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
-
-        # get metadata
-        l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
-
-        # validate metadata
-        cg.validate_metadata_for_table(ltable, l_key, 'left', logger, verbose)
-        cg.validate_metadata_for_table(rtable, r_key, 'right', logger, verbose)
-
-        # ----------------------------------- metadata related stuff----------------------------------------------
-
-        # remove nans : should be modified based on the policy for handling missing values
-        l_df, r_df = self.rem_nan(ltable, l_block_attr), self.rem_nan(rtable, r_block_attr)
-
-        # do blocking
-        candset = pd.merge(l_df, r_df, left_on=l_block_attr, right_on=r_block_attr, suffixes=('_ltable', '_rtable'))
-
-        # construct output table
-        retain_cols, final_cols = self.output_columns(l_key, r_key, list(candset.columns),
-                                                      l_output_attrs, r_output_attrs,
-                                                      l_output_prefix, r_output_prefix)
+                     sink=None, chunk_size=100000, num_partitions=None, temp_dir=None,
+                     max_pairs_per_key=None, heavy_key_policy='drop', l_sub_block_attr=None,
+                     r_sub_block_attr=None, heavy_key_sink=None, verbose=True):
+        """
+        Block the tables, keeping the pairs whose block attribute values are equal.
+
+        A block attribute can also be a key function, which maps a table to a column of keys (see e.g.
+        lower_key, prefix_key and soundex_key), or a list of attributes and key functions, to block on a
+        composite key; l_block_attr and r_block_attr must then be lists of the same length. The composite
+        key is encoded once into a column of integer codes, which is joined on directly.
+
+        Setting num_partitions joins the block attributes out of core: only the block attribute values of both
+        tables (not the other columns) are hash-partitioned into that many spill files (in a fresh directory
+        under temp_dir, which defaults to the system temporary directory), and the partitions are joined one
+        pair at a time, so the values of only one partition pair are in memory at a time. The output pairs are
+        still collected into the candset, so pass a sink as well to bound the memory of the output. Without a
+        sink, the candset is the same as the in-memory one, in the same order; with a sink, the chunks are
+        written in partition order.
+
+        Setting max_pairs_per_key guards against skewed block values: the number of pairs of each value (its
+        frequency in the ltable times its frequency in the rtable) is computed before joining, the values
+        with more than max_pairs_per_key pairs are reported in self.heavy_keys (value -> projected pairs,
+        heaviest first), and heavy_key_policy decides what happens to their pairs:
+
+            'drop': they are left out of the candset
+            'cap': only the first max_pairs_per_key pairs of each heavy value are kept
+            'sub_block': they are also required to agree on l_sub_block_attr and r_sub_block_attr
+            'stream': they are written to heavy_key_sink (a CandsetSink, e.g. a CsvSink) instead of the candset,
+                whose result (the value returned by its close method) is kept in self.heavy_key_output
+
+        self.heavy_keys and self.heavy_key_output are reset by each call. The pairs of heavy values come after
+        the others, unless num_partitions is set and no sink is given.
+        """
+        stats = self.stats
+        self.heavy_keys = OrderedDict()
+        self.heavy_key_output = None
+
+        with stats.stage('validate'):
+            self.validate_block_attrs(ltable, rtable, l_block_attr, r_block_attr)
+            self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
+            if max_pairs_per_key is not None:
+                self.validate_heavy_key_policy(ltable, rtable, heavy_key_policy, l_sub_block_attr,
+                                               r_sub_block_attr, heavy_key_sink)
+
+            # ----------------------------------- metadata related stuff------------------------------------------
+
+            # required metadata: keys for the input tables.
+            helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
+
+            # get metadata
+            l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
+
+            # validate metadata
+            cg.validate_metadata_for_table(ltable, l_key, 'left', logger, verbose)
+            cg.validate_metadata_for_table(rtable, r_key, 'right', logger, verbose)
+
+            # ----------------------------------- metadata related stuff------------------------------------------
+
+        # do blocking; rows with missing values in the block attribute do not match anything
+
+        # #compute the keys to join on
+        with stats.stage('keys'):
+            l_col, r_col, key_values = self.get_block_keys(ltable, rtable, l_block_attr, r_block_attr)
+
+        # #find the heavy keys, and set their rows aside
+        l_rows, r_rows, heavy_chunks = None, None, None
+        if max_pairs_per_key is not None:
+            with stats.stage('heavy_keys'):
+                l_rows, r_rows, heavy_chunks = self.split_heavy_keys(ltable, rtable, l_col, r_col, key_values,
+                                                                     max_pairs_per_key, heavy_key_policy,
+                                                                     l_sub_block_attr, r_sub_block_attr,
+                                                                     chunk_size, verbose)
+                stats.add('heavy_keys', len(self.heavy_keys))
+            if heavy_chunks is not None:
+                heavy_chunks = stats.iter_stage('heavy_keys', heavy_chunks)
+
+        # #join the rest of the rows
+        if num_partitions is None:
+            pair_chunks = self.iter_equi_join(l_col, r_col, chunk_size, l_rows, r_rows)
+        else:
+            pair_chunks = self.iter_partitioned_equi_join(l_col, r_col, num_partitions, temp_dir, chunk_size,
+                                                          verbose, l_rows, r_rows)
+        pair_chunks = stats.iter_stage('join', pair_chunks)
+
+        if heavy_chunks is not None:
+            if heavy_key_policy == 'stream':
+                self.heavy_key_output = self.assemble_candset(heavy_chunks, ltable, rtable, l_key, r_key,
+                                                              l_output_attrs, r_output_attrs, l_output_prefix,
+                                                              r_output_prefix, sink=heavy_key_sink,
+                                                              chunk_size=chunk_size)
+            else:
+                pair_chunks = itertools.chain(pair_chunks, heavy_chunks)
 
-        candset = candset[retain_cols]
-        candset.columns = final_cols
+        if num_partitions is not None:
+            if sink is None:
+                # put the pairs back in the order of the in-memory join
+                pair_chunks = [self.sort_pairs(pair_chunks)]
 
-        # Update catalog for the candidate set
-        key = helper.get_name_for_key(candset.columns)
-        candset = helper.add_key_column(candset, key)
-        cg.set_candset_properties(candset, key, l_output_prefix + l_key, r_output_prefix + r_key, ltable, rtable)
+        # construct output table (or stream it to the sink) and update catalog for the candidate set
+        candset = self.assemble_candset(pair_chunks, ltable, rtable, l_key, r_key, l_output_attrs, r_output_attrs,
+                                        l_output_prefix, r_output_prefix, sink=sink, chunk_size=chunk_size)
 
         # return the candidate set
         return candset
 
+    @record_stats
     def block_candset(self, candset, l_block_attr, r_block_attr, verbose=True, show_progress=True):
+        stats = self.stats
+        stats.add('pairs_in', len(candset))
 
-        # required metadata: key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key
-        helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
-                                'ltable, rtable, ltable key, rtable key', verbose)
-        # get metadata
-        key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger, verbose)
-
-        # validate metadata
-        cg.validate_metadata_for_candset(candset, key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key,
-                                         logger, verbose)
+        with stats.stage('validate'):
+            # required metadata: key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key
+            helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
+                                    'ltable, rtable, ltable key, rtable key', verbose)
+            # get metadata
+            key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger,
+                                                                                                verbose)
 
+            # validate metadata
+            cg.validate_metadata_for_candset(candset, key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key,
+                                             logger, verbose)
 
-
-        # validate block attrs
-        self.validate_block_attrs(ltable, rtable, l_block_attr, r_block_attr)
+            # validate block attrs
+            self.validate_block_attrs(ltable, rtable, l_block_attr, r_block_attr)
 
         # do blocking
-        if show_progress:
-            bar = pyprind.ProgBar(len(candset))
-
-        # #keep track of valid ids
-        valid = []
-
-        # #set index for convenience
-        l_df = ltable.set_index(l_key, drop=False)
-        r_df = rtable.set_index(r_key, drop=False)
 
-        for idx, row in candset.iterrows(): # think about converting this to itertuples, and using a lookup table.
-            if show_progress:
-                bar.update()
-
-            # #get the value of block attributes
-            l_val = l_df.ix[row[fk_ltable], l_block_attr]
-            r_val = r_df.ix[row[fk_rtable], r_block_attr]
-
-            if l_val != np.NaN and r_val != np.NaN:
-                if l_val == r_val:
-                    valid.append(True)
-                else:
-                    valid.append(False)
-            else:
-                valid.append(False)
+        # #encode the block attribute values of both tables with common integer codes (-1 for missing values)
+        with stats.stage('keys'):
+            l_col, r_col, _ = self.get_block_keys(ltable, rtable, l_block_attr, r_block_attr)
+            l_codes, r_codes, _ = self.get_join_codes(l_col, r_col)
+        l_index = pd.Index(ltable[l_key])
+        r_index = pd.Index(rtable[r_key])
+        l_fks = candset[fk_ltable].values
+        r_fks = candset[fk_rtable].values
+
+        # #map the foreign keys to rows and their rows to codes, and compare the codes, a chunk at a time;
+        # missing values never match
+        chunks = helper.split_into_chunks(len(candset), int(math.ceil(len(candset) / 1000000.0)))
+        if show_progress:
+            bar = pyprind.ProgBar(len(chunks))
+
+        valid = np.zeros(len(candset), dtype=bool)
+        with stats.stage('join'):
+            for begin, end in chunks:
+                if show_progress:
+                    bar.update()
+                l_rows = l_index.get_indexer(l_fks[begin:end])
+                r_rows = r_index.get_indexer(r_fks[begin:end])
+                l_vals = np.where(l_rows >= 0, l_codes[l_rows], -1)
+                r_vals = np.where(r_rows >= 0, r_codes[r_rows], -1)
+                valid[begin:end] = (l_vals >= 0) & (l_vals == r_vals)
 
         # construct output table
-        if len(candset) > 0:
-            out_table = candset[valid]
-        else:
-            out_table = pd.DataFrame(columns=candset.columns)
+        with stats.stage('assemble'):
+            if len(candset) > 0 or isinstance(candset, LazyCandset):
+                out_table = candset[valid]
+            else:
+                out_table = pd.DataFrame(columns=candset.columns)
 
-        # update the catalog
-        cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+            # update the catalog
+            cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+        stats.add('pairs_emitted', len(out_table))
 
         # return the output table
         return out_table
@@ -134,56 +220,237 @@ class AttrEquivalenceBlocker(Blocker):
 
     # validate the blocking attrs
     def validate_block_attrs(self, ltable, rtable, l_block_attr, r_block_attr):
+        if isinstance(l_block_attr, list) or isinstance(r_block_attr, list):
+            assert isinstance(l_block_attr, list) and isinstance(r_block_attr, list) and \
+                   len(l_block_attr) == len(r_block_attr) and len(l_block_attr) > 0, \
+                'Left and right block attributes must be lists of the same length'
+
+        # key functions are checked when they are applied
         if not isinstance(l_block_attr, list):
             l_block_attr = [l_block_attr]
+        l_block_attr = [attr for attr in l_block_attr if not callable(attr)]
         assert set(l_block_attr).issubset(ltable.columns) is True, 'Left block attribute is not in the left table'
 
         if not isinstance(r_block_attr, list):
             r_block_attr = [r_block_attr]
+        r_block_attr = [attr for attr in r_block_attr if not callable(attr)]
         assert set(r_block_attr).issubset(rtable.columns) is True, 'Right block attribute is not in the right table'
 
-    def output_columns(self, l_key, r_key, col_names, l_output_attrs, r_output_attrs, l_output_prefix, r_output_prefix):
-
-        ret_cols = []
-        fin_cols = []
-
-        # retain id columns from merge
-        ret_l_id = [self.retain_names(x, col_names, '_ltable') for x in [l_key]]
-        ret_r_id = [self.retain_names(x, col_names, '_rtable') for x in [r_key]]
-        ret_cols.extend(ret_l_id)
-        ret_cols.extend(ret_r_id)
-
-        # retain output attrs from merge
-        if l_output_attrs:
-            l_output_attrs = [x for x in l_output_attrs if x not in [l_key]]
-            ret_l_col = [self.retain_names(x, col_names, '_ltable') for x in l_output_attrs]
-            ret_cols.extend(ret_l_col)
-        if r_output_attrs:
-            l_output_attrs = [x for x in r_output_attrs if x not in [r_key]]
-            ret_r_col = [self.retain_names(x, col_names, '_rtable') for x in r_output_attrs]
-            ret_cols.extend(ret_r_col)
-
-        # final columns in the output
-        fin_l_id = [self.final_names(x, l_output_prefix) for x in [l_key]]
-        fin_r_id = [self.final_names(x, r_output_prefix) for x in [r_key]]
-        fin_cols.extend(fin_l_id)
-        fin_cols.extend(fin_r_id)
-
-        # final output attrs from merge
-        if l_output_attrs:
-            fin_l_col = [self.final_names(x, l_output_prefix) for x in l_output_attrs]
-            fin_cols.extend(fin_l_col)
-        if r_output_attrs:
-            fin_r_col = [self.final_names(x, r_output_prefix) for x in r_output_attrs]
-            fin_cols.extend(fin_r_col)
-
-        return ret_cols, fin_cols
-
-    def retain_names(self, x, col_names, suffix):
-        if x in col_names:
-            return x
-        else:
-            return str(x) + suffix
-
-    def final_names(self, x, prefix):
-        return prefix + str(x)
+    # get the columns to join the tables on: the block attributes themselves, the output of key functions,
+    # or, for composite keys, a column of integer codes (NaN when any part of the key is missing). for
+    # composite keys, also return the key (a tuple) of each code.
+    def get_block_keys(self, ltable, rtable, l_block_attr, r_block_attr):
+        if not isinstance(l_block_attr, list):
+            return self.get_key_column(ltable, l_block_attr), self.get_key_column(rtable, r_block_attr), None
+
+        # combine the codes of the parts one at a time, re-encoding after each step to keep them small
+        codes, key_values = None, None
+        for l_attr, r_attr in zip(l_block_attr, r_block_attr):
+            l_codes, r_codes, uniques = self.get_join_codes(self.get_key_column(ltable, l_attr),
+                                                            self.get_key_column(rtable, r_attr))
+            part_codes = np.concatenate([l_codes, r_codes])
+            if codes is None:
+                codes, key_values = part_codes, [(v,) for v in uniques]
+                continue
+            valid = (codes >= 0) & (part_codes >= 0)
+            codes = np.where(valid, codes * len(uniques) + part_codes, -1)
+            new_codes, combined = pd.factorize(codes[valid])
+            codes[valid] = new_codes
+            key_values = [key_values[c // len(uniques)] + (uniques[c % len(uniques)],) for c in combined]
+
+        codes = np.where(codes >= 0, codes, np.NaN)
+        return pd.Series(codes[:len(ltable)]), pd.Series(codes[len(ltable):]), key_values
+
+    # the block attribute of a table, or the output of a key function
+    def get_key_column(self, table, block_attr):
+        if callable(block_attr):
+            col = block_attr(table)
+            assert len(col) == len(table), 'The key function must return one key per row'
+            return pd.Series(col.values if isinstance(col, pd.Series) else np.asarray(col))
+        return table[block_attr]
+
+    # equi-join the tables on the block attributes, by position. the values of both columns are factorized
+    # together and the rtable rows are grouped by code (CSR); the ltable is then scanned in order, in
+    # batches that produce about chunk_size pairs each. missing values get no code and never match.
+    def iter_equi_join(self, l_col, r_col, chunk_size, l_rows=None, r_rows=None):
+        if l_rows is None:
+            return self.iter_join_columns(l_col, r_col, chunk_size)
+        return self.iter_join_rows(l_col, r_col, l_rows, r_rows, chunk_size)
+
+    # equi-join the rows at the given positions only
+    def iter_join_rows(self, l_col, r_col, l_rows, r_rows, chunk_size):
+        for l_pos, r_pos in self.iter_join_columns(l_col.iloc[l_rows], r_col.iloc[r_rows], chunk_size):
+            yield l_rows[l_pos], r_rows[r_pos]
+
+    def iter_join_columns(self, l_col, r_col, chunk_size):
+        l_codes, r_codes, uniques = self.get_join_codes(l_col, r_col)
+        num_codes = len(uniques)
+
+        r_rows = np.flatnonzero(r_codes >= 0)
+        r_codes = r_codes[r_rows]
+        r_sorted = r_rows[np.argsort(r_codes, kind='mergesort')]
+        r_offsets = get_offsets(r_codes, num_codes)
+
+        l_rows = np.flatnonzero(l_codes >= 0)
+        l_codes = l_codes[l_rows]
+        num_pairs = np.diff(r_offsets)[l_codes]
+        for begin, end in helper.split_by_volume(num_pairs, chunk_size):
+            owners, r_pos = gather(r_offsets, r_sorted, l_codes[begin:end])
+            yield l_rows[begin:end][owners], r_pos
+
+    # out-of-core equi-join: the non-missing block attribute values of each table are hash-partitioned into
+    # spill files (a series per partition, indexed by row position), and each pair of partitions is joined
+    # in memory. equal values always land in partitions with the same number, since both columns are cast
+    # to a common dtype, and the numbers of object columns are normalized, before they are hashed.
+    def iter_partitioned_equi_join(self, l_col, r_col, num_partitions, temp_dir, chunk_size, verbose,
+                                   l_rows=None, r_rows=None):
+        assert num_partitions >= 1, 'num_partitions must be at least 1'
+        dtype = pd.concat([l_col.iloc[:0], r_col.iloc[:0]]).dtype
+
+        spill_dir = tempfile.mkdtemp(prefix='magellan_', dir=temp_dir)
+        try:
+            helper.log_info(logger, 'Partitioning the tables into ' + spill_dir, verbose)
+            l_files = self.spill_partitions(l_col.astype(dtype), l_rows, num_partitions, spill_dir, 'ltable')
+            r_files = self.spill_partitions(r_col.astype(dtype), r_rows, num_partitions, spill_dir, 'rtable')
+
+            for l_file, r_file in zip(l_files, r_files):
+                l_part = pd.read_pickle(l_file)
+                r_part = pd.read_pickle(r_file)
+                if len(l_part) == 0 or len(r_part) == 0:
+                    continue
+                for l_pos, r_pos in self.iter_join_columns(l_part, r_part, chunk_size):
+                    yield l_part.index.values[l_pos], r_part.index.values[r_pos]
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # write the non-missing values of a column (at the given positions, or all) into num_partitions pickled
+    # series, by hash of the value, and return the file names
+    def spill_partitions(self, col, rows, num_partitions, spill_dir, name):
+        positions = np.flatnonzero(col.notnull().values)
+        if rows is not None:
+            positions = np.intersect1d(positions, rows)
+        values = col.values[positions]
+        parts = self.get_partition_hashes(values) % np.uint64(num_partitions)
+        order = np.argsort(parts, kind='mergesort')
+        offsets = np.zeros(num_partitions + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parts.astype(np.int64), minlength=num_partitions), out=offsets[1:])
+
+        files = []
+        for p in range(num_partitions):
+            rows = order[offsets[p]:offsets[p+1]]
+            file_name = os.path.join(spill_dir, name + '_' + str(p) + '.pkl')
+            pd.Series(values[rows], index=positions[rows]).to_pickle(file_name)
+            files.append(file_name)
+        return files
+
+    # 64-bit hash of each value. the values of an object column are hashed through their string form, so
+    # the numbers that are equal (and thus join) but of different types, such as 1, 1.0 and True, are
+    # first converted to the same type: int for the whole numbers, float for the others.
+    def get_partition_hashes(self, values):
+        if values.dtype == object:
+            values = np.array([(int(v) if float(v).is_integer() else float(v))
+                               if isinstance(v, numbers.Real) else v for v in values], dtype=object)
+        return pd.util.hash_pandas_object(pd.Series(values), index=False).values
+
+    # compute the number of pairs of each block value (frequency in the ltable times frequency in the rtable),
+    # and report the values with more than max_pairs_per_key pairs in self.heavy_keys. returns the positions of
+    # the ltable and rtable rows that do not have a heavy value, and the pairs of the heavy values generated
+    # according to the policy.
+    def split_heavy_keys(self, ltable, rtable, l_col, r_col, key_values, max_pairs_per_key, policy,
+                         l_sub_block_attr, r_sub_block_attr, chunk_size, verbose):
+        l_codes, r_codes, uniques = self.get_join_codes(l_col, r_col)
+        if key_values is not None:
+            uniques = [key_values[int(c)] for c in uniques]
+        l_counts = np.bincount(l_codes[l_codes >= 0], minlength=len(uniques))
+        r_counts = np.bincount(r_codes[r_codes >= 0], minlength=len(uniques))
+        num_pairs = l_counts * r_counts
+        heavy_codes = np.flatnonzero(num_pairs > max_pairs_per_key)
+        heavy_codes = heavy_codes[np.argsort(-num_pairs[heavy_codes], kind='mergesort')]
+
+        self.heavy_keys = OrderedDict((uniques[c], int(num_pairs[c])) for c in heavy_codes)
+        helper.log_info(logger, 'Found ' + str(len(heavy_codes)) + ' heavy keys, with ' +
+                        str(int(num_pairs[heavy_codes].sum())) + ' projected pairs: ' +
+                        ', '.join(str(k) + ' (' + str(v) + ')' for k, v in self.heavy_keys.items()[:20]) +
+                        (', ...' if len(heavy_codes) > 20 else ''), verbose)
+
+        is_heavy = np.zeros(len(uniques) + 1, dtype=bool)
+        is_heavy[heavy_codes] = True
+        # missing values have code -1, which picks the last (False) entry
+        l_heavy = is_heavy[l_codes]
+        r_heavy = is_heavy[r_codes]
+
+        heavy_chunks = None
+        if policy != 'drop':
+            heavy_chunks = self.iter_heavy_key_pairs(ltable, rtable, l_codes, r_codes, l_heavy, r_heavy,
+                                                     heavy_codes, len(uniques), max_pairs_per_key, policy,
+                                                     l_sub_block_attr, r_sub_block_attr, chunk_size)
+        return np.flatnonzero(~l_heavy), np.flatnonzero(~r_heavy), heavy_chunks
+
+    # generate the pairs of the heavy values, heaviest first
+    def iter_heavy_key_pairs(self, ltable, rtable, l_codes, r_codes, l_heavy, r_heavy, heavy_codes, num_codes,
+                             max_pairs_per_key, policy, l_sub_block_attr, r_sub_block_attr, chunk_size):
+        # group the rows of the heavy values by code
+        l_rows = np.flatnonzero(l_heavy)
+        l_rows = l_rows[np.argsort(l_codes[l_rows], kind='mergesort')]
+        l_offsets = get_offsets(l_codes[l_rows], num_codes)
+        r_rows = np.flatnonzero(r_heavy)
+        r_rows = r_rows[np.argsort(r_codes[r_rows], kind='mergesort')]
+        r_offsets = get_offsets(r_codes[r_rows], num_codes)
+
+        if policy == 'sub_block':
+            l_sub_col, r_sub_col, _ = self.get_block_keys(ltable, rtable, l_sub_block_attr, r_sub_block_attr)
+
+        for c in heavy_codes:
+            l_key_rows = l_rows[l_offsets[c]:l_offsets[c+1]]
+            r_key_rows = r_rows[r_offsets[c]:r_offsets[c+1]]
+            if policy == 'sub_block':
+                for l_pos, r_pos in self.iter_join_rows(l_sub_col, r_sub_col, l_key_rows, r_key_rows,
+                                                        chunk_size):
+                    yield l_pos, r_pos
+                continue
+
+            if policy == 'cap':
+                l_key_rows = l_key_rows[:int(math.ceil(max_pairs_per_key / float(len(r_key_rows))))]
+            num_pairs = len(l_key_rows) * len(r_key_rows)
+            if policy == 'cap':
+                num_pairs = min(num_pairs, max_pairs_per_key)
+
+            # the cross product of the rows, l-major, in batches of about chunk_size pairs
+            batch_size = max(1, chunk_size // len(r_key_rows))
+            for begin in range(0, len(l_key_rows), batch_size):
+                l_batch = l_key_rows[begin:begin + batch_size]
+                l_pos = np.repeat(l_batch, len(r_key_rows))
+                r_pos = np.tile(r_key_rows, len(l_batch))
+                end = min(len(l_pos), num_pairs - begin * len(r_key_rows))
+                yield l_pos[:end], r_pos[:end]
+
+    def validate_heavy_key_policy(self, ltable, rtable, policy, l_sub_block_attr, r_sub_block_attr,
+                                  heavy_key_sink):
+        assert policy in ['drop', 'cap', 'sub_block', 'stream'], 'heavy_key_policy must be one of drop, cap, ' \
+                                                                  'sub_block and stream'
+        if policy == 'sub_block':
+            assert l_sub_block_attr is not None and r_sub_block_attr is not None, \
+                'l_sub_block_attr and r_sub_block_attr are required by the sub_block policy'
+            self.validate_block_attrs(ltable, rtable, l_sub_block_attr, r_sub_block_attr)
+        if policy == 'stream':
+            assert heavy_key_sink is not None, 'heavy_key_sink is required by the stream policy'
+
+    # concatenate chunks of pair positions and sort them by ltable position, then by rtable position
+    def sort_pairs(self, pair_chunks):
+        l_pos = []
+        r_pos = []
+        for l, r in pair_chunks:
+            l_pos.append(l)
+            r_pos.append(r)
+        if len(l_pos) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        l_pos = np.concatenate(l_pos)
+        r_pos = np.concatenate(r_pos)
+        order = np.lexsort((r_pos, l_pos))
+        return l_pos[order], r_pos[order]
+
+    # encode the values of the left and right block attributes with common integer codes (-1 for missing)
+    def get_join_codes(self, l_col, r_col):
+        codes, uniques = pd.factorize(pd.concat([l_col, r_col], ignore_index=True))
+        codes = codes.astype(np.int64)
+        return codes[:len(l_col)], codes[len(l_col):], uniques
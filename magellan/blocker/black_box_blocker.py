@@ -1,15 +1,21 @@
+import itertools
 import logging
 import logging.config
+import math
+from collections import namedtuple
 
 
-from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import pyprind
 
 
 import magellan.utils.helperfunctions as helper
 import magellan.core.catalog as cg
+from magellan.core.lazy_candset import LazyCandset
 from magellan.blocker.blocker import Blocker
+import magellan.blocker.decision_cache as dc
+from magellan.utils.stats import record_stats
 
 
 logging.config.fileConfig(helper.get_install_path()+'/configs/logging.ini')
@@ -20,189 +26,379 @@ class BlackBoxBlocker(Blocker):
     def __init__(self, *args, **kwargs):
         super(Blocker, self).__init__(*args, **kwargs)
         self.black_box_function = None
-
-    def set_black_box_function(self, function):
+        self.batch_black_box_function = None
+        self.l_attrs = None
+        self.r_attrs = None
+        self.row_type = 'series'
+        self.decision_cache = None
+        self.decision_cache_version = None
+
+    def set_black_box_function(self, function, l_attrs=None, r_attrs=None, row_type='series'):
+        """
+        Set the black box function, which is called with an ltable row and an rtable row and returns True to
+        drop the pair.
+
+        Args:
+            function (function): Black box function
+            l_attrs, r_attrs (list): Attributes of the ltable and rtable rows that the function reads; the rows
+                passed to it then hold only these attributes (defaults to None, which means all of them)
+            row_type (str): Type of the rows passed to the function: 'series' (pandas series, the default),
+                'dict' or 'namedtuple'. Dicts and namedtuples are much faster to build and to read from than
+                series, and take less memory; a dict is read like a series (row['attr']) and a namedtuple by
+                position or by attribute (row.attr). Their values are python scalars.
+
+        Examples:
+            >>> bb = BlackBoxBlocker()
+            >>> bb.set_black_box_function(lambda l, r: l['year'] != r['year'], l_attrs=['year'], r_attrs=['year'],
+            ...                           row_type='dict')
+        """
+        assert row_type in ['series', 'dict', 'namedtuple'], 'row_type must be one of series, dict and namedtuple'
         self.black_box_function = function
-
+        self.batch_black_box_function = None
+        self.l_attrs = l_attrs
+        self.r_attrs = r_attrs
+        self.row_type = row_type
+
+    def set_batch_black_box_function(self, function, l_attrs=None, r_attrs=None):
+        """
+        Set a batch black box function, which is used instead of a per-pair black box function (the last one
+        set is used). It is called with the ltable and rtable sides of a chunk of pairs, as two dicts mapping
+        each attribute to a numpy array of values (aligned: the i-th values of the arrays belong to the i-th
+        pair), and returns a boolean numpy array that is True for the pairs to drop.
+
+        Args:
+            function (function): Batch black box function
+            l_attrs, r_attrs (list): Attributes of the ltable and rtable passed to the function (defaults to
+                None, which means all of them)
+
+        Examples:
+            >>> bb = BlackBoxBlocker()
+            >>> bb.set_batch_black_box_function(lambda l, r: np.abs(l['year'] - r['year']) > 2,
+            ...                                 l_attrs=['year'], r_attrs=['year'])
+        """
+        self.black_box_function = None
+        self.batch_black_box_function = function
+        self.l_attrs = l_attrs
+        self.r_attrs = r_attrs
+
+    def set_decision_cache(self, decision_cache, version=None):
+        """
+        Set an on-disk cache of the decisions of the black box function, used by block_candset: the function
+        is only evaluated on the pairs whose decisions are not in the cache (new pairs, pairs whose keys or
+        attribute values changed, or all pairs once the function changed), and the new decisions are added
+        to it.
+
+        Args:
+            decision_cache (DecisionCache): Cache of decisions (None disables it)
+            version (str): Version of the function, added to its fingerprint; change it to invalidate the
+                cached decisions when something the fingerprint does not cover changes (e.g. a global the
+                function reads)
+        """
+        self.decision_cache = decision_cache
+        self.decision_cache_version = version
+
+    @record_stats
     def block_tables(self, ltable, rtable, l_output_attrs=None, r_output_attrs=None,
                      l_output_prefix='ltable_', r_output_prefix='rtable_',
-                     verbose=True, show_progress=True):
-
-        # validate the presence of black box function
-        if self.black_box_function is None:
-            raise AssertionError('Black box function is not set')
-
-        # validate output attributes
-        self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
-
-        # metadata related stuff..
-
-        # required metadata: keys for the input tables
-        helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
-
-        # get metadata
-        l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
-
-        # validate metadata.
-        cg.validate_metadata_for_table(ltable, l_key, 'left', logger, verbose)
-        cg.validate_metadata_for_table(rtable, r_key, 'right', logger, verbose)
-
-        # do blocking
-        if show_progress:
-            bar = pyprind.ProgBar(len(ltable)*len(rtable))
-
-        # #keep track of the list that survives blocking
-        block_list = []
-
-        # #set index for convenience
-        l_df = ltable.set_index(l_key, drop=False)
-        r_df = rtable.set_index(r_key, drop=False)
-
-        # #create look up index for faster processing.
-        l_dict={}
-        for k, r in l_df.iterrows():
-            l_dict[k] = r
+                     sink=None, chunk_size=100000, n_jobs=1, verbose=True, show_progress=True):
+        """
+        Block the tables, keeping the pairs of the cartesian product for which the black box function does
+        not return True.
 
-        r_dict={}
-        for k, r in r_df.iterrows():
-            r_dict[k] = r
+        The product is split into tiles (a range of ltable rows times a range of rtable rows), which are
+        processed by n_jobs worker processes (-1 means all cpus); the workers are forked, so the black box
+        function does not need to be picklable. The candset is the same, in the same order, for any n_jobs.
+        """
+        stats = self.stats
 
-        # #get the position of the id attribute in the tables.
-        l_id_pos = list(ltable.columns).index(l_key)
-        r_id_pos = list(rtable.columns).index(r_key)
-
-        # #iterate through the tuples and apply the black box function
-        for l_t in ltable.itertuples(index=False):
-            for r_t in rtable.itertuples(index=False):
-                if show_progress:
-                    bar.update()
+        with stats.stage('validate'):
+            # validate the presence of black box function
+            self.validate_black_box_function()
 
-                l_tuple = l_dict[l_t[l_id_pos]]
-                r_tuple = r_dict[r_t[r_id_pos]]
+            # validate output attributes
+            self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
 
-                res = self.black_box_function(l_tuple, r_tuple)
+            # metadata related stuff..
 
-                if not res is True: # "not" because, we want to include only tuple pairs that SURVIVE the blocking fn.
-                    d = OrderedDict()
+            # required metadata: keys for the input tables
+            helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
 
-                    # #add ltable and rtable ids
-                    ltable_id = l_output_prefix+l_key
-                    rtable_id = r_output_prefix+r_key
+            # get metadata
+            l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
 
-                    d[ltable_id] = l_tuple[l_key]
-                    d[rtable_id] = r_tuple[r_key]
+            # validate metadata.
+            cg.validate_metadata_for_table(ltable, l_key, 'left', logger, verbose)
+            cg.validate_metadata_for_table(rtable, r_key, 'right', logger, verbose)
 
-                    # #add left table attributes
-                    if l_output_attrs:
-                        l_out = l_tuple[l_output_attrs]
-                        l_out.index = l_output_prefix + l_out.index
-                        d.update(l_out)
-
-                    # #add right table attributes
-                    if r_output_attrs:
-                        r_out = r_tuple(r_output_attrs)
-                        r_out.index = r_output_prefix + r_out.index
-                        d.update(r_out)
-
-                    # #add the ordered dict to block_list
-                    block_list.append(d)
-
-        # Construct the output table
-        candset = pd.DataFrame(block_list)
-        l_output_attrs = self.process_output_attrs(ltable, l_key, l_output_attrs, 'left')
-        r_output_attrs = self.process_output_attrs(rtable, r_key, r_output_attrs, 'right')
-
-        retain_cols = self.get_attrs_to_retain(l_key, r_key, l_output_attrs, r_output_attrs,
-                                               l_output_prefix, r_output_prefix)
-        if len(candset) > 0:
-            candset = candset[retain_cols]
-        else:
-            candset = pd.DataFrame(columns=retain_cols)
+        # do blocking
+        stats.add('pairs_evaluated', len(ltable) * len(rtable))
+        pair_chunks = self.iter_black_box_pairs(ltable, rtable, l_key, r_key, n_jobs, show_progress)
+        pair_chunks = stats.iter_stage('black_box', pair_chunks)
 
-        # update metadata in the catalog.
-        key = helper.get_name_for_key(candset.columns)
-        candset = helper.add_key_column(candset, key)
-        cg.set_candset_properties(candset, key, l_output_prefix+l_key, r_output_prefix+r_key, ltable, rtable)
+        # construct the output table (or stream it to the sink) and update metadata in the catalog.
+        candset = self.assemble_candset(pair_chunks, ltable, rtable, l_key, r_key, l_output_attrs, r_output_attrs,
+                                        l_output_prefix, r_output_prefix, sink=sink, chunk_size=chunk_size)
 
         # return the candidate set
         return candset
 
+    @record_stats
+    def block_candset(self, candset, n_jobs=1, verbose=True, show_progress=True):
+        """
+        Block the candset, keeping the pairs for which the black box function does not return True. The
+        candset is split into chunks, which are processed by n_jobs worker processes (-1 means all cpus).
+        """
+        stats = self.stats
+        stats.add('pairs_in', len(candset))
 
-    def block_candset(self, candset, verbose=True, show_progress=True):
+        with stats.stage('validate'):
+            # validate the presence of black box function
+            self.validate_black_box_function()
 
-        # validate the presence of black box function
-        if self.black_box_function is None:
-            raise AssertionError('Black box function is not set')
-
-        # required metadata: key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key
-        helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
-                                'ltable, rtable, ltable key, rtable key', verbose)
-
-        # get metadata
-        key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger, verbose)
+            # required metadata: key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key
+            helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
+                                    'ltable, rtable, ltable key, rtable key', verbose)
 
+            # get metadata
+            key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger,
+                                                                                                verbose)
 
-        # validate metadata
-        cg.validate_metadata_for_candset(candset, key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key,
-                                         logger, verbose)
+            # validate metadata
+            cg.validate_metadata_for_candset(candset, key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key,
+                                             logger, verbose)
 
         # do blocking
-        if show_progress:
-            bar = pyprind.ProgBar(len(candset))
-
-        # #set index for convenience
-        l_df = ltable.set_index(l_key, drop=False)
-        r_df = rtable.set_index(r_key, drop=False)
-
-        # #create a lookup table for a quick access of rows
-        l_dict = {}
-        for k, r in l_df.iterrows():
-            l_dict[k] = r
-
-        r_dict = {}
-        for k, r in r_df.iterrows():
-            r_dict[k] = r
-
-
-        # #keep track of valid ids
-        valid = []
-        l_id_pos = list(candset.columns).index(l_key)
-        r_id_pos = list(candset.columns).index(r_key)
-
-        for row in candset.itertuples(index=False):
-            if show_progress:
-                bar.update()
-
-            l_tuple = l_dict[row[l_id_pos]]
-            r_tuple = r_dict[row[r_id_pos]]
-
-            res = self.black_box_function(l_tuple, r_tuple)
 
-            if not res is True:
-                valid.append(True)
-            else:
-                valid.append(False)
+        # #map the foreign keys to the positions of the rows
+        l_rows, r_rows = self.get_candset_positions(candset, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key)
+
+        # #look up the cached decisions, and evaluate the black box function only on the other pairs
+        cache = self.decision_cache
+        if cache is not None:
+            with stats.stage('decision_cache'):
+                fingerprint = self.get_function_fingerprint()
+                pair_hashes = dc.get_pair_hashes(dc.get_row_hashes(ltable, l_key, self.l_attrs)[l_rows],
+                                                 dc.get_row_hashes(rtable, r_key, self.r_attrs)[r_rows])
+                found, valid = cache.lookup(fingerprint, pair_hashes)
+                todo = np.flatnonzero(~found)
+            with stats.stage('black_box'):
+                valid[todo] = self.apply_to_pairs(ltable, rtable, l_key, r_key, l_rows[todo], r_rows[todo],
+                                                  n_jobs, show_progress)
+            with stats.stage('decision_cache'):
+                cache.update(fingerprint, pair_hashes[todo], valid[todo])
+            stats.add('pairs_evaluated', len(todo))
+        else:
+            with stats.stage('black_box'):
+                valid = self.apply_to_pairs(ltable, rtable, l_key, r_key, l_rows, r_rows, n_jobs, show_progress)
+            stats.add('pairs_evaluated', len(candset))
 
         # construct the output table
-        if len(candset) > 0:
-            out_table = candset[valid]
-        else:
-            out_table = pd.DataFrame(columns=candset.columns)
+        with stats.stage('assemble'):
+            if len(candset) > 0 or isinstance(candset, LazyCandset):
+                out_table = candset[valid]
+            else:
+                out_table = pd.DataFrame(columns=candset.columns)
 
-        # update the catalog
-        cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+            # update the catalog
+            cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+        stats.add('pairs_emitted', len(out_table))
 
         # return the output table
         return out_table
 
     def block_tuples(self, ltuple, rtuple):
         # validate the presence of black box function
-        if self.black_box_function is None:
-            raise AssertionError('Black box function is not set')
+        self.validate_black_box_function()
 
+        if self.batch_black_box_function is not None:
+            l_columns = dict((attr, np.array([ltuple[attr]])) for attr in (self.l_attrs or ltuple.index))
+            r_columns = dict((attr, np.array([rtuple[attr]])) for attr in (self.r_attrs or rtuple.index))
+            return bool(self.batch_black_box_function(l_columns, r_columns)[0])
         return self.black_box_function(ltuple, rtuple)
 
 
 
 
     # utility functions.
+
+    # apply the black box function to the pairs given by the positions of their rows, a chunk at a time, and
+    # return the boolean mask of the pairs that survive
+    def apply_to_pairs(self, ltable, rtable, l_key, r_key, l_rows, r_rows, n_jobs, show_progress):
+        n_procs = helper.get_num_procs(n_jobs, len(l_rows))
+        chunks = helper.split_into_chunks(len(l_rows), max(4 * n_procs, int(math.ceil(len(l_rows) / 10000.0))))
+        function = _block_pairs if self.batch_black_box_function is None else _block_pairs_batch
+        results = self.iter_map(function, chunks, n_procs, show_progress, l_rows=l_rows, r_rows=r_rows,
+                                **self.get_shared_tables(ltable, rtable, l_key, r_key))
+        return np.concatenate([np.zeros(0, dtype=bool)] + list(results))
+
+    # fingerprint of the black box function (and of what its decisions depend on), for the decision cache
+    def get_function_fingerprint(self):
+        if self.batch_black_box_function is not None:
+            return dc.get_function_fingerprint(self.batch_black_box_function, 'batch', self.l_attrs, self.r_attrs,
+                                               self.decision_cache_version)
+        return dc.get_function_fingerprint(self.black_box_function, self.row_type, self.l_attrs, self.r_attrs,
+                                           self.decision_cache_version)
+
+    # apply the black box function to all pairs of the cartesian product and generate the positions of
+    # the pairs that survive, one range of ltable rows at a time (in ltable order, then rtable order)
+    def iter_black_box_pairs(self, ltable, rtable, l_key, r_key, n_jobs, show_progress):
+        n_procs = helper.get_num_procs(n_jobs, len(ltable))
+        tiles = self.get_tiles(len(ltable), len(rtable), 4 * n_procs)
+        function = _block_tile if self.batch_black_box_function is None else _block_tile_batch
+        results = self.iter_map(function, tiles, n_procs, show_progress,
+                                **self.get_shared_tables(ltable, rtable, l_key, r_key))
+
+        # #the tiles of an ltable range come one after another; merge their pairs back into ltable order
+        l_range, l_pos, r_pos = None, [], []
+        for tile, (l, r) in itertools.izip(tiles, results):
+            if tile[0] != l_range and len(l_pos) > 0:
+                yield self.merge_tile_pairs(l_pos, r_pos)
+                l_pos, r_pos = [], []
+            l_range = tile[0]
+            l_pos.append(l)
+            r_pos.append(r)
+
+        if len(l_pos) > 0:
+            yield self.merge_tile_pairs(l_pos, r_pos)
+
+    # split the cartesian product into (ltable range, rtable range) tiles of at most max_tile_pairs pairs,
+    # with at least min_tiles tiles (if there are enough rows), ordered by ltable range, then rtable range
+    def get_tiles(self, n_l, n_r, min_tiles, max_tile_pairs=100000):
+        l_ranges = helper.split_into_chunks(n_l, max(min_tiles, int(math.ceil(n_l * n_r / float(max_tile_pairs)))))
+        tiles = []
+        for l_range in l_ranges:
+            num_pairs = (l_range[1] - l_range[0]) * n_r
+            r_ranges = helper.split_into_chunks(n_r, int(math.ceil(num_pairs / float(max_tile_pairs))))
+            tiles.extend((l_range, r_range) for r_range in r_ranges)
+        return tiles
+
+    def merge_tile_pairs(self, l_pos, r_pos):
+        l_pos = np.concatenate(l_pos)
+        r_pos = np.concatenate(r_pos)
+        if len(l_pos) > 0:
+            order = np.lexsort((r_pos, l_pos))
+            l_pos, r_pos = l_pos[order], r_pos[order]
+        return l_pos, r_pos
+
+    def validate_black_box_function(self):
+        if self.black_box_function is None and self.batch_black_box_function is None:
+            raise AssertionError('Black box function is not set')
+
+    # the inputs of the black box function, shared with the workers: the rows of the tables for a per-pair
+    # function, or their columns for a batch function
+    def get_shared_tables(self, ltable, rtable, l_key, r_key):
+        if self.batch_black_box_function is not None:
+            return dict(l_columns=self.get_columns(ltable, self.l_attrs),
+                        r_columns=self.get_columns(rtable, self.r_attrs))
+        return dict(l_tuples=self.get_tuples(ltable, l_key, self.l_attrs),
+                    r_tuples=self.get_tuples(rtable, r_key, self.r_attrs))
+
+    # the given attributes (or all) of a table, as a dict of numpy arrays
+    def get_columns(self, table, attrs):
+        if attrs is None:
+            attrs = list(table.columns)
+        elif not isinstance(attrs, list):
+            attrs = [attrs]
+        assert set(attrs).issubset(table.columns) is True, 'The attributes read by the black box function ' \
+                                                           'are not in the table'
+        return dict((attr, table[attr].values) for attr in attrs)
+
+    # the rows of a table, by position, as self.row_type records of the given attributes (or all of them)
+    def get_tuples(self, table, key, attrs):
+        if attrs is not None:
+            if not isinstance(attrs, list):
+                attrs = [attrs]
+            assert set(attrs).issubset(table.columns) is True, 'The attributes read by the black box function ' \
+                                                               'are not in the table'
+        else:
+            attrs = list(table.columns)
+
+        if self.row_type == 'series':
+            # project before indexing by the key, so that only the attributes read are copied
+            df = table[attrs]
+            df.index = pd.Index(table[key].values, name=key)
+            return [r for k, r in df.iterrows()]
+
+        # build the records column-wise, from lists of python scalars
+        columns = [table[attr].tolist() for attr in attrs]
+        value_rows = itertools.izip(*columns) if len(columns) > 0 else [()] * len(table)
+        if self.row_type == 'dict':
+            return [dict(itertools.izip(attrs, values)) for values in value_rows]
+        record = namedtuple('Row', attrs, rename=True)
+        return [record._make(values) for values in value_rows]
+
+    # apply function (a module level function, called as function(state, item)) to the items, in a pool of
+    # worker processes when n_procs > 1, and generate the results in order. the state of the call is given
+    # to the pool initializer, so the forked workers inherit it (including the black box function) without
+    # pickling, and overlapping calls (e.g. a nested block_tables) each keep their own state.
+    def iter_map(self, function, items, n_procs, show_progress, **state):
+        if show_progress:
+            bar = pyprind.ProgBar(max(1, len(items)))
+
+        state = dict(state, blocker=self)
+        if n_procs > 1:
+            pool = helper.get_worker_pool(n_procs, state)
+            try:
+                for res in pool.imap(helper.call_with_worker_state, [(function, item) for item in items]):
+                    if show_progress:
+                        bar.update()
+                    yield res
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for item in items:
+                if show_progress:
+                    bar.update()
+                yield function(state, item)
+
+
+# the functions applied by iter_map, called with the state of the call (s) and an item
+def _block_tile(s, tile):
+    (l_begin, l_end), (r_begin, r_end) = tile
+    black_box_function = s['blocker'].black_box_function
+    r_tuples = s['r_tuples'][r_begin:r_end]
+
+    l_pos = []
+    r_pos = []
+    for l_idx in range(l_begin, l_end):
+        l_tuple = s['l_tuples'][l_idx]
+        for r_idx, r_tuple in enumerate(r_tuples, r_begin):
+            res = black_box_function(l_tuple, r_tuple)
+            if not res is True: # "not" because, we want to include only tuple pairs that SURVIVE the blocking fn.
+                l_pos.append(l_idx)
+                r_pos.append(r_idx)
+    return np.array(l_pos, dtype=np.int64), np.array(r_pos, dtype=np.int64)
+
+
+def _block_pairs(s, chunk):
+    begin, end = chunk
+    black_box_function = s['blocker'].black_box_function
+    l_tuples = s['l_tuples']
+    r_tuples = s['r_tuples']
+    valid = [not black_box_function(l_tuples[l], r_tuples[r]) is True
+             for l, r in zip(s['l_rows'][begin:end], s['r_rows'][begin:end])]
+    return np.array(valid, dtype=bool)
+
+
+# apply the batch black box function to the pairs given by the positions of their rows, and return the
+# boolean mask of the pairs that survive
+def _apply_batch_function(s, l_rows, r_rows):
+    l_columns = dict((attr, values[l_rows]) for attr, values in s['l_columns'].items())
+    r_columns = dict((attr, values[r_rows]) for attr, values in s['r_columns'].items())
+    drop = np.asarray(s['blocker'].batch_black_box_function(l_columns, r_columns), dtype=bool)
+    assert drop.shape == (len(l_rows),), 'The batch black box function must return one value per pair'
+    return ~drop
+
+
+def _block_tile_batch(s, tile):
+    (l_begin, l_end), (r_begin, r_end) = tile
+    l_pos = np.repeat(np.arange(l_begin, l_end, dtype=np.int64), r_end - r_begin)
+    r_pos = np.tile(np.arange(r_begin, r_end, dtype=np.int64), l_end - l_begin)
+    valid = _apply_batch_function(s, l_pos, r_pos)
+    return l_pos[valid], r_pos[valid]
+
+
+def _block_pairs_batch(s, chunk):
+    begin, end = chunk
+    return _apply_batch_function(s, s['l_rows'][begin:end], s['r_rows'][begin:end])
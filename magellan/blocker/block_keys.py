@@ -0,0 +1,80 @@
+"""
+Key functions for AttrEquivalenceBlocker. A key function maps a table to a column (pandas series) with one
+key per row, or NaN when the row has no key; it can be used in place of a block attribute, alone or as part
+of a composite key. The functions below are vectorized over the column, or applied once per distinct value.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def lower_key(attr):
+    """
+    Key function: the value of the attribute, in lower case.
+
+    Examples:
+        >>> ab = mg.AttrEquivalenceBlocker()
+        >>> C = ab.block_tables(A, B, [mg.lower_key('last_name'), mg.prefix_key('first_name', 1), 'year'],
+        ...                     [mg.lower_key('last_name'), mg.prefix_key('first_name', 1), 'year'])
+    """
+    def key(table):
+        return _get_str_column(table, attr).str.lower()
+    return key
+
+
+def prefix_key(attr, length, lower=True):
+    """
+    Key function: the first length characters of the attribute value (in lower case, unless lower is False).
+    """
+    def key(table):
+        col = _get_str_column(table, attr)
+        if lower:
+            col = col.str.lower()
+        return col.str[:length]
+    return key
+
+
+def soundex_key(attr):
+    """
+    Key function: the (american) soundex code of the attribute value, e.g. 'R163' for both 'Robert' and
+    'Rupert'. Values without any ascii letter have no key.
+    """
+    def key(table):
+        col = _get_str_column(table, attr)
+        codes, uniques = pd.factorize(col)
+        # each distinct value is encoded once; code -1 (missing) picks the trailing NaN
+        keys = np.array([soundex(val) for val in uniques] + [np.NaN], dtype=object)
+        return pd.Series(keys[codes], index=col.index)
+    return key
+
+
+_soundex_digits = dict((c, d) for letters, d in [('BFPV', '1'), ('CGJKQSXZ', '2'), ('DT', '3'), ('L', '4'),
+                                                  ('MN', '5'), ('R', '6')] for c in letters)
+
+
+def soundex(value):
+    """
+    Soundex code of a string (NaN if it has no ascii letter).
+    """
+    letters = [c for c in value.upper() if 'A' <= c <= 'Z']
+    if len(letters) == 0:
+        return np.NaN
+    code = letters[0]
+    prev = _soundex_digits.get(letters[0], '')
+    for c in letters[1:]:
+        # h and w do not separate letters with the same digit; vowels do
+        if c in 'HW':
+            continue
+        digit = _soundex_digits.get(c, '')
+        if digit != '' and digit != prev:
+            code += digit
+        prev = digit
+    return (code + '000')[:4]
+
+
+# the attribute as a column of strings (missing values stay missing)
+def _get_str_column(table, attr):
+    col = table[attr]
+    if col.dtype != object:
+        col = col.astype(str).where(col.notnull())
+    return col
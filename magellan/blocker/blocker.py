@@ -1,17 +1,30 @@
+from collections import OrderedDict
+
 import numpy as np
+import pandas as pd
+
 import magellan.utils.helperfunctions as helper
 import magellan.core.catalog as cg
+from magellan.core.lazy_candset import LazyCandset
+from magellan.io.sinks import LazySink
+from magellan.utils.stats import _null_stats
 
 
 class Blocker(object):
-    pass
+    # stats of the last recorded call (see magellan.utils.stats.record_stats)
+    stats = _null_stats
 
-    # remove nows with nan values at block_attr
+    # remove nows with nan values at block_attr (with a boolean mask; the blockers themselves do not copy
+    # the tables, they work on the positions of the rows with a value, see get_not_null_positions)
 
     @staticmethod
     def rem_nan(table, block_attr):
-        l = table.index.values[np.where(table[block_attr].notnull())[0]]
-        return table.ix[l]
+        return table[table[block_attr].notnull().values]
+
+    # positions of the rows with a value at attr
+    @staticmethod
+    def get_not_null_positions(table, attr):
+        return np.flatnonzero(table[attr].notnull().values)
 
 
 
@@ -40,7 +53,111 @@ class Blocker(object):
     def get_attrs_to_retain(self, l_key, r_key, l_output_attrs, r_output_attrs, l_output_prefix, r_output_prefix):
         ret_cols = [l_output_prefix + l_key, r_output_prefix + r_key]
         if l_output_attrs:
-            ret_cols.extend([l_output_prefix]+c for c in l_output_attrs)
+            ret_cols.extend(l_output_prefix + c for c in l_output_attrs)
         if r_output_attrs:
-            ret_cols.extend([r_output_prefix]+c for c in r_output_attrs)
+            ret_cols.extend(r_output_prefix + c for c in r_output_attrs)
         return ret_cols
+
+    # construct the candset from the positions of surviving tuple pairs; l_pos[i] and r_pos[i] are the
+    # row positions (not labels) of the i-th pair in l_df and r_df. every output column is gathered with a
+    # single take, so the cost is linear in the number of pairs and independent of how they were found.
+    @staticmethod
+    def build_candset_from_positions(l_df, r_df, l_pos, r_pos, l_key, r_key, l_output_attrs, r_output_attrs,
+                                     l_output_prefix, r_output_prefix):
+        l_pos = np.asarray(l_pos, dtype=np.int64)
+        r_pos = np.asarray(r_pos, dtype=np.int64)
+
+        cols = OrderedDict()
+        cols[l_output_prefix + l_key] = l_df[l_key].values.take(l_pos)
+        cols[r_output_prefix + r_key] = r_df[r_key].values.take(r_pos)
+        if l_output_attrs:
+            for c in l_output_attrs:
+                cols[l_output_prefix + c] = l_df[c].values.take(l_pos)
+        if r_output_attrs:
+            for c in r_output_attrs:
+                cols[r_output_prefix + c] = r_df[c].values.take(r_pos)
+
+        return pd.DataFrame(cols, columns=list(cols.keys()))
+
+    # positions of the rows of the candset pairs in the ltable and rtable (read directly from a lazy candset)
+    @staticmethod
+    def get_candset_positions(candset, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key):
+        if isinstance(candset, LazyCandset):
+            return candset.l_pos.astype(np.int64), candset.r_pos.astype(np.int64)
+        l_rows = pd.Index(ltable[l_key]).get_indexer(candset[fk_ltable])
+        r_rows = pd.Index(rtable[r_key]).get_indexer(candset[fk_rtable])
+        return l_rows, r_rows
+
+    # construct the candset from a stream of (l_pos, r_pos) chunks holding the positions of surviving pairs.
+    # without a sink the chunks are gathered into one candset, which is registered in the catalog. with a
+    # sink, each chunk is materialized (in pieces of at most chunk_size pairs) and written to the sink, so
+    # only one chunk is held in memory at a time; the return value is that of sink.close() (sink.abort() is
+    # called instead if the blocking or the sink fails). a LazySink
+    # gets the positions themselves, and returns a LazyCandset.
+    def assemble_candset(self, pair_chunks, ltable, rtable, l_key, r_key, l_output_attrs, r_output_attrs,
+                         l_output_prefix, r_output_prefix, sink=None, chunk_size=100000):
+        l_output_attrs = self.process_output_attrs(ltable, l_key, l_output_attrs, 'left')
+        r_output_attrs = self.process_output_attrs(rtable, r_key, r_output_attrs, 'right')
+        fk_ltable, fk_rtable = l_output_prefix + l_key, r_output_prefix + r_key
+        stats = self.stats
+
+        if sink is None:
+            with stats.stage('assemble'):
+                l_pos, r_pos = [], []
+                for l, r in pair_chunks:
+                    l_pos.append(l)
+                    r_pos.append(r)
+                l_pos = np.concatenate(l_pos) if len(l_pos) > 0 else np.array([], dtype=np.int64)
+                r_pos = np.concatenate(r_pos) if len(r_pos) > 0 else np.array([], dtype=np.int64)
+                candset = self.build_candset_from_positions(ltable, rtable, l_pos, r_pos, l_key, r_key,
+                                                            l_output_attrs, r_output_attrs,
+                                                            l_output_prefix, r_output_prefix)
+
+                # update metadata in the catalog
+                key = helper.get_name_for_key(candset.columns)
+                candset = helper.add_key_column(candset, key)
+                cg.set_candset_properties(candset, key, fk_ltable, fk_rtable, ltable, rtable)
+            stats.add('pairs_emitted', len(candset))
+            return candset
+
+        columns = self.get_attrs_to_retain(l_key, r_key, l_output_attrs, r_output_attrs,
+                                           l_output_prefix, r_output_prefix)
+        key = helper.get_name_for_key(columns)
+
+        if isinstance(sink, LazySink):
+            l_columns = OrderedDict([(fk_ltable, l_key)] + [(l_output_prefix + c, c) for c in l_output_attrs or []])
+            r_columns = OrderedDict([(fk_rtable, r_key)] + [(r_output_prefix + c, c) for c in r_output_attrs or []])
+            sink.open_positions(key, fk_ltable, fk_rtable, ltable, rtable, l_columns, r_columns)
+            with stats.stage('assemble'):
+                try:
+                    for l_pos, r_pos in pair_chunks:
+                        sink.write_positions(l_pos, r_pos)
+                except:
+                    sink.abort()
+                    raise
+                candset = sink.close()
+            stats.add('pairs_emitted', len(candset))
+            return candset
+
+        sink.open([key] + columns, key, fk_ltable, fk_rtable, ltable, rtable)
+        num_rows = 0
+        with stats.stage('assemble'):
+            # #on an error (in the blocking or in the sink), the sink discards its partial output
+            try:
+                for l_pos, r_pos in pair_chunks:
+                    for begin in range(0, len(l_pos), chunk_size):
+                        chunk = self.build_candset_from_positions(ltable, rtable, l_pos[begin:begin+chunk_size],
+                                                                  r_pos[begin:begin+chunk_size], l_key, r_key,
+                                                                  l_output_attrs, r_output_attrs,
+                                                                  l_output_prefix, r_output_prefix)
+                        chunk = helper.add_key_column(chunk, key, num_rows)
+                        num_rows += len(chunk)
+                        with stats.stage('sink'):
+                            sink.write(chunk)
+            except:
+                sink.abort()
+                raise
+            with stats.stage('sink'):
+                result = sink.close()
+        stats.add('pairs_emitted', num_rows)
+        return result
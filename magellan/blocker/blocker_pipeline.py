@@ -0,0 +1,265 @@
+import inspect
+import logging
+import logging.config
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from magellan.blocker.black_box_blocker import BlackBoxBlocker
+from magellan.blocker.blocker import Blocker
+import magellan.core.catalog as cg
+import magellan.utils.helperfunctions as helper
+from magellan.utils.stats import BlockerStats
+
+logging.config.fileConfig(helper.get_install_path()+'/configs/logging.ini')
+logger = logging.getLogger(__name__)
+
+
+class BlockerPipeline(object):
+    """
+    Conjunction of blockers: a pair survives the pipeline only if it survives every blocker. The pipeline
+    picks the order in which the blockers run from estimates taken on samples of the tables.
+
+    One blocker blocks the tables (block_tables) and the others filter its candset (block_candset). For each
+    blocker, the pipeline measures on the samples its selectivity (the fraction of pairs that survive) and
+    its cost, both per pair as a candset filter and to block the tables; the cost of blocking the tables is
+    scaled to the table sizes as a quadratic cost for black box blockers, which enumerate the cartesian
+    product, and as a cost linear in the input and output sizes for the others. The filters then run in
+    increasing order of cost / (1 - selectivity), which runs the cheap and selective ones first, and the
+    blocker for the tables is the one that gives the cheapest plan overall. The chosen plan, with its
+    estimates, is kept in self.plan (a dataframe) and logged.
+
+    Each measurement is repeated num_repeats times and the median time is used, so that a single slow run
+    does not change the plan. The sample runs have no side effects on the blockers: they are not reported
+    to the stats callbacks (and do not replace blocker.stats), and the decision cache of a black box blocker
+    is neither read nor filled.
+
+    Args:
+        sample_size (int): Number of rows sampled from each table (defaults to 100)
+        random_state (int): Seed for the samples (defaults to None)
+        num_repeats (int): Number of times each measurement is repeated (defaults to 3)
+
+    Examples:
+        >>> pipeline = mg.BlockerPipeline()
+        >>> pipeline.add_blocker(mg.AttrEquivalenceBlocker(), 'zipcode', 'zipcode')
+        >>> pipeline.add_blocker(ob, 'address', 'address', overlap_size=2)
+        >>> pipeline.add_blocker(bb)
+        >>> C = pipeline.block_tables(A, B, l_output_attrs=['name'], r_output_attrs=['name'])
+        >>> pipeline.plan
+    """
+
+    def __init__(self, sample_size=100, random_state=None, num_repeats=3):
+        self.sample_size = sample_size
+        self.random_state = random_state
+        self.num_repeats = num_repeats
+        self.steps = []
+        self.plan = None
+
+    def add_blocker(self, blocker, *args, **kwargs):
+        """
+        Add a blocker to the conjunction. The positional and keyword arguments are passed to its block_tables
+        and block_candset after the tables (or the candset), so they must be accepted by both; e.g. the
+        block attributes of an AttrEquivalenceBlocker, or the overlap attributes and overlap_size of an
+        OverlapBlocker. A name for the plan can be given with the keyword argument name; show_progress is
+        set by the pipeline.
+        """
+        name = kwargs.pop('name', None)
+        if name is None:
+            name = type(blocker).__name__ + '(' + ', '.join(str(a) for a in args) + ')'
+        self.steps.append(dict(name=name, blocker=blocker, args=args, kwargs=kwargs))
+        return self
+
+    def block_tables(self, ltable, rtable, l_output_attrs=None, r_output_attrs=None,
+                     l_output_prefix='ltable_', r_output_prefix='rtable_', verbose=True, show_progress=True):
+        assert len(self.steps) > 0, 'The pipeline has no blockers'
+
+        helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
+        l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
+
+        # choose the plan
+        estimates = self.estimate_steps(ltable, rtable, l_key, r_key, True)
+        order = self.get_plan(estimates, len(ltable), len(rtable))
+        self.plan = self.get_plan_report(estimates, order, len(ltable), len(rtable), None)
+        helper.log_info(logger, 'Blocker pipeline plan:\n' + self.plan.to_string(), verbose)
+
+        # run it
+        first = self.steps[order[0]]
+        candset = first['blocker'].block_tables(ltable, rtable, *first['args'],
+                                                l_output_attrs=l_output_attrs, r_output_attrs=r_output_attrs,
+                                                l_output_prefix=l_output_prefix, r_output_prefix=r_output_prefix,
+                                                verbose=False,
+                                                **_with_progress(first['blocker'].block_tables, show_progress,
+                                                                 first['kwargs']))
+        return self.run_filters(candset, order[1:], False, show_progress)
+
+    def block_candset(self, candset, verbose=True, show_progress=True):
+        assert len(self.steps) > 0, 'The pipeline has no blockers'
+
+        helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
+                                'ltable, rtable, ltable key, rtable key', verbose)
+        key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger,
+                                                                                            verbose)
+
+        estimates = self.estimate_steps(ltable, rtable, l_key, r_key, False)
+        order = self.get_filter_order(estimates, range(len(self.steps)))
+        self.plan = self.get_plan_report(estimates, order, len(ltable), len(rtable), len(candset))
+        helper.log_info(logger, 'Blocker pipeline plan:\n' + self.plan.to_string(), verbose)
+
+        return self.run_filters(candset, order, True, show_progress)
+
+    # helper functions
+
+    # apply the blockers of the given steps to the candset, in order; the catalog entries of the intermediate
+    # candsets (and of the input candset, unless keep_input) are removed
+    def run_filters(self, candset, steps, keep_input, show_progress):
+        for i in steps:
+            step = self.steps[i]
+            out_table = step['blocker'].block_candset(candset, *step['args'], verbose=False,
+                                                      show_progress=show_progress, **step['kwargs'])
+            if not keep_input:
+                _del_properties(candset)
+            keep_input = False
+            candset = out_table
+        return candset
+
+    # measure the selectivity and the costs of each blocker on samples of the tables: the cost per pair of
+    # block_candset on the cartesian product of the samples, and (if with_tables) the time of block_tables
+    # on the samples (the median time of num_repeats runs, without side effects on the blocker)
+    def estimate_steps(self, ltable, rtable, l_key, r_key, with_tables):
+        l_sample = ltable.sample(min(self.sample_size, len(ltable)), random_state=self.random_state)
+        r_sample = rtable.sample(min(self.sample_size, len(rtable)), random_state=self.random_state)
+        l_sample = l_sample.reset_index(drop=True)
+        r_sample = r_sample.reset_index(drop=True)
+        cg.set_key(l_sample, l_key)
+        cg.set_key(r_sample, r_key)
+
+        n_l, n_r = len(l_sample), len(r_sample)
+        l_pos = np.repeat(np.arange(n_l, dtype=np.int64), n_r)
+        r_pos = np.tile(np.arange(n_r, dtype=np.int64), n_l)
+        product = Blocker().assemble_candset([(l_pos, r_pos)], l_sample, r_sample, l_key, r_key, None, None,
+                                             'ltable_', 'rtable_')
+        num_pairs = max(1, len(product))
+
+        estimates = []
+        try:
+            for step in self.steps:
+                blocker, args, kwargs = step['blocker'], step['args'], step['kwargs']
+                with _unrecorded(blocker):
+                    candset_time, out_table = self.time_calls(
+                        lambda: blocker.block_candset(product, *args, verbose=False, show_progress=False, **kwargs))
+                    pair_cost = candset_time / num_pairs
+                    # smoothed, so that no blocker looks perfectly selective (or useless) on a small sample
+                    selectivity = (len(out_table) + 0.5) / (num_pairs + 1.0)
+                    _del_properties(out_table)
+
+                    tables_time = None
+                    if with_tables:
+                        tables_time, out_table = self.time_calls(
+                            lambda: blocker.block_tables(l_sample, r_sample, *args, verbose=False,
+                                                         **_with_progress(blocker.block_tables, False, kwargs)))
+                        _del_properties(out_table)
+                estimates.append(dict(pair_cost=pair_cost, selectivity=selectivity, tables_time=tables_time,
+                                      n_l=n_l, n_r=n_r))
+        finally:
+            for df in [product, l_sample, r_sample]:
+                _del_properties(df)
+        return estimates
+
+    # call a function num_repeats times; returns the median time of the calls and the result of the last one
+    # (the other results are removed from the catalog)
+    def time_calls(self, function):
+        times, result = [], None
+        for i in range(max(1, self.num_repeats)):
+            if result is not None:
+                _del_properties(result)
+            start = time.time()
+            result = function()
+            times.append(time.time() - start)
+        return float(np.median(times)), result
+
+    # estimated time of block_tables on the full tables
+    def get_tables_cost(self, step, estimate, n_l, n_r):
+        sample_pairs = float(max(1, estimate['n_l'] * estimate['n_r']))
+        if isinstance(step['blocker'], BlackBoxBlocker):
+            return estimate['tables_time'] * n_l * n_r / sample_pairs
+        sample_size = estimate['n_l'] + estimate['n_r'] + estimate['selectivity'] * sample_pairs
+        size = n_l + n_r + estimate['selectivity'] * n_l * n_r
+        return estimate['tables_time'] * size / max(1.0, sample_size)
+
+    # order the filters by increasing cost per pair removed
+    def get_filter_order(self, estimates, steps):
+        return sorted(steps, key=lambda i: estimates[i]['pair_cost'] / max(1e-9, 1.0 - estimates[i]['selectivity']))
+
+    # pick the blocker for the tables that gives the cheapest plan; returns the order of the steps
+    def get_plan(self, estimates, n_l, n_r):
+        best_cost, best_order = None, None
+        for first in range(len(self.steps)):
+            filters = self.get_filter_order(estimates, [i for i in range(len(self.steps)) if i != first])
+            order = [first] + filters
+            cost = self.get_tables_cost(self.steps[first], estimates[first], n_l, n_r)
+            num_pairs = estimates[first]['selectivity'] * n_l * n_r
+            for i in filters:
+                cost += estimates[i]['pair_cost'] * num_pairs
+                num_pairs *= estimates[i]['selectivity']
+            if best_cost is None or cost < best_cost:
+                best_cost, best_order = cost, order
+        return best_order
+
+    # one row per step of the plan, with its estimates; num_pairs is the size of the input candset, or None
+    # if the plan starts by blocking the tables
+    def get_plan_report(self, estimates, order, n_l, n_r, num_pairs):
+        rows = []
+        for rank, i in enumerate(order):
+            step, estimate = self.steps[i], estimates[i]
+            row = OrderedDict()
+            row['blocker'] = step['name']
+            if num_pairs is None:
+                num_pairs = n_l * n_r
+                row['method'] = 'block_tables'
+                row['input_pairs'] = num_pairs
+                row['est_seconds'] = self.get_tables_cost(step, estimate, n_l, n_r)
+            else:
+                row['method'] = 'block_candset'
+                row['input_pairs'] = num_pairs
+                row['est_seconds'] = estimate['pair_cost'] * num_pairs
+            row['est_selectivity'] = estimate['selectivity']
+            row['est_pair_cost'] = estimate['pair_cost']
+            num_pairs = int(round(num_pairs * estimate['selectivity']))
+            rows.append(row)
+        return pd.DataFrame(rows, columns=['blocker', 'method', 'input_pairs', 'est_seconds', 'est_selectivity',
+                                           'est_pair_cost'])
+
+
+# remove a dataframe from the catalog, if it is there
+def _del_properties(df):
+    if cg.is_dfinfo_present(df):
+        cg.del_all_properties(df)
+
+
+# run the blocker calls made in the block without side effects: they record into throwaway stats (so they
+# are not passed to the stats callbacks, and blocker.stats is kept), and without the decision cache of a
+# black box blocker
+@contextmanager
+def _unrecorded(blocker):
+    stats, cache = blocker.stats, getattr(blocker, 'decision_cache', None)
+    blocker.stats = BlockerStats('sample')
+    if cache is not None:
+        blocker.decision_cache = None
+    try:
+        # #a recorded method called within a stage records into the enclosing stats (see record_stats)
+        with blocker.stats.stage('sample'):
+            yield
+    finally:
+        blocker.stats = stats
+        if cache is not None:
+            blocker.decision_cache = cache
+
+
+# add show_progress to the keyword arguments of a blocker method, if it accepts it
+def _with_progress(method, show_progress, kwargs):
+    if 'show_progress' in inspect.getargspec(getattr(method, '__wrapped__', method)).args:
+        kwargs = dict(kwargs, show_progress=show_progress)
+    return kwargs
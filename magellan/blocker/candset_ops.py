@@ -0,0 +1,167 @@
+import logging
+import logging.config
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from magellan.blocker.blocker import Blocker
+import magellan.core.catalog as cg
+import magellan.utils.helperfunctions as helper
+
+
+logging.config.fileConfig(helper.get_install_path()+'/configs/logging.ini')
+logger = logging.getLogger(__name__)
+
+# Set operations on candsets of the same pair of tables (e.g. the outputs of several blockers, for disjunctive
+# blocking). Each pair is packed into one 64-bit integer, l_pos * len(rtable) + r_pos, where l_pos and r_pos
+# are the positions of its rows in the tables, and the operations are sorted integer set operations on the
+# packed pairs. The output candset has the columns of the input candsets, a fresh key column, and the catalog
+# properties of the first candset. The output attributes (prefix + attribute of the table) are gathered from
+# the tables, and the other columns from the first candset that has both the pair and the column (missing
+# values for the pairs that no such candset has).
+
+
+def union_candsets(candsets, verbose=True):
+    """
+    Union of candsets: the pairs that are in any of them, in the order of their first occurrence.
+
+    Args:
+        candsets (list): Candsets of the same ltable and rtable
+        verbose (boolean): Flag to indicate whether logging should be done
+
+    Examples:
+        >>> C = mg.union_candsets([C1, C2])
+    """
+    meta, keys = _get_packed_pairs(candsets, verbose)
+    all_keys = np.concatenate(keys)
+    if len(all_keys) > 0:
+        first = np.unique(all_keys, return_index=True)[1]
+        all_keys = all_keys[np.sort(first)]
+    return _build_candset(candsets, meta, keys, all_keys)
+
+
+def intersect_candsets(candsets, verbose=True):
+    """
+    Intersection of candsets: the pairs that are in all of them, in the order of the first one.
+
+    Args:
+        candsets (list): Candsets of the same ltable and rtable
+        verbose (boolean): Flag to indicate whether logging should be done
+    """
+    meta, keys = _get_packed_pairs(candsets, verbose)
+    out_keys = _get_unique_in_order(keys[0])
+    for other in keys[1:]:
+        out_keys = out_keys[np.in1d(out_keys, other)]
+    return _build_candset(candsets, meta, keys, out_keys)
+
+
+def diff_candsets(candset, candsets, verbose=True):
+    """
+    Difference of candsets: the pairs of candset that are in none of candsets, in the order of candset.
+
+    Args:
+        candset (pandas dataframe): Candset
+        candsets (list): Candsets (or a single candset) to subtract, of the same ltable and rtable
+        verbose (boolean): Flag to indicate whether logging should be done
+    """
+    if not isinstance(candsets, list):
+        candsets = [candsets]
+    meta, keys = _get_packed_pairs([candset] + candsets, verbose)
+    out_keys = _get_unique_in_order(keys[0])
+    if len(candsets) > 0:
+        out_keys = out_keys[~np.in1d(out_keys, np.concatenate(keys[1:]))]
+    # #only the columns of candset are kept
+    return _build_candset([candset], meta, keys[:1], out_keys)
+
+
+# validate the metadata of the candsets, and pack their pairs; returns the metadata of the first candset and
+# the packed pairs of each candset
+def _get_packed_pairs(candsets, verbose):
+    assert len(candsets) > 0, 'At least one candset must be given'
+
+    helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
+                            'ltable, rtable, ltable key, rtable key', verbose)
+    meta = None
+    keys = []
+    for candset in candsets:
+        key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger,
+                                                                                            verbose)
+        if meta is None:
+            meta = dict(key=key, fk_ltable=fk_ltable, fk_rtable=fk_rtable, ltable=ltable, rtable=rtable,
+                        l_key=l_key, r_key=r_key)
+        assert ltable is meta['ltable'] and rtable is meta['rtable'], 'The candsets must be of the same ' \
+                                                                      'ltable and rtable'
+
+        l_rows, r_rows = Blocker.get_candset_positions(candset, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key)
+        assert (l_rows >= 0).all() and (r_rows >= 0).all(), 'Cand.set does not satisfy foreign key ' \
+                                                            'constraint with the left and right tables'
+        keys.append(l_rows.astype(np.int64) * len(rtable) + r_rows)
+    return meta, keys
+
+
+# the distinct values of an array, in the order of their first occurrence
+def _get_unique_in_order(values):
+    if len(values) == 0:
+        return values
+    first = np.unique(values, return_index=True)[1]
+    return values[np.sort(first)]
+
+
+# build the candset of the given packed pairs, taking the values of the other columns from the candsets
+def _build_candset(candsets, meta, keys, out_keys):
+    ltable, rtable = meta['ltable'], meta['rtable']
+    fk_ltable, fk_rtable = meta['fk_ltable'], meta['fk_rtable']
+    l_pos, r_pos = np.divmod(out_keys, max(1, len(rtable)))
+
+    cols = OrderedDict()
+    cols[fk_ltable] = ltable[meta['l_key']].values.take(l_pos)
+    cols[fk_rtable] = rtable[meta['r_key']].values.take(r_pos)
+
+    # #the output attributes, by the prefixes of the foreign keys
+    out_attrs = dict()
+    for table, fk, table_key, pos in [(ltable, fk_ltable, meta['l_key'], l_pos),
+                                      (rtable, fk_rtable, meta['r_key'], r_pos)]:
+        if fk.endswith(table_key):
+            prefix = fk[:len(fk) - len(table_key)]
+            out_attrs.update((prefix + attr, (table, attr, pos)) for attr in table.columns)
+
+    # #find the row of each output pair in each candset (found tells whether the candset has the pair)
+    matches = []
+    for candset, candset_keys in zip(candsets, keys):
+        if len(candset_keys) == 0:
+            matches.append((np.zeros(len(out_keys), dtype=bool), np.zeros(len(out_keys), dtype=np.int64)))
+            continue
+        order = np.argsort(candset_keys, kind='mergesort')
+        pos = np.minimum(np.searchsorted(candset_keys[order], out_keys), len(order) - 1)
+        rows = order[pos]
+        matches.append((candset_keys[rows] == out_keys, rows))
+
+    # #gather the other columns, from the candsets that have them, the first ones first
+    for candset in candsets:
+        skip = [cg.get_key(candset), cg.get_property(candset, 'fk_ltable'), cg.get_property(candset, 'fk_rtable')]
+        for name in candset.columns:
+            if name in cols or name in skip:
+                continue
+            if name in out_attrs:
+                table, attr, pos = out_attrs[name]
+                cols[name] = table[attr].values.take(pos)
+                continue
+            sources = [(c[name].values, f, r) for c, (f, r) in zip(candsets, matches) if name in c.columns]
+            if sources[0][1].all():
+                # all the pairs are in the first candset that has the column, which keeps its dtype
+                cols[name] = sources[0][0].take(sources[0][2])
+                continue
+            values = np.full(len(out_keys), np.nan, dtype=object)
+            done = np.zeros(len(out_keys), dtype=bool)
+            for col, f, r in sources:
+                todo = f & ~done
+                values[todo] = col[r[todo]]
+                done |= todo
+            cols[name] = pd.Series(values).infer_objects().values
+
+    out_table = pd.DataFrame(cols, columns=list(cols.keys()))
+    key = helper.get_name_for_key(out_table.columns)
+    out_table = helper.add_key_column(out_table, key)
+    cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+    return out_table
@@ -0,0 +1,193 @@
+import glob
+import hashlib
+import os
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+
+class DecisionCache(object):
+    """
+    On-disk cache of the decisions of a black box function, so that BlackBoxBlocker.block_candset only
+    evaluates the function on the pairs it has not seen before.
+
+    A decision is keyed by a fingerprint of the black box function and by a 64-bit hash of the pair: the
+    ltable and rtable keys of the pair and the values of the attributes the function reads (l_attrs and
+    r_attrs, or all of them). A pair whose values changed is therefore evaluated again, and so is every
+    pair once the code of the function changes. The fingerprint covers the bytecode, constants, default
+    arguments and closure of the function, but not the globals or the other functions it calls; pass a
+    version to set_decision_cache to invalidate the decisions when those change.
+
+    The decisions of each function are kept in one .npz file in the cache directory. A file holds at most
+    max_size decisions, the least recently used ones being evicted first, and at most max_functions files
+    are kept, the least recently used ones being removed first. A lookup only reads the file: the decisions
+    it used are marked as used in memory, and the marks are saved with the new decisions by the following
+    update, so a fully cached run does not rewrite the file (and its marks are not kept).
+
+    Args:
+        path (str): Directory of the cache (created if it does not exist)
+        max_size (int): Maximum number of decisions kept per function (defaults to 10000000)
+        max_functions (int): Maximum number of functions whose decisions are kept (defaults to 10)
+
+    Examples:
+        >>> bb = BlackBoxBlocker()
+        >>> bb.set_black_box_function(fn, l_attrs=['year'], r_attrs=['year'], row_type='dict')
+        >>> bb.set_decision_cache(mg.DecisionCache('./bb_cache'))
+        >>> D = bb.block_candset(C)
+    """
+
+    def __init__(self, path, max_size=10000000, max_functions=10):
+        self.path = path
+        self.max_size = max_size
+        self.max_functions = max_functions
+        self.hits = 0
+        self.misses = 0
+        # the decisions read by the last lookup (fingerprint, hashes, valid, stamps), for the following update
+        self._loaded = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def clear(self):
+        for file_name in self._get_files():
+            os.remove(file_name)
+
+    def lookup(self, fingerprint, pair_hashes):
+        """
+        Look up the decisions of a function for the given pair hashes.
+
+        Returns:
+            Boolean arrays (found, valid): whether a decision is cached for each pair, and (where found) whether
+            the pair survives the black box function
+        """
+        hashes, valid, stamps = self._load(fingerprint)
+        found = np.zeros(len(pair_hashes), dtype=bool)
+        out = np.zeros(len(pair_hashes), dtype=bool)
+        if len(hashes) > 0 and len(pair_hashes) > 0:
+            pos = np.minimum(np.searchsorted(hashes, pair_hashes), len(hashes) - 1)
+            found = hashes[pos] == pair_hashes
+            out[found] = valid[pos[found]]
+            # #mark the decisions that were used, for the eviction (saved by update), and the file
+            if found.any():
+                stamps[pos[found]] = time.time()
+                os.utime(self._get_file(fingerprint), None)
+        self._loaded = (fingerprint, hashes, valid, stamps)
+        self.hits += int(found.sum())
+        self.misses += len(pair_hashes) - int(found.sum())
+        return found, out
+
+    def update(self, fingerprint, pair_hashes, valid):
+        """
+        Add the decisions of a function for the given pair hashes, evicting the least recently used decisions
+        beyond max_size.
+        """
+        loaded, self._loaded = self._loaded, None
+        if len(pair_hashes) == 0:
+            return
+        if loaded is not None and loaded[0] == fingerprint:
+            old_hashes, old_valid, old_stamps = loaded[1:]
+        else:
+            old_hashes, old_valid, old_stamps = self._load(fingerprint)
+        hashes = np.concatenate([old_hashes, np.asarray(pair_hashes, dtype=np.uint64)])
+        valid = np.concatenate([old_valid, np.asarray(valid, dtype=bool)])
+        stamps = np.concatenate([old_stamps, np.repeat(time.time(), len(pair_hashes))])
+
+        # #keep one decision per hash (the pairs may repeat), and the most recently used ones
+        hashes, first = np.unique(hashes, return_index=True)
+        valid, stamps = valid[first], stamps[first]
+        if len(hashes) > self.max_size:
+            keep = np.sort(np.argsort(-stamps, kind='mergesort')[:self.max_size])
+            hashes, valid, stamps = hashes[keep], valid[keep], stamps[keep]
+        self._save(fingerprint, hashes, valid, stamps)
+        self._evict_functions(fingerprint)
+
+    # helper functions
+
+    def _get_files(self):
+        return glob.glob(os.path.join(self.path, '*.npz'))
+
+    def _get_file(self, fingerprint):
+        return os.path.join(self.path, fingerprint + '.npz')
+
+    # the decisions of a function, sorted by hash
+    def _load(self, fingerprint):
+        file_name = self._get_file(fingerprint)
+        if not os.path.isfile(file_name):
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool), np.zeros(0, dtype=np.float64)
+        with np.load(file_name) as d:
+            return d['hashes'], d['valid'], d['stamps']
+
+    def _save(self, fingerprint, hashes, valid, stamps):
+        # #write to a temporary file first, so that an interrupted run does not leave a corrupt file
+        file_name = self._get_file(fingerprint)
+        tmp_name = file_name + '.tmp.npz'
+        np.savez(tmp_name, hashes=hashes, valid=valid, stamps=stamps)
+        os.rename(tmp_name, file_name)
+
+    # remove the least recently used files beyond max_functions (but not the current one)
+    def _evict_functions(self, fingerprint):
+        files = sorted(self._get_files(), key=os.path.getmtime, reverse=True)
+        current = self._get_file(fingerprint)
+        files = [current] + [f for f in files if f != current]
+        for file_name in files[max(1, self.max_functions):]:
+            os.remove(file_name)
+
+
+def get_function_fingerprint(function, *extra):
+    """
+    Fingerprint of a function: a hash of its code (bytecode, constants and names, including those of the
+    nested functions), default arguments and closure, and of the extra values given (e.g. the attributes it
+    reads). Callable objects are fingerprinted by their class and their __call__ method.
+    """
+    h = hashlib.sha1()
+    _update_function_hash(h, function)
+    h.update(repr(extra))
+    return h.hexdigest()
+
+
+def get_row_hashes(table, key, attrs):
+    """
+    64-bit hash of the key and the given attributes (or all of them) of each row of a table, as a numpy array.
+    """
+    if attrs is None:
+        attrs = list(table.columns)
+    elif not isinstance(attrs, list):
+        attrs = [attrs]
+    columns = [key] + [attr for attr in attrs if attr != key]
+    return pd.util.hash_pandas_object(table[columns], index=False).values
+
+
+def get_pair_hashes(l_hashes, r_hashes):
+    """
+    64-bit hash of each pair, combining the row hashes of its ltable and rtable sides (aligned arrays).
+    """
+    with np.errstate(over='ignore'):
+        return l_hashes * np.uint64(0x9E3779B97F4A7C15) ^ (r_hashes + np.uint64(0x632BE59BD9B4E019))
+
+
+def _update_function_hash(h, function):
+    if isinstance(function, types.MethodType):
+        function = function.im_func
+    if not isinstance(function, types.FunctionType):
+        h.update(type(function).__module__ + '.' + type(function).__name__)
+        function = type(function).__call__.im_func
+    _update_code_hash(h, function.func_code)
+    h.update(repr(function.func_defaults))
+    for cell in function.func_closure or []:
+        value = cell.cell_contents
+        if isinstance(value, (types.FunctionType, types.MethodType)):
+            _update_function_hash(h, value)
+        else:
+            h.update(repr(value))
+
+
+def _update_code_hash(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    h.update(repr(code.co_varnames))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code_hash(h, const)
+        else:
+            h.update(repr(const))
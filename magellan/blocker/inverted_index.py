@@ -0,0 +1,401 @@
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+import magellan.utils.helperfunctions as helper
+
+
+class InvertedIndex(object):
+    """
+    Compact inverted index over the token sets of the records in a table.
+
+    Tokens are mapped to integer ids, ordered by increasing document frequency (ties broken by the token),
+    so the rarest tokens have the smallest ids. Both directions of the index are stored as CSR pairs of
+    NumPy arrays:
+
+        postings of token id t:   row_ids[offsets[t]:offsets[t+1]]                        (sorted)
+        tokens of record r:       record_token_ids[record_offsets[r]:record_offsets[r+1]]  (sorted)
+
+    Records are identified by their position (0 .. num_rows-1) in the list of indexed records;
+    row_positions maps them back to the positions of the rows in the source table (rows with a missing
+    value are not indexed). settings holds the tokenizer settings the index was built with.
+
+    An index can be saved to a directory and reopened with its arrays memory-mapped, so that it is built
+    once and shared (through the page cache) by several blocking runs or worker processes.
+    """
+
+    _array_names = ['offsets', 'row_ids', 'record_offsets', 'record_token_ids', 'row_positions']
+
+    def __init__(self, tokens, offsets, row_ids, record_offsets, record_token_ids, row_positions=None,
+                 settings=None):
+        self.tokens = tokens
+        self.token_ids = dict(zip(tokens, range(len(tokens))))
+        self.offsets = offsets
+        self.row_ids = row_ids
+        self.record_offsets = record_offsets
+        self.record_token_ids = record_token_ids
+        if row_positions is None:
+            row_positions = np.arange(len(record_offsets) - 1, dtype=np.int64)
+        self.row_positions = row_positions
+        if settings is None:
+            settings = {}
+        self.settings = settings
+        self._prefix_postings = {}
+        # the number of postings read by the probes of this index so far
+        self.num_postings_read = 0
+
+    @property
+    def num_rows(self):
+        return len(self.record_offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return len(self.tokens)
+
+    @classmethod
+    def from_token_lists(cls, token_lists):
+        """
+        Build the index from a list of token lists, one per record.
+
+        Args:
+            token_lists (list): List of token lists (duplicate tokens within a record are ignored)
+
+        Returns:
+            Inverted index (InvertedIndex)
+        """
+        # encode the tokens with temporary ids (in the order they are seen)
+        vocab = {}
+        flat_ids = []
+        lens = []
+        for lst in token_lists:
+            ids = set(vocab.setdefault(t, len(vocab)) for t in lst)
+            flat_ids.extend(ids)
+            lens.append(len(ids))
+
+        tmp_ids = np.array(flat_ids, dtype=np.int64)
+        lens = np.array(lens, dtype=np.int64)
+        rows = np.repeat(np.arange(len(lens), dtype=np.int64), lens)
+
+        # re-number the tokens by increasing document frequency
+        tmp_tokens = [None] * len(vocab)
+        for t, i in vocab.iteritems():
+            tmp_tokens[i] = t
+        doc_freq = np.bincount(tmp_ids, minlength=len(vocab))
+        order = sorted(range(len(vocab)), key=lambda i: (doc_freq[i], tmp_tokens[i]))
+        remap = np.empty(len(vocab), dtype=np.int64)
+        remap[order] = np.arange(len(vocab), dtype=np.int64)
+        tok_ids = remap[tmp_ids]
+        tokens = [tmp_tokens[i] for i in order]
+
+        return cls.from_arrays(tokens, rows, tok_ids, len(lens))
+
+    @classmethod
+    def from_arrays(cls, tokens, rows, tok_ids, num_rows):
+        """
+        Build the index from aligned arrays of (record position, token id) entries.
+        """
+        id_dtype = get_int_dtype(max(num_rows, len(tokens)))
+
+        # forward index: tokens of each record, sorted
+        order = np.lexsort((tok_ids, rows))
+        record_token_ids = tok_ids[order].astype(id_dtype)
+        record_offsets = get_offsets(rows, num_rows)
+
+        # postings: records of each token, sorted
+        order = np.lexsort((rows, tok_ids))
+        row_ids = rows[order].astype(id_dtype)
+        offsets = get_offsets(tok_ids, len(tokens))
+
+        return cls(tokens, offsets, row_ids, record_offsets, record_token_ids)
+
+    def save(self, path):
+        """
+        Save the index to a directory: one .npy file per array and the tokens and settings in a pickle.
+
+        Args:
+            path (str): Directory path (created if it does not exist)
+
+        Returns:
+            status (bool). Returns True if the index was saved successfully
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self._array_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'index.pkl'), 'wb') as f:
+            pickle.dump({'tokens': self.tokens, 'settings': self.settings}, f, pickle.HIGHEST_PROTOCOL)
+        return True
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load an index saved with save.
+
+        Args:
+            path (str): Directory path the index was saved to
+            mmap_mode (str): Memory-map mode for the arrays (see numpy.load); 'r' (default) maps them
+                read-only, so processes loading the same index share its pages. None reads them into memory.
+
+        Returns:
+            Inverted index (InvertedIndex)
+        """
+        with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+            d = pickle.load(f)
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                      for name in cls._array_names)
+        return cls(d['tokens'], settings=d['settings'], **arrays)
+
+    def encode(self, token_lists):
+        """
+        Encode token lists (e.g. of the records of another table) with the token ids of this index.
+        Tokens that are not in the index are dropped, since they cannot contribute to an overlap.
+
+        Returns:
+            CSR pair (offsets, token_ids), with the token ids of each record sorted
+        """
+        token_ids = self.token_ids
+        flat_ids = []
+        lens = []
+        for lst in token_lists:
+            ids = sorted(set(token_ids[t] for t in lst if t in token_ids))
+            flat_ids.extend(ids)
+            lens.append(len(ids))
+        offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        return offsets, np.array(flat_ids, dtype=get_int_dtype(self.num_tokens))
+
+    def get_posting_lengths(self):
+        return np.diff(self.offsets)
+
+    def get_postings(self, token_ids):
+        """
+        Get the concatenated postings of the given token ids (vectorized lookup).
+        """
+        owners, row_ids = gather(self.offsets, self.row_ids, np.asarray(token_ids, dtype=np.int64))
+        return row_ids
+
+    def prune(self, max_posting_len=None, max_doc_freq_ratio=None):
+        """
+        Drop the frequent tokens: those with more than max_posting_len postings, or that occur in more than
+        max_doc_freq_ratio (a fraction) of the records. Such tokens cost the most to probe and add little
+        blocking power.
+
+        Returns:
+            The pruned index (InvertedIndex), which shares the settings and row positions of this index,
+            and the dropped tokens (OrderedDict mapping each token to its posting length, most frequent first)
+        """
+        lengths = self.get_posting_lengths()
+        keep = np.ones(self.num_tokens, dtype=bool)
+        if max_posting_len is not None:
+            keep &= lengths <= max_posting_len
+        if max_doc_freq_ratio is not None:
+            keep &= lengths <= max_doc_freq_ratio * self.num_rows
+
+        dropped_ids = np.flatnonzero(~keep)
+        dropped_ids = dropped_ids[np.argsort(-lengths[dropped_ids], kind='mergesort')]
+        dropped = OrderedDict((self.tokens[i], int(lengths[i])) for i in dropped_ids)
+        if len(dropped) == 0:
+            return self, dropped
+
+        new_ids = np.cumsum(keep) - 1
+        entry_tokens = np.repeat(np.arange(self.num_tokens, dtype=np.int64), lengths)
+        row_ids = self.row_ids[keep[entry_tokens]]
+        offsets = np.zeros(int(keep.sum()) + 1, dtype=np.int64)
+        np.cumsum(lengths[keep], out=offsets[1:])
+
+        in_record = keep[self.record_token_ids]
+        record_token_ids = new_ids[self.record_token_ids[in_record]].astype(self.record_token_ids.dtype)
+        rows = np.repeat(np.arange(self.num_rows, dtype=np.int64), np.diff(self.record_offsets))[in_record]
+        record_offsets = get_offsets(rows, self.num_rows)
+
+        tokens = [t for t, k in zip(self.tokens, keep) if k]
+        index = InvertedIndex(tokens, offsets, row_ids, record_offsets, record_token_ids,
+                              row_positions=self.row_positions, settings=self.settings)
+        return index, dropped
+
+    def get_prefix_postings(self, overlap_size):
+        """
+        Get the postings (as a CSR pair) restricted to the prefix of each record: the first
+        (len - overlap_size + 1) tokens in the frequency order. Two records sharing at least overlap_size
+        tokens must share a token that is in the prefix of both. The result is cached per overlap_size.
+        """
+        if overlap_size not in self._prefix_postings:
+            in_prefix = get_prefix_mask(self.record_offsets, overlap_size)
+            lens = np.diff(self.record_offsets)
+            rows = np.repeat(np.arange(self.num_rows, dtype=np.int64), lens)[in_prefix]
+            tok_ids = self.record_token_ids[in_prefix].astype(np.int64)
+            order = np.lexsort((rows, tok_ids))
+            self._prefix_postings[overlap_size] = (get_offsets(tok_ids, self.num_tokens),
+                                                   rows[order].astype(self.row_ids.dtype))
+        return self._prefix_postings[overlap_size]
+
+    def probe(self, offsets, token_ids, overlap_size, prefix_filter=False):
+        """
+        Probe the index with a batch of encoded records (a CSR pair as returned by encode).
+
+        Args:
+            offsets, token_ids (ndarray): Encoded probe records
+            overlap_size (int): Minimum number of shared tokens
+            prefix_filter (boolean): Probe only the prefixes and verify the candidates, instead of counting
+                over the full postings. The result is the same.
+
+        Returns:
+            Two integer arrays (index positions, probe positions) of the qualifying pairs, sorted by probe
+            position and then by index position
+        """
+        n_probe = len(offsets) - 1
+        if self.num_rows == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        if prefix_filter:
+            in_prefix = get_prefix_mask(offsets, overlap_size)
+            probe_rows = np.repeat(np.arange(n_probe, dtype=np.int64), np.diff(offsets))[in_prefix]
+            prefix_offsets, prefix_row_ids = self.get_prefix_postings(overlap_size)
+            owners, l_rows = gather(prefix_offsets, prefix_row_ids, token_ids[in_prefix].astype(np.int64))
+            self.num_postings_read += len(l_rows)
+            keys = np.unique(probe_rows[owners] * self.num_rows + l_rows)
+            r_pos, l_pos = np.divmod(keys, self.num_rows)
+            overlaps = get_pair_overlaps(self.record_offsets, self.record_token_ids, offsets, token_ids,
+                                         l_pos, r_pos, self.num_tokens)
+            keep = overlaps >= overlap_size
+        else:
+            probe_rows = np.repeat(np.arange(n_probe, dtype=np.int64), np.diff(offsets))
+            owners, l_rows = gather(self.offsets, self.row_ids, token_ids.astype(np.int64))
+            self.num_postings_read += len(l_rows)
+            keys, counts = np.unique(probe_rows[owners] * self.num_rows + l_rows, return_counts=True)
+            r_pos, l_pos = np.divmod(keys, self.num_rows)
+            keep = counts >= overlap_size
+        return l_pos[keep], r_pos[keep]
+
+
+    def probe_top_k(self, offsets, token_ids, k, overlap_size=1):
+        """
+        Probe the index with a batch of encoded records, keeping for each probe record only the k indexed
+        records with the highest overlap (at least overlap_size); ties are broken in favor of the record
+        with the smaller position.
+
+        The tokens of the probe records are scanned rarest first (shortest postings first), in rounds that
+        double the number of tokens scanned, and the exact overlaps of the new candidates are computed after
+        each round (as under prefix filtering). A record that was not seen in the first s tokens of a probe
+        record of n tokens shares at most n - s tokens with it, so the scan of a probe record stops once
+        n - s is below both overlap_size and the k-th best overlap of its candidates; the remaining
+        (longest) postings are not read.
+
+        Returns:
+            Two integer arrays (index positions, probe positions) of the qualifying pairs, sorted by probe
+            position and then by index position
+        """
+        n_probe = len(offsets) - 1
+        if self.num_rows == 0 or n_probe == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        lens = np.diff(offsets)
+        probe_rows = np.repeat(np.arange(n_probe, dtype=np.int64), lens)
+        token_pos = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], lens)
+
+        # #number of tokens scanned, and to scan, for each probe record (none if it has < overlap_size tokens)
+        scanned = np.zeros(n_probe, dtype=np.int64)
+        target = np.maximum(lens - overlap_size + 1, 0)
+        keys = np.array([], dtype=np.int64)
+        overlaps = np.array([], dtype=np.int64)
+        while True:
+            upto = np.minimum(target, np.maximum(2 * scanned, 1))
+            if not (upto > scanned).any():
+                break
+            in_round = (token_pos >= scanned[probe_rows]) & (token_pos < upto[probe_rows])
+            owners, l_rows = gather(self.offsets, self.row_ids, token_ids[in_round].astype(np.int64))
+            self.num_postings_read += len(l_rows)
+            new_keys = np.setdiff1d(np.unique(probe_rows[in_round][owners] * self.num_rows + l_rows), keys,
+                                    assume_unique=True)
+            r_pos, l_pos = np.divmod(new_keys, self.num_rows)
+            new_overlaps = get_pair_overlaps(self.record_offsets, self.record_token_ids, offsets, token_ids,
+                                             l_pos, r_pos, self.num_tokens)
+            keys = np.concatenate([keys, new_keys])
+            overlaps = np.concatenate([overlaps, new_overlaps])
+            scanned = upto
+
+            # #the k-th best overlap of the candidates of each probe record (0 if it has fewer than k)
+            r_pos = keys // self.num_rows
+            order = np.lexsort((-overlaps, r_pos))
+            rank = get_group_ranks(r_pos[order])
+            kth = np.zeros(n_probe, dtype=np.int64)
+            kth[r_pos[order][rank == k - 1]] = overlaps[order][rank == k - 1]
+            target = np.minimum(target, lens - np.maximum(kth, overlap_size) + 1)
+
+        # #keep the k best qualifying candidates of each probe record
+        keep = overlaps >= overlap_size
+        keys, overlaps = keys[keep], overlaps[keep]
+        r_pos, l_pos = np.divmod(keys, self.num_rows)
+        order = np.lexsort((l_pos, -overlaps, r_pos))
+        keys = np.sort(keys[order][get_group_ranks(r_pos[order]) < k])
+        r_pos, l_pos = np.divmod(keys, self.num_rows)
+        return l_pos, r_pos
+
+
+# smallest integer dtype for ids up to n
+def get_int_dtype(n):
+    if n < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+# CSR offsets for an array of group ids in [0, n)
+def get_offsets(group_ids, n):
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group_ids, minlength=n), out=offsets[1:])
+    return offsets
+
+
+# concatenate the CSR slices values[offsets[g]:offsets[g+1]] of the given groups; also return, for each
+# gathered value, the position (in groups) of the group it came from
+def gather(offsets, values, groups):
+    starts = offsets[groups]
+    lens = offsets[groups + 1] - starts
+    owners = np.repeat(np.arange(len(groups), dtype=np.int64), lens)
+    ends = np.cumsum(lens)
+    pos = np.arange(ends[-1] if len(ends) > 0 else 0, dtype=np.int64) - np.repeat(ends - lens - starts, lens)
+    return owners, values[pos]
+
+
+# rank of each item within its group, for an array of group ids in which the items of a group are contiguous
+def get_group_ranks(groups):
+    if len(groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+    lens = np.diff(np.append(starts, len(groups)))
+    return np.arange(len(groups), dtype=np.int64) - np.repeat(starts, lens)
+
+
+# mask over the entries of a CSR structure that selects the first (len - overlap_size + 1) entries of each
+# group; groups with fewer than overlap_size entries are dropped entirely (size filter)
+def get_prefix_mask(offsets, overlap_size):
+    lens = np.diff(offsets)
+    pos = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], lens)
+    return pos < np.repeat(lens - overlap_size + 1, lens)
+
+
+# split encoded probe records (a CSR pair) into contiguous (begin, end) batches such that the postings
+# scanned for each batch stay (roughly) within max_postings; a single record is never split.
+def get_probe_batches(offsets, token_ids, posting_lengths, max_postings=1000000):
+    volume = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    np.cumsum(posting_lengths[token_ids], out=volume[1:])
+    return helper.split_by_volume(np.diff(volume[offsets]), max_postings)
+
+
+def get_pair_overlaps(l_offsets, l_token_ids, r_offsets, r_token_ids, l_pos, r_pos, num_tokens,
+                      chunk_size=100000):
+    """
+    Compute the number of shared token ids for each pair (l_pos[i], r_pos[i]) of records given as CSR
+    pairs of sorted, unique token ids. The pairs are processed in chunks to bound the memory used.
+    """
+    l_pos = np.asarray(l_pos, dtype=np.int64)
+    r_pos = np.asarray(r_pos, dtype=np.int64)
+    overlaps = np.zeros(len(l_pos), dtype=np.int64)
+    width = np.int64(num_tokens + 1)
+    for begin in range(0, len(l_pos), chunk_size):
+        end = min(begin + chunk_size, len(l_pos))
+        l_owners, l_toks = gather(l_offsets, l_token_ids, l_pos[begin:end])
+        r_owners, r_toks = gather(r_offsets, r_token_ids, r_pos[begin:end])
+        common = np.intersect1d(l_owners * width + l_toks, r_owners * width + r_toks, assume_unique=True)
+        overlaps[begin:end] = np.bincount(common // width, minlength=end - begin)
+    return overlaps
@@ -1,146 +1,242 @@
 
 import pyximport; pyximport.install()
+import hashlib
 import logging
 import logging.config
 import math
-import re, string
+import numpy as np
 import pandas as pd
 import pyprind
 
 
 from  magellan.blocker.blocker import Blocker
-from magellan.external.py_stringmatching.tokenizers import qgram
+from magellan.blocker.inverted_index import InvertedIndex, get_pair_overlaps, get_probe_batches
+from magellan.external.py_stringmatching.tokenizers import _qgram
 import magellan.utils.helperfunctions as helper
 import magellan.core.catalog as cg
-from collections import Counter, OrderedDict
+from magellan.core.lazy_candset import LazyCandset
+from magellan.utils.normalizer import Normalizer
+from magellan.utils.stats import record_stats
+from magellan.utils.tokencache import get_token_cache
+from collections import OrderedDict
 
 logging.config.fileConfig(helper.get_install_path()+'/configs/logging.ini')
 logger = logging.getLogger(__name__)
 
 
 class OverlapBlocker(Blocker):
-    def __init__(self):
+    """
+    Blocks the pairs whose overlap attributes share at least overlap_size tokens.
+
+    The overlap attributes can also be lists of attributes (of the same length), to block on all of them in a
+    single pass: the tokens are tagged with the position of their attribute, so a token counts towards the
+    overlap only when it occurs in the same attribute on both sides, and q_val can then be a list holding
+    the q-gram length (or None for words) of each attribute.
+
+    Args:
+        normalizer (Normalizer): Normalizes the attribute values before they are tokenized (defaults to
+            Normalizer(), which drops non-ascii characters and punctuation and converts to lower case). The
+            stop words of the normalizer are always removed; the blocker's stop_words are removed when
+            rem_stop_words is set.
+    """
+    def __init__(self, normalizer=None):
         self.stop_words = ['a', 'an', 'and', 'are', 'as', 'at',
                            'be', 'by', 'for', 'from',
                            'has', 'he', 'in', 'is', 'it',
                            'its', 'on', 'that', 'the', 'to',
                            'was', 'were', 'will', 'with']
-        self.regex_punctuation = re.compile('[%s]' %re.escape(string.punctuation))
+        self.normalizer = normalizer if normalizer is not None else Normalizer()
+        self.pruned_tokens = OrderedDict()
         super(OverlapBlocker, self).__init__()
 
+    @record_stats
     def block_tables(self, ltable, rtable, l_overlap_attr, r_overlap_attr,
                      rem_stop_words=False, q_val=None, word_level=True, overlap_size=1,
                      l_output_attrs=None, r_output_attrs=None,
                      l_output_prefix='ltable_', r_output_prefix='rtable_',
-                     verbose=True, show_progress=True):
+                     prefix_filter=False, top_k=None, n_jobs=1, l_index=None, max_posting_len=None,
+                     max_doc_freq_ratio=None, sink=None, chunk_size=100000, verbose=True, show_progress=True):
+
+        stats = self.stats
 
         # validations
-        self.validate_overlap_attrs(ltable, rtable, l_overlap_attr, r_overlap_attr)
-        self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
+        with stats.stage('validate'):
+            self.validate_overlap_attrs(ltable, rtable, l_overlap_attr, r_overlap_attr)
+            self.validate_output_attrs(ltable, rtable, l_output_attrs, r_output_attrs)
+            self.validate_tokenizer_settings(q_val, word_level)
+            if prefix_filter == True and top_k is not None:
+                raise SyntaxError('Parameters prefix_filter and top_k cannot be set together')
+            assert top_k is None or top_k >= 1, 'top_k must be at least 1'
 
-        # required metadata; keys from ltable and rtable
-        helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
+            # required metadata; keys from ltable and rtable
+            helper.log_info(logger, 'Required metadata: ltable key, rtable key', verbose)
 
-        # get metadata
-        l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
+            # get metadata
+            l_key, r_key = cg.get_keys_for_ltable_rtable(ltable, rtable, logger, verbose)
 
         # do blocking
 
-        if word_level == True and q_val != None:
-            raise SyntaxError('Parameters word_level and q_val cannot be set together; Note that word_level is '
-                              'set to True by default, so explicity set word_level=false to use qgram with the '
-                              'specified q_val')
-
-        # #rem nans
-        l_df = self.rem_nan(ltable, l_overlap_attr)
-        r_df = self.rem_nan(rtable, r_overlap_attr)
-
-        # #reset indexes in the dataframe
-        l_df.reset_index(inplace=True, drop=True)
-        r_df.reset_index(inplace=True, drop=True)
+        # #tokenize the ltable and build the index over it, unless a prebuilt index is given
+        if l_index is None:
+            l_index = self.build_index(ltable, l_overlap_attr, rem_stop_words=rem_stop_words, q_val=q_val,
+                                       word_level=word_level, n_jobs=n_jobs, verbose=False)
+        else:
+            with stats.stage('validate'):
+                self.validate_index(l_index, ltable, l_key, l_overlap_attr, rem_stop_words, q_val, word_level)
+
+        with stats.stage('index'):
+            # #ignore the frequent tokens (if asked to)
+            if max_posting_len is not None or max_doc_freq_ratio is not None:
+                l_index = self.prune_index(l_index, max_posting_len, max_doc_freq_ratio, verbose)
+
+            if prefix_filter:
+                # compute the prefix postings before any worker is forked, so that they are shared as well
+                l_index.get_prefix_postings(overlap_size)
+
+        # #probe the index with the rtable; the result is the positions of surviving pairs in the tables
+        n_procs = helper.get_num_procs(n_jobs, len(rtable))
+        with stats.stage('tokenize'):
+            r_positions, r_colvalues_chopped = self.tokenize_table(rtable, r_overlap_attr, q_val, rem_stop_words,
+                                                                   n_procs, 'Right')
+        if n_procs > 1:
+            pair_chunks = self.iter_probe_table_in_parallel(r_colvalues_chopped, l_index, overlap_size,
+                                                            prefix_filter, top_k, n_procs, show_progress)
+        else:
+            pair_chunks = self.iter_probe_index(r_colvalues_chopped, l_index, overlap_size, prefix_filter, top_k,
+                                                show_progress)
+        pair_chunks = ((l_index.row_positions[l_pos], r_positions[r_pos])
+                       for l_pos, r_pos in stats.iter_stage('probe', pair_chunks))
 
-        # #create a dummy column with all values set to 1.
-        l_df['_dummy_'] = 1 # need to fix this - should be a name that does not occur in the col. names
-        r_df['_dummy_'] = 1
+        # Construct the output table (or stream it to the sink) and update the catalog
+        candset = self.assemble_candset(pair_chunks, ltable, rtable, l_key, r_key, l_output_attrs, r_output_attrs,
+                                        l_output_prefix, r_output_prefix, sink=sink, chunk_size=chunk_size)
 
-        # #case the column to string if required.
-        if l_df.dtypes[l_overlap_attr] != object:
-            logger.warning('Left overlap attribute is not of type string; coverting to string temporarily')
-            l_df[l_overlap_attr] = l_df[l_overlap_attr].astype(str)
+        # return the candidate set
+        return candset
 
-        if r_df.dtypes[r_overlap_attr] != object:
-            logger.warning('Right overlap attribute is not of type string; coverting to string temporarily')
-            r_df[r_overlap_attr] = r_df[r_overlap_attr].astype(str)
+    @record_stats
+    def block_candset(self, candset, l_overlap_attr, r_overlap_attr, rem_stop_words=False, q_val=None,
+                      word_level=True, overlap_size=1, verbose=True, show_progress=True):
+        stats = self.stats
+        stats.add('pairs_in', len(candset))
 
-        l_dict = {}
-        r_dict = {}
+        with stats.stage('validate'):
+            # required metadata: key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key
+            helper.log_info(logger, 'Required metadata: cand.set key, fk ltable, fk rtable, '
+                                    'ltable, rtable, ltable key, rtable key', verbose)
+            # get metadata
+            key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key = cg.get_metadata_for_candset(candset, logger,
+                                                                                                verbose)
 
-        # #create a lookup table for quick access
-        for k, r in l_df.iterrows():
-            l_dict[k] = r
+            # validate metadata
+            cg.validate_metadata_for_candset(candset, key, fk_ltable, fk_rtable, ltable, rtable, l_key, r_key,
+                                             logger, verbose)
 
-        for k, r in r_df.iterrows():
-            r_dict[k] = r
+            # validate overlap attrs and tokenizer settings
+            self.validate_overlap_attrs(ltable, rtable, l_overlap_attr, r_overlap_attr)
+            self.validate_tokenizer_settings(q_val, word_level)
 
-        l_colvalues_chopped = self.process_table(l_df, l_overlap_attr, q_val, rem_stop_words)
-        zipped_l_colvalues = zip(l_colvalues_chopped, range(0, len(l_colvalues_chopped)))
-        appended_l_colidx_values = [self. append_index_values(val[0], val[1]) for val in zipped_l_colvalues]
+        # do blocking
 
-        inv_idx = {}
-        sink = [self.compute_inv_index(t, inv_idx) for c in appended_l_colidx_values for t in c]
+        # #map the foreign keys to row positions, and tokenize each distinct record just once
+        with stats.stage('tokenize'):
+            l_rows, r_rows = self.get_candset_positions(candset, fk_ltable, fk_rtable, ltable, rtable, l_key,
+                                                        r_key)
+            l_uniq, l_inv = np.unique(l_rows, return_inverse=True)
+            r_uniq, r_inv = np.unique(r_rows, return_inverse=True)
 
+            l_colvalues_chopped = self.process_rows(ltable, l_overlap_attr, l_uniq, q_val, rem_stop_words, 'Left')
+            r_colvalues_chopped = self.process_rows(rtable, r_overlap_attr, r_uniq, q_val, rem_stop_words,
+                                                    'Right')
 
-        r_colvalues_chopped = self.process_table(r_df, r_overlap_attr, q_val, rem_stop_words)
-        r_idx = 0
+        # #encode the tokens as integer ids and intersect the token id sets of all pairs in bulk
+        with stats.stage('index'):
+            index = InvertedIndex.from_token_lists(l_colvalues_chopped)
+            r_offsets, r_token_ids = index.encode(r_colvalues_chopped)
 
-        white_list = []
+        chunks = helper.split_into_chunks(len(candset), int(math.ceil(len(candset) / 100000.0)))
         if show_progress:
-            bar = pyprind.ProgBar(len(r_colvalues_chopped))
-
-        df_list = []
-        for col_values in r_colvalues_chopped:
-            if show_progress:
-                bar.update()
-
-            qualifying_ltable_indices = self.get_potential_match_indices(col_values, inv_idx, overlap_size)
-            r_row = r_dict[r_idx]
-            r_row_dict = r_row.to_frame().T
-
-            l_rows_dict = l_df.iloc[qualifying_ltable_indices]
-            df = l_rows_dict.merge(r_row_dict, on='_dummy_', suffixes=('_ltable', '_rtable'))
-
-            if len(df) > 0:
-                df_list.append(df)
-
-        # Construct the output table
-        candset = pd.concat(df_list)
-        l_output_attrs = self.process_output_attrs(ltable, l_key, l_output_attrs, 'left')
-        r_output_attrs = self.process_output_attrs(rtable, r_key, r_output_attrs, 'right')
-
-        retain_cols = self.get_attrs_to_retain(l_key, r_key, l_output_attrs, r_output_attrs,
-                                               l_output_prefix, r_output_prefix)
-
-        if len(candset) > 0:
-            candset = candset[retain_cols]
-        else:
-            candset = pd.DataFrame(columns=retain_cols)
-
-        # Update metadata in the catalog
-        key = helper.get_name_for_key(candset.columns)
-        candset = helper.add_key_column(candset, key)
-        cg.set_candset_properties(candset, key, l_output_prefix+l_key, r_output_prefix+r_key, ltable, rtable)
-
-        # return the candidate set
-        return candset
-
-
-
+            bar = pyprind.ProgBar(len(chunks))
+
+        overlaps = np.zeros(len(candset), dtype=np.int64)
+        with stats.stage('overlap'):
+            for begin, end in chunks:
+                if show_progress:
+                    bar.update()
+                overlaps[begin:end] = get_pair_overlaps(index.record_offsets, index.record_token_ids,
+                                                        r_offsets, r_token_ids, l_inv[begin:end],
+                                                        r_inv[begin:end], index.num_tokens)
+        valid = overlaps >= overlap_size
+
+        # construct output table
+        with stats.stage('assemble'):
+            if len(candset) > 0 or isinstance(candset, LazyCandset):
+                out_table = candset[valid]
+            else:
+                out_table = pd.DataFrame(columns=candset.columns)
+
+            # update the catalog
+            cg.set_candset_properties(out_table, key, fk_ltable, fk_rtable, ltable, rtable)
+        stats.add('pairs_emitted', len(out_table))
+
+        # return the output table
+        return out_table
+
+    @record_stats
+    def build_index(self, ltable, l_overlap_attr, rem_stop_words=False, q_val=None, word_level=True,
+                    n_jobs=1, verbose=True):
+        """
+        Tokenize the overlap attribute of the left table and build an inverted index over it.
+
+        The index records the tokenizer settings and a fingerprint of the key and overlap attribute values of
+        the table, so it can be saved (InvertedIndex.save), reopened memory-mapped (InvertedIndex.load) and
+        passed to block_tables (l_index) to block the same left table against several right tables without
+        re-tokenizing and re-indexing it. The left table must then have the same rows, in the same order.
+
+        Args:
+            ltable (pandas dataframe): Left table
+            l_overlap_attr (str or list): Overlap attribute(s) of the left table
+            rem_stop_words, q_val, word_level: Tokenizer settings, as in block_tables
+            n_jobs (int): Number of processes used to tokenize the table (-1 means all cpus)
+            verbose (boolean): Flag to indicate whether logging should be done
+
+        Returns:
+            Inverted index (InvertedIndex)
+        """
+        stats = self.stats
+        with stats.stage('validate'):
+            self.validate_overlap_attrs(ltable, ltable, l_overlap_attr, l_overlap_attr)
+            self.validate_tokenizer_settings(q_val, word_level)
+
+            helper.log_info(logger, 'Required metadata: ltable key', verbose)
+            l_key = cg.get_key(ltable)
+
+        helper.log_info(logger, 'Building the inverted index', verbose)
+        n_procs = helper.get_num_procs(n_jobs, len(ltable))
+        with stats.stage('tokenize'):
+            l_positions, l_colvalues_chopped = self.tokenize_table(ltable, l_overlap_attr, q_val, rem_stop_words,
+                                                                   n_procs, 'Left')
+
+        with stats.stage('index'):
+            index = InvertedIndex.from_token_lists(l_colvalues_chopped)
+        index.row_positions = l_positions
+        index.settings = {'key': l_key, 'overlap_attr': l_overlap_attr, 'num_table_rows': len(ltable),
+                          'q_val': q_val, 'word_level': word_level, 'rem_stop_words': rem_stop_words,
+                          'normalizer': self.normalizer.get_settings(),
+                          'fingerprint': self.get_table_fingerprint(ltable, l_key, l_overlap_attr)}
+        helper.log_info(logger, '..... Done', verbose)
+        return index
 
 
 
     # helper functions
     # validate the blocking attrs
     def validate_overlap_attrs(self, ltable, rtable, l_overlap_attr, r_overlap_attr):
+        if isinstance(l_overlap_attr, list) or isinstance(r_overlap_attr, list):
+            assert isinstance(l_overlap_attr, list) and isinstance(r_overlap_attr, list) and \
+                   len(l_overlap_attr) == len(r_overlap_attr) and len(l_overlap_attr) > 0, \
+                'Left and right overlap attributes must be lists of the same length'
+
         if not isinstance(l_overlap_attr, list):
             l_overlap_attr = [l_overlap_attr]
         assert set(l_overlap_attr).issubset(ltable.columns) is True, 'Left block attribute is not in the left table'
@@ -149,7 +245,40 @@ class OverlapBlocker(Blocker):
             r_overlap_attr = [r_overlap_attr]
         assert set(r_overlap_attr).issubset(rtable.columns) is True, 'Right block attribute is not in the right table'
 
+    def validate_tokenizer_settings(self, q_val, word_level):
+        if isinstance(q_val, list):
+            q_val = [q for q in q_val if q is not None] or None
+        if word_level == True and q_val != None:
+            raise SyntaxError('Parameters word_level and q_val cannot be set together; Note that word_level is '
+                              'set to True by default, so explicity set word_level=false to use qgram with the '
+                              'specified q_val')
 
+    # validate that a prebuilt index was built over the given table with the same tokenizer settings
+    def validate_index(self, index, ltable, l_key, l_overlap_attr, rem_stop_words, q_val, word_level):
+        settings = index.settings
+        assert settings.get('num_table_rows') == len(ltable) and settings.get('key') == l_key, \
+            'The index was not built over the left table'
+        assert settings.get('fingerprint') == self.get_table_fingerprint(ltable, l_key, l_overlap_attr), \
+            'The index was built over different key or overlap attribute values (e.g. the rows of the left ' \
+            'table were reordered or modified)'
+        assert settings.get('overlap_attr') == l_overlap_attr, \
+            'The index was built over a different overlap attribute (' + str(settings.get('overlap_attr')) + ')'
+        for name, value in [('q_val', q_val), ('word_level', word_level), ('rem_stop_words', rem_stop_words)]:
+            assert settings.get(name) == value, 'The index was built with ' + name + '=' + \
+                                                str(settings.get(name)) + ', but ' + name + '=' + str(value) + \
+                                                ' is given'
+        assert settings.get('normalizer') == self.normalizer.get_settings(), 'The index was built with a ' \
+                                                                            'different normalizer'
+
+
+
+    # fingerprint of the key and overlap attribute values of a table, in row order, so that an index is only
+    # used with the table it was built over (its row positions map the pairs to the rows)
+    def get_table_fingerprint(self, table, key, overlap_attr):
+        attrs = overlap_attr if isinstance(overlap_attr, list) else [overlap_attr]
+        columns = [key] + [attr for attr in attrs if attr != key]
+        hashes = pd.util.hash_pandas_object(table[columns], index=False).values
+        return hashlib.sha1(hashes.tobytes()).hexdigest()
 
     def get_token_overlap_bt_two_tuples(self, l_tuple, r_tuple, l_overlap_attr, r_overlap_attr,
                                         q_val, rem_stop_words):
@@ -173,14 +302,12 @@ class OverlapBlocker(Blocker):
 
 
     def process_val(self, val, overlap_attr, q_val, rem_stop_words):
-        val = helper.remove_non_ascii(val)
-        val = self.rem_punctuations(val).lower()
-        chopped_vals = val.split()
+        chopped_vals = self.normalizer.get_tokens(val)
         if rem_stop_words == True:
             chopped_vals = self.rem_stopwords(chopped_vals)
         if q_val != None:
             values = ' '.join(chopped_vals)
-            chopped_vals = qgram(values, q_val)
+            chopped_vals = _qgram(values, q_val)
         return list(set(chopped_vals))
 
     def get_row_dict_with_output_attrs(self, l_tuple, r_tuple, l_key, r_key,
@@ -207,16 +334,97 @@ class OverlapBlocker(Blocker):
         return d
 
 
+    # get the positions of the rows with a value for the overlap attribute, and those values as strings
+    def get_values_to_tokenize(self, table, overlap_attr, error_str):
+        col = table[overlap_attr]
+        positions = self.get_not_null_positions(table, overlap_attr)
+        col = col.iloc[positions]
+        if col.dtype != object:
+            logger.warning(error_str + ' overlap attribute is not of type string; coverting to string temporarily')
+            col = col.astype(str)
+        return positions, col
+
+    # tokenize the overlap attribute of a table and return the positions of the rows with a value, along with
+    # their token lists. the result is kept in the shared token cache (see mg.get_token_cache), keyed by the
+    # table, the attribute and the tokenizer settings, so repeated blocking calls do not tokenize again.
+    def tokenize_table(self, table, overlap_attr, q_val, rem_stop_words, n_procs, error_str):
+        if isinstance(overlap_attr, list):
+            results = [self.tokenize_table(table, attr, q, rem_stop_words, n_procs, error_str)
+                       for attr, q in self.get_attr_settings(overlap_attr, q_val)]
+            return self.merge_attr_tokens(len(table), results)
+
+        def tokenize(table, overlap_attr):
+            positions, values = self.get_values_to_tokenize(table, overlap_attr, error_str)
+            self.stats.add('rows_tokenized', len(positions))
+            if n_procs > 1:
+                return positions, self.process_column_in_parallel(values, q_val, rem_stop_words, n_procs)
+            return positions, self.process_column(values, q_val, rem_stop_words)
+
+        return get_token_cache().get_column_tokens(table, overlap_attr,
+                                                   self.get_tokenizer_settings(q_val, rem_stop_words), tokenize)
+
+    # hashable description of everything the tokens depend on
+    def get_tokenizer_settings(self, q_val, rem_stop_words):
+        stop_words = tuple(self.stop_words) if rem_stop_words else None
+        return ('OverlapBlocker', self.normalizer.get_settings(), q_val, rem_stop_words, stop_words)
+
+    # pair each overlap attribute with its q_val
+    def get_attr_settings(self, overlap_attrs, q_val):
+        if not isinstance(q_val, list):
+            q_val = [q_val] * len(overlap_attrs)
+        assert len(q_val) == len(overlap_attrs), 'q_val must have one entry per overlap attribute'
+        return zip(overlap_attrs, q_val)
+
+    # merge the (positions, token lists) of several attributes of a table into one token list per row with
+    # a value in any of them; the tokens are tagged with the position of their attribute ('0:...', '1:...')
+    def merge_attr_tokens(self, num_rows, results):
+        row_tokens = [[] for i in range(num_rows)]
+        has_value = np.zeros(num_rows, dtype=bool)
+        for i, (positions, colvalues_chopped) in enumerate(results):
+            tag = str(i) + ':'
+            for pos, tokens in zip(positions, colvalues_chopped):
+                row_tokens[pos].extend([tag + t for t in tokens])
+            has_value[positions] = True
+        positions = np.flatnonzero(has_value)
+        return positions, [row_tokens[pos] for pos in positions]
+
+    # tokenize the overlap attribute of the rows at the given positions; rows with a missing value get no tokens
+    def process_rows(self, table, overlap_attr, positions, q_val, rem_stop_words, error_str):
+        if isinstance(overlap_attr, list):
+            results = [(np.arange(len(positions)),
+                        self.process_rows(table, attr, positions, q, rem_stop_words, error_str))
+                       for attr, q in self.get_attr_settings(overlap_attr, q_val)]
+            return self.merge_attr_tokens(len(positions), results)[1]
+
+        if get_token_cache().is_enabled():
+            # tokenize (or fetch) the whole column once, and pick the rows from it
+            not_null_pos, col_tokens = self.tokenize_table(table, overlap_attr, q_val, rem_stop_words, 1,
+                                                           error_str)
+            lookup = np.full(len(table), -1, dtype=np.int64)
+            lookup[not_null_pos] = np.arange(len(not_null_pos))
+            return [col_tokens[i] if i >= 0 else [] for i in lookup[positions]]
+
+        not_null_pos, values = self.get_values_to_tokenize(table[overlap_attr].iloc[positions].to_frame(),
+                                                           overlap_attr, error_str)
+        self.stats.add('rows_tokenized', len(not_null_pos))
+        colvalues_chopped = [[] for i in range(len(positions))]
+        for i, tokens in zip(not_null_pos, self.process_column(values, q_val, rem_stop_words)):
+            colvalues_chopped[i] = tokens
+        return colvalues_chopped
+
     def process_table(self, table, overlap_attr, q_val, rem_stop_words):
+        return self.process_column(table[overlap_attr], q_val, rem_stop_words)
 
-        # get overlap_attr column
-        attr_col_values = table[overlap_attr]
+    # tokenize a column; each distinct value is tokenized once, and its rows share the (read-only) token list
+    def process_column(self, attr_col_values, q_val, rem_stop_words):
+        codes, uniques = pd.factorize(np.asarray(attr_col_values, dtype=object))
+        uniq_values_chopped = self.process_values(uniques, q_val, rem_stop_words)
+        return [uniq_values_chopped[c] for c in codes]
 
-        # remove non-ascii chars
-        attr_col_values = [helper.remove_non_ascii(val) for val in attr_col_values]
+    def process_values(self, attr_col_values, q_val, rem_stop_words):
 
-        # remove special characters
-        attr_col_values = [self.rem_punctuations(val).lower() for val in attr_col_values]
+        # normalize the values (non-ascii chars, case and special characters)
+        attr_col_values = self.normalizer.normalize_column(attr_col_values)
 
         # chop the attribute values
         col_values_chopped = [val.split() for val in attr_col_values]
@@ -225,60 +433,127 @@ class OverlapBlocker(Blocker):
         col_values_chopped = [list(set(val)) for val in col_values_chopped]
 
         # remove stop words
+        col_values_chopped = self.normalizer.rem_stop_words_column(col_values_chopped)
         if rem_stop_words == True:
-            col_values_chopped = [self.rem_stopwords(val) for val in col_values_chopped]
+            stop_words = set(self.stop_words)
+            col_values_chopped = [[t for t in val if t not in stop_words] for val in col_values_chopped]
 
         if q_val is not None:
             values = [' '.join(val) for val in col_values_chopped]
-            col_values_chopped = [qgram(val, q_val) for val in values]
+            col_values_chopped = [list(set(_qgram(val, q_val))) for val in values]
 
         return col_values_chopped
 
 
 
-    def rem_punctuations(self, s):
-        return self.regex_punctuation.sub('',s)
-
     def rem_stopwords(self, lst):
         return [t for t in lst if t not in self.stop_words]
 
 
-    def append_index_values(self, lst, idx):
-        lst = set(lst)
-        return [(val, idx) for val in lst]
-
-    def compute_inv_index(self, tok_idx, idx):
-        lst = idx.pop(tok_idx[0], None)
-
-        if lst is None:
-            lst = list()
-            lst.append(tok_idx[1])
-            idx[tok_idx[0]] = lst
-        else:
-            lst.append(tok_idx[1])
-            idx[tok_idx[0]] = lst
-
-    def probe_inv_index_for_a_token(self, token, inv_index):
-        return inv_index.get(token, None)
-
-    def probe_inv_index(self, lst, inv_index):
-        return [self.probe_inv_index_for_a_token(tok, inv_index) for tok in lst]
-
-    def get_freq_count(self, lst):
-        p = list()
-        dummy = [p.extend(k) for k in lst if k is not None]
-        d = dict(Counter(p))
-        return d
+    # drop the tokens whose posting lists are longer than max_posting_len or cover more than
+    # max_doc_freq_ratio of the ltable; the dropped tokens are kept in self.pruned_tokens (token -> posting
+    # length) and the pairs sharing only such tokens are not reported.
+    def prune_index(self, index, max_posting_len, max_doc_freq_ratio, verbose):
+        index, self.pruned_tokens = index.prune(max_posting_len=max_posting_len,
+                                                max_doc_freq_ratio=max_doc_freq_ratio)
+        num_postings = sum(self.pruned_tokens.values())
+        helper.log_info(logger, 'Pruned ' + str(len(self.pruned_tokens)) + ' frequent tokens, saving ' +
+                        str(num_postings) + ' postings: ' + ', '.join(self.pruned_tokens.keys()[:20]) +
+                        (', ...' if len(self.pruned_tokens) > 20 else ''), verbose)
+        return index
+
+    # probe the index with the rtable records and generate, for each batch of records, two flat integer
+    # arrays holding the positions of (ltable, rtable) pairs that share at least overlap_size tokens. the
+    # records are probed in batches whose total posting volume is bounded, so that each batch is a handful
+    # of vectorized operations. with top_k, only the top_k ltable records with the highest overlap (and at
+    # least overlap_size) are kept for each rtable record.
+    def iter_probe_index(self, r_colvalues_chopped, index, overlap_size, prefix_filter, top_k, show_progress):
+        offsets, token_ids = index.encode(r_colvalues_chopped)
+        posting_lengths = index.get_posting_lengths()
+        batches = get_probe_batches(offsets, token_ids, posting_lengths)
+        if show_progress:
+            bar = pyprind.ProgBar(len(batches))
 
-    def get_qualifying_indices(self, freq_dict, overlap_size):
-        q_indices = []
-        for k, v in freq_dict.iteritems():
-            if v >= overlap_size:
-                q_indices.append(k)
-        return q_indices
-
-    def get_potential_match_indices(self, lst, inv_index, overlap_size):
-        indices = self.probe_inv_index(lst, inv_index)
-        freq_dict = self.get_freq_count(indices)
-        qualifying_indices = self.get_qualifying_indices(freq_dict, overlap_size)
-        return qualifying_indices
\ No newline at end of file
+        for begin, end in batches:
+            if show_progress:
+                bar.update()
+            batch_offsets = offsets[begin:end+1] - offsets[begin]
+            batch_token_ids = token_ids[offsets[begin]:offsets[end]]
+            num_postings = index.num_postings_read
+            if top_k is None:
+                l_pos, r_pos = index.probe(batch_offsets, batch_token_ids, overlap_size, prefix_filter)
+            else:
+                l_pos, r_pos = index.probe_top_k(batch_offsets, batch_token_ids, top_k, overlap_size)
+            # #the postings actually read: the prefix postings only, or those before the early stop of top_k
+            self.stats.add('postings_scanned', index.num_postings_read - num_postings)
+            yield l_pos, r_pos + begin
+
+    def probe_index(self, r_colvalues_chopped, index, overlap_size, prefix_filter, top_k, show_progress):
+        l_pos = []
+        r_pos = []
+        for l, r in self.iter_probe_index(r_colvalues_chopped, index, overlap_size, prefix_filter, top_k,
+                                          show_progress):
+            l_pos.append(l)
+            r_pos.append(r)
+
+        if len(l_pos) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(l_pos), np.concatenate(r_pos)
+
+    # multi-core blocking: the tables are split into contiguous shards that are processed by a pool of
+    # worker processes. the index over the ltable is given to the pool initializer (see
+    # helper.get_worker_pool), so the (forked) workers share its pages read-only instead of receiving a
+    # pickled copy, and overlapping calls each keep their own state.
+    def process_column_in_parallel(self, values, q_val, rem_stop_words, n_procs):
+        # the distinct values are found up front, so that each of them is tokenized by one worker only
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        state = dict(blocker=self, values=uniques, q_val=q_val, rem_stop_words=rem_stop_words)
+        pool = helper.get_worker_pool(n_procs, state)
+        try:
+            shards = helper.split_into_chunks(len(uniques), n_procs)
+            results = pool.map(helper.call_with_worker_state, [(_tokenize_shard, shard) for shard in shards])
+        finally:
+            pool.close()
+            pool.join()
+
+        uniq_values_chopped = [val for res in results for val in res]
+        return [uniq_values_chopped[c] for c in codes]
+
+    def iter_probe_table_in_parallel(self, r_colvalues_chopped, index, overlap_size, prefix_filter, top_k,
+                                     n_procs, show_progress):
+        state = dict(blocker=self, colvalues_chopped=r_colvalues_chopped, index=index,
+                     overlap_size=overlap_size, prefix_filter=prefix_filter, top_k=top_k)
+        # use more shards than processes so that skewed shards do not leave cores idle
+        shards = helper.split_into_chunks(len(r_colvalues_chopped), 4 * n_procs)
+        if show_progress:
+            bar = pyprind.ProgBar(len(shards))
+
+        pool = helper.get_worker_pool(n_procs, state)
+        try:
+            # the shard results come back in order, so the pairs are generated in the serial order
+            for l_pos, r_pos, num_postings in pool.imap(helper.call_with_worker_state,
+                                                        [(_probe_shard, shard) for shard in shards]):
+                if show_progress:
+                    bar.update()
+                self.stats.add('postings_scanned', num_postings)
+                yield l_pos, r_pos
+        finally:
+            pool.close()
+            pool.join()
+
+
+# the functions run by the worker processes of OverlapBlocker, called with the state of the call (s) and a
+# shard
+def _tokenize_shard(s, shard):
+    begin, end = shard
+    return s['blocker'].process_values(s['values'][begin:end], s['q_val'], s['rem_stop_words'])
+
+
+def _probe_shard(s, shard):
+    begin, end = shard
+    # the counters of the worker's (forked) copy of the stats are sent back with the pairs
+    stats = s['blocker'].stats
+    num_postings = stats.counters.get('postings_scanned', 0)
+    l_pos, r_pos = s['blocker'].probe_index(s['colvalues_chopped'][begin:end], s['index'], s['overlap_size'],
+                                            s['prefix_filter'], s['top_k'], False)
+    return l_pos, r_pos + begin, stats.counters.get('postings_scanned', 0) - num_postings
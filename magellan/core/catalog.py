@@ -606,7 +606,9 @@ def check_fk_constraint(df_foreign, attr_foreign, df_base, attr_base):
         return False
     if helper.check_attrs_present(df_base, attr_base) is False:
         return False
-    t = df_base[df_base[attr_base].isin(pd.unique(df_foreign[attr_foreign]))]
+    # only the key column of the referenced rows is copied
+    col = df_base[attr_base]
+    t = col[col.isin(pd.unique(df_foreign[attr_foreign])).values].to_frame()
     return is_key_attribute(t, attr_base)
 
 
@@ -664,7 +666,7 @@ def does_contain_missing_vals(df, attr):
         This is an internal helper function
 
     """
-    nan_flag = sum(df[attr].isnull()) == 0
+    nan_flag = not df[attr].isnull().values.any()
     if not nan_flag:
         return False
     else:
@@ -694,7 +696,7 @@ def is_key_attribute(df, attr, verbose=False):
             return False
 
         # check if there are missing or null values
-        nan_flag = sum(df[attr].isnull()) == 0
+        nan_flag = not df[attr].isnull().values.any()
         if not nan_flag:
             if verbose:
                 logger.warning('Attribute ' + attr + ' contains missing values')
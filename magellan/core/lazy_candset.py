@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import magellan.core.catalog as cg
+
+
+class LazyCandset(object):
+    """
+    Candidate set that stores the positions of its pairs in the ltable and rtable (two integer arrays, int32
+    when the tables are small enough) instead of the values of its columns. The columns (the key, the
+    foreign keys and the output attributes) are gathered from the tables when they are read, so a large
+    candset does not hold a copy of the output attributes of each of its pairs.
+
+    A lazy candset is produced by a blocker given a LazySink, and is registered in the catalog like any
+    candset. It can be read like a dataframe (candset['ltable_name'], len(candset), candset.columns), filtered
+    with a boolean mask, passed to the blockers' block_candset (the output is then a lazy candset as well),
+    materialized in chunks (iter_chunks) or converted to a dataframe (to_dataframe).
+
+    Examples:
+        >>> C = ob.block_tables(A, B, 'address', 'address', l_output_attrs=['name'], sink=mg.LazySink())
+        >>> D = mg.AttrEquivalenceBlocker().block_candset(C, 'zipcode', 'zipcode')
+        >>> for chunk in D.iter_chunks(100000):
+        ...     process(chunk)
+        >>> D.to_dataframe()
+    """
+
+    def __init__(self, ltable, rtable, l_pos, r_pos, key, fk_ltable, fk_rtable, l_columns, r_columns, ids=None):
+        self.ltable = ltable
+        self.rtable = rtable
+        self.l_pos = self.get_position_array(l_pos, len(ltable))
+        self.r_pos = self.get_position_array(r_pos, len(rtable))
+        self.key = key
+        self.fk_ltable = fk_ltable
+        self.fk_rtable = fk_rtable
+        # output column -> table attribute, for each side (including the foreign key)
+        self.l_columns = l_columns
+        self.r_columns = r_columns
+        # the values of the key column, or None for 0, 1, ..., len - 1
+        self.ids = ids
+
+    # the columns are laid out as in an eager candset: key, foreign keys, ltable and rtable output attributes
+    @property
+    def columns(self):
+        l_names, r_names = list(self.l_columns.keys()), list(self.r_columns.keys())
+        return [self.key, l_names[0], r_names[0]] + l_names[1:] + r_names[1:]
+
+    def __len__(self):
+        return len(self.l_pos)
+
+    def __getitem__(self, item):
+        """
+        Get a column (as a pandas series), several columns (as a dataframe) or the pairs selected by a boolean
+        mask (as a lazy candset, with the same key values).
+        """
+        if isinstance(item, basestring):
+            return pd.Series(self.get_values(item, 0, len(self)), name=item)
+        if isinstance(item, list) and all(isinstance(c, basestring) for c in item):
+            return self.get_chunk(0, len(self), item)
+
+        mask = np.asarray(item)
+        assert mask.dtype == bool and len(mask) == len(self), 'A lazy candset can only be indexed by a column ' \
+                                                              'name, a list of column names or a boolean mask'
+        return LazyCandset(self.ltable, self.rtable, self.l_pos[mask], self.r_pos[mask], self.key,
+                           self.fk_ltable, self.fk_rtable, self.l_columns, self.r_columns,
+                           self.get_values(self.key, 0, len(self))[mask])
+
+    def get_values(self, column, begin, end):
+        """
+        Values of a column for the pairs begin to end, as a numpy array.
+        """
+        end = min(end, len(self))
+        if column == self.key:
+            return np.arange(begin, end, dtype=np.int64) if self.ids is None else self.ids[begin:end]
+        if column in self.l_columns:
+            return self.ltable[self.l_columns[column]].values.take(self.l_pos[begin:end])
+        if column in self.r_columns:
+            return self.rtable[self.r_columns[column]].values.take(self.r_pos[begin:end])
+        raise KeyError(column)
+
+    def get_chunk(self, begin, end, columns=None):
+        """
+        Materialize the pairs begin to end as a dataframe, with the given columns (defaults to all of them).
+        """
+        if columns is None:
+            columns = self.columns
+        cols = OrderedDict((c, self.get_values(c, begin, end)) for c in columns)
+        return pd.DataFrame(cols, columns=columns, index=np.arange(begin, begin + len(self.l_pos[begin:end])))
+
+    def iter_chunks(self, chunk_size=100000, columns=None):
+        """
+        Materialize the candset a chunk of at most chunk_size pairs at a time. The catalog properties of the
+        candset are set on each chunk that has the key and the foreign keys.
+        """
+        for begin in range(0, len(self), chunk_size):
+            chunk = self.get_chunk(begin, begin + chunk_size, columns)
+            if set([self.key, self.fk_ltable, self.fk_rtable]).issubset(chunk.columns):
+                cg.set_candset_properties(chunk, self.key, self.fk_ltable, self.fk_rtable, self.ltable,
+                                          self.rtable)
+            yield chunk
+
+    def to_dataframe(self, columns=None):
+        """
+        Materialize the candset as a dataframe (registered in the catalog, if it has the key and the foreign
+        keys).
+        """
+        df = self.get_chunk(0, len(self), columns).reset_index(drop=True)
+        if set([self.key, self.fk_ltable, self.fk_rtable]).issubset(df.columns):
+            cg.set_candset_properties(df, self.key, self.fk_ltable, self.fk_rtable, self.ltable, self.rtable)
+        return df
+
+    def __repr__(self):
+        return 'LazyCandset(%d pairs; columns: %s)' % (len(self), ', '.join(self.columns))
+
+    # positions in a table of num_rows rows, as int32 if they fit, else int64
+    @staticmethod
+    def get_position_array(positions, num_rows):
+        dtype = np.int32 if num_rows < 2 ** 31 else np.int64
+        return np.asarray(positions).astype(dtype, copy=False)
@@ -2,11 +2,12 @@ import cython
 
 from magellan.external.py_stringmatching.compat import _range
 from magellan.external.py_stringmatching import utils
+from magellan.utils.tokencache import get_token_cache
 
 
 # @todo: add examples in the comments
 
-def qgram(input_string, qval=2):
+def qgram(input_string, qval=2, normalizer=None):
     """
     Tokenizes input string into q-grams.
 
@@ -18,6 +19,9 @@ def qgram(input_string, qval=2):
 
         qval (int): Q-gram length (defaults to 2)
 
+        normalizer (Normalizer): If given, the string is normalized (and its stop words are removed) before
+            it is tokenized (defaults to None)
+
     Returns:
         Token list (list)
 
@@ -31,22 +35,20 @@ def qgram(input_string, qval=2):
         []
         >>> qgram('database', 3)
         ['dat', 'ata', 'tab', 'aba', 'bas', 'ase']
+        >>> from magellan.utils.normalizer import Normalizer
+        >>> qgram('Data!', 3, normalizer=Normalizer())
+        ['dat', 'ata']
 
 
     """
     utils.tok_check_for_none(input_string)
     utils.tok_check_for_string_input(input_string)
 
-    qgram_list = []
+    return _cached_tokenize(input_string, ('qgram', qval), normalizer,
+                            lambda s: _qgram(_normalize(s, normalizer), qval))
 
-    if len(input_string) < qval or qval < 1:
-        return qgram_list
 
-    qgram_list = [input_string[i:i + qval] for i in _range(len(input_string) - (qval - 1))]
-    return qgram_list
-
-
-def delimiter(input_string, delim_str=' '):
+def delimiter(input_string, delim_str=' ', normalizer=None):
     """
     Tokenizes input string based on the given delimiter.
 
@@ -55,6 +57,8 @@ def delimiter(input_string, delim_str=' '):
 
         delim_str (str): Delimiter string
 
+        normalizer (Normalizer): If given, the string is normalized before it is tokenized, and the stop
+            words are removed from the tokens (defaults to None)
 
     Returns:
         Token list (list)
@@ -74,16 +78,22 @@ def delimiter(input_string, delim_str=' '):
     utils.tok_check_for_none(input_string)
     utils.tok_check_for_string_input(input_string)
 
-    return input_string.split(delim_str)
+    if normalizer is None:
+        return _cached_tokenize(input_string, ('delimiter', delim_str), None, lambda s: s.split(delim_str))
+    return _cached_tokenize(input_string, ('delimiter', delim_str), normalizer,
+                            lambda s: normalizer.rem_stop_words(normalizer.normalize(s).split(delim_str)))
 
 
-def whitespace(input_string):
+def whitespace(input_string, normalizer=None):
     """
     Tokenizes input string based on white space.
 
     Args:
         input_string (str): Input string
 
+        normalizer (Normalizer): If given, the string is normalized before it is tokenized, and the stop
+            words are removed from the tokens (defaults to None)
+
     Returns:
         Token list (list)
 
@@ -102,4 +112,35 @@ def whitespace(input_string):
     utils.tok_check_for_none(input_string)
     utils.tok_check_for_string_input(input_string)
 
-    return input_string.split()
+    if normalizer is None:
+        return _cached_tokenize(input_string, ('whitespace',), None, lambda s: s.split())
+    return _cached_tokenize(input_string, ('whitespace',), normalizer, normalizer.get_tokens)
+
+
+def _qgram(input_string, qval):
+    qgram_list = []
+
+    if len(input_string) < qval or qval < 1:
+        return qgram_list
+
+    qgram_list = [input_string[i:i + qval] for i in _range(len(input_string) - (qval - 1))]
+    return qgram_list
+
+
+def _normalize(input_string, normalizer):
+    if normalizer is None:
+        return input_string
+    if normalizer.stop_words:
+        return ' '.join(normalizer.get_tokens(input_string))
+    return normalizer.normalize(input_string)
+
+
+def _cached_tokenize(input_string, settings, normalizer, tokenize_value):
+    # go through the shared token cache (mg.get_token_cache) when it is enabled; callers get their own copy
+    # of the cached list
+    cache = get_token_cache()
+    if not cache.is_enabled():
+        return tokenize_value(input_string)
+    if normalizer is not None:
+        settings += (normalizer.get_settings(),)
+    return list(cache.get_value_tokens(input_string, settings, tokenize_value))
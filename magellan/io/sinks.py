@@ -0,0 +1,216 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import magellan.core.catalog as catalog
+from magellan.core.lazy_candset import LazyCandset
+
+
+class CandsetSink(object):
+    """
+    Destination for a candidate set that is produced in chunks (see the sink parameter of the blockers).
+
+    A blocker calls open once with the output columns and the candset metadata, then write for each chunk
+    (a dataframe with at most chunk_size rows, with the key column already filled in), and finally close,
+    whose return value is returned by the blocker. If the blocking fails after open, abort is called
+    instead of close, and the error is raised.
+    """
+
+    def __init__(self):
+        self.num_rows = 0
+        self.metadata = None
+
+    def open(self, columns, key, fk_ltable, fk_rtable, ltable, rtable):
+        self.num_rows = 0
+        self.metadata = dict(key=key, fk_ltable=fk_ltable, fk_rtable=fk_rtable, ltable=ltable, rtable=rtable)
+
+    def write(self, chunk):
+        self.num_rows += len(chunk)
+
+    def close(self):
+        return self.num_rows
+
+    def abort(self):
+        """
+        Discard the partial output (the base sink only resets its row count).
+        """
+        self.num_rows = 0
+
+
+class CsvSink(CandsetSink):
+    """
+    Append candset chunks to a csv file; the metadata is written to a .metadata file with the same name
+    (as in to_csv_metadata), so the candset can be read back with read_csv_metadata (pass the ltable and
+    rtable, which are written as pointers).
+
+    Args:
+        file_path (str): csv file path
+        kwargs (dict): key value arguments to pandas to_csv
+    """
+
+    def __init__(self, file_path, **kwargs):
+        super(CsvSink, self).__init__()
+        self.file_path = file_path
+        kwargs.setdefault('index', False)
+        self.kwargs = kwargs
+
+    def open(self, columns, key, fk_ltable, fk_rtable, ltable, rtable):
+        super(CsvSink, self).open(columns, key, fk_ltable, fk_rtable, ltable, rtable)
+        _write_candset_metadata(self.file_path, self.metadata)
+        pd.DataFrame(columns=columns).to_csv(self.file_path, mode='w', header=True, **self.kwargs)
+
+    def write(self, chunk):
+        super(CsvSink, self).write(chunk)
+        chunk.to_csv(self.file_path, mode='a', header=False, **self.kwargs)
+
+    def abort(self):
+        super(CsvSink, self).abort()
+        _remove_candset_files(self.file_path)
+
+
+class BinarySink(CandsetSink):
+    """
+    Append candset chunks, pickled one after another, to a binary file; the metadata is written to a
+    .metadata file with the same name. Use read_candset_chunks to read the chunks back.
+
+    Args:
+        file_path (str): File path
+    """
+
+    def __init__(self, file_path):
+        super(BinarySink, self).__init__()
+        self.file_path = file_path
+        self.file = None
+
+    def open(self, columns, key, fk_ltable, fk_rtable, ltable, rtable):
+        super(BinarySink, self).open(columns, key, fk_ltable, fk_rtable, ltable, rtable)
+        _write_candset_metadata(self.file_path, self.metadata)
+        self.file = open(self.file_path, 'wb')
+
+    def write(self, chunk):
+        super(BinarySink, self).write(chunk)
+        pickle.dump(chunk, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.file.close()
+        self.file = None
+        return super(BinarySink, self).close()
+
+    def abort(self):
+        super(BinarySink, self).abort()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        _remove_candset_files(self.file_path)
+
+
+class CallbackSink(CandsetSink):
+    """
+    Pass each candset chunk to a user function. The catalog properties of the candset (key, fk_ltable,
+    fk_rtable, ltable, rtable) are set on each chunk before it is passed on.
+
+    Args:
+        function (function): Function called with each chunk (pandas dataframe)
+    """
+
+    def __init__(self, function):
+        super(CallbackSink, self).__init__()
+        self.function = function
+
+    def write(self, chunk):
+        super(CallbackSink, self).write(chunk)
+        m = self.metadata
+        catalog.set_candset_properties(chunk, m['key'], m['fk_ltable'], m['fk_rtable'], m['ltable'], m['rtable'])
+        self.function(chunk)
+
+
+class LazySink(CandsetSink):
+    """
+    Collect the positions of the pairs in the ltable and rtable instead of their values; the blocker then
+    returns a LazyCandset (registered in the catalog), whose columns are gathered from the tables when they
+    are read. The blockers pass the positions to write_positions instead of materializing chunks.
+    """
+
+    def __init__(self):
+        super(LazySink, self).__init__()
+        self.l_pos = []
+        self.r_pos = []
+        self.columns = None
+
+    def open_positions(self, key, fk_ltable, fk_rtable, ltable, rtable, l_columns, r_columns):
+        self.open([key] + list(l_columns.keys()) + list(r_columns.keys()), key, fk_ltable, fk_rtable, ltable,
+                  rtable)
+        self.l_pos, self.r_pos = [], []
+        self.columns = (l_columns, r_columns)
+
+    def write_positions(self, l_pos, r_pos):
+        m = self.metadata
+        self.num_rows += len(l_pos)
+        # #convert each chunk to the compact dtype right away, so the int64 chunks are not all kept
+        self.l_pos.append(LazyCandset.get_position_array(l_pos, len(m['ltable'])))
+        self.r_pos.append(LazyCandset.get_position_array(r_pos, len(m['rtable'])))
+
+    def abort(self):
+        super(LazySink, self).abort()
+        self.l_pos, self.r_pos = [], []
+
+    def close(self):
+        m = self.metadata
+        l_pos = np.concatenate(self.l_pos) if len(self.l_pos) > 0 else np.array([], dtype=np.int64)
+        r_pos = np.concatenate(self.r_pos) if len(self.r_pos) > 0 else np.array([], dtype=np.int64)
+        self.l_pos, self.r_pos = [], []
+        candset = LazyCandset(m['ltable'], m['rtable'], l_pos, r_pos, m['key'], m['fk_ltable'], m['fk_rtable'],
+                              self.columns[0], self.columns[1])
+        catalog.set_candset_properties(candset, m['key'], m['fk_ltable'], m['fk_rtable'], m['ltable'],
+                                       m['rtable'])
+        return candset
+
+
+def read_candset_chunks(file_path):
+    """
+    Read back the chunks written by a BinarySink, one at a time.
+
+    Args:
+        file_path (str): File path
+
+    Returns:
+        Generator of candset chunks (pandas dataframe)
+    """
+    with open(file_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+def _write_candset_metadata(file_path, metadata):
+    """
+    Write candset metadata next to the given file, in the format read by read_csv_metadata.
+
+    Notes:
+        This is an internal function
+    """
+    file_name, file_ext = os.path.splitext(file_path)
+    with open(file_name + '.metadata', 'w') as f:
+        for k in ['key', 'fk_ltable', 'fk_rtable', 'ltable', 'rtable']:
+            v = metadata[k]
+            if isinstance(v, basestring) is False:
+                v = 'POINTER'
+            f.write('#%s=%s\n' % (k, v))
+    return True
+
+
+def _remove_candset_files(file_path):
+    """
+    Remove a candset file and the metadata file next to it, if they exist.
+
+    Notes:
+        This is an internal function
+    """
+    file_name, file_ext = os.path.splitext(file_path)
+    for name in [file_path, file_name + '.metadata']:
+        if os.path.isfile(name):
+            os.remove(name)
@@ -0,0 +1,147 @@
+from nose.tools import *
+import os
+
+import numpy as np
+import pandas as pd
+
+import magellan as mg
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def test_ab_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    expected = set((l, r) for l, lz in zip(A.ID, A.zipcode) for r, rz in zip(B.ID, B.zipcode) if lz == rz)
+    assert_equal(set(zip(C.ltable_ID, C.rtable_ID)), expected)
+    assert_equal(mg.get_key(C), '_id')
+    mg.del_catalog()
+
+
+def test_ab_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    D = ab.block_candset(C, 'birth_year', 'birth_year', verbose=False, show_progress=False)
+    expected = [(l, r) for l, r in zip(C.ltable_ID, C.rtable_ID)
+                if A.birth_year[A.ID == l].iloc[0] == B.birth_year[B.ID == r].iloc[0]]
+    assert_equal(list(zip(D.ltable_ID, D.rtable_ID)), expected)
+    assert_equal(mg.get_property(D, 'fk_ltable'), 'ltable_ID')
+    assert_equal(mg.get_property(D, 'ltable').equals(A), True)
+    mg.del_catalog()
+
+
+def test_ab_block_candset_missing_values():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    A['zipcode'] = A['zipcode'].astype(float)
+    B['zipcode'] = B['zipcode'].astype(float)
+    A.loc[0, 'zipcode'] = np.NaN
+    B['zipcode'] = B['zipcode'].where(B.ID != 'b1', np.NaN)
+    D = ab.block_candset(C, 'zipcode', 'zipcode', verbose=False, show_progress=False)
+    expected = [(l, r) for l, r in zip(C.ltable_ID, C.rtable_ID) if l != 'a1' and r != 'b1']
+    assert_equal(list(zip(D.ltable_ID, D.rtable_ID)), expected)
+    mg.del_catalog()
+
+
+def test_ab_block_tables_partitioned():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    B['zipcode'] = B['zipcode'].astype(float)
+    B.loc[0, 'zipcode'] = np.NaN
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], verbose=False)
+    for num_partitions in [1, 3]:
+        D = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], num_partitions=num_partitions,
+                            verbose=False)
+        assert_equal(C.equals(D), True)
+        assert_equal(mg.get_property(D, 'fk_rtable'), 'rtable_ID')
+    chunks = []
+    n = ab.block_tables(A, B, 'zipcode', 'zipcode', num_partitions=3, sink=mg.CallbackSink(chunks.append),
+                        chunk_size=2, verbose=False)
+    assert_equal(n, len(C))
+    pairs = [pair for c in chunks for pair in zip(c.ltable_ID, c.rtable_ID)]
+    assert_equal(sorted(pairs), sorted(zip(C.ltable_ID, C.rtable_ID)))
+    mg.del_catalog()
+
+
+def test_ab_block_tables_partitioned_mixed_numbers():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    A['zipcode'] = pd.Series([int(z) for z in A.zipcode], dtype=object)
+    B['zipcode'] = pd.Series([float(z) for z in B.zipcode], dtype=object)
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    assert_equal(len(C) > 0, True)
+    for num_partitions in [2, 5]:
+        D = ab.block_tables(A, B, 'zipcode', 'zipcode', num_partitions=num_partitions, verbose=False)
+        assert_equal(C.equals(D), True)
+    mg.del_catalog()
+
+
+def test_ab_block_tables_heavy_keys():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    light = [('a1', 'b1'), ('a1', 'b2'), ('a1', 'b6'), ('a3', 'b1'), ('a3', 'b2'), ('a3', 'b6')]
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', max_pairs_per_key=6, verbose=False)
+    assert_equal(ab.heavy_keys.items(), [(94122, 9)])
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), light)
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', max_pairs_per_key=6, heavy_key_policy='cap', chunk_size=2,
+                        verbose=False)
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), light + [('a2', 'b3'), ('a2', 'b4'), ('a2', 'b5'),
+                                                               ('a4', 'b3'), ('a4', 'b4'), ('a4', 'b5')])
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', max_pairs_per_key=6, heavy_key_policy='sub_block',
+                        l_sub_block_attr='birth_year', r_sub_block_attr='birth_year', verbose=False)
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), light + [('a2', 'b3'), ('a5', 'b5')])
+    chunks = []
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', max_pairs_per_key=6, heavy_key_policy='stream',
+                        heavy_key_sink=mg.CallbackSink(chunks.append), num_partitions=2, verbose=False)
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), light)
+    assert_equal(sum(len(c) for c in chunks), 9)
+    assert_equal(ab.heavy_key_output, 9)
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    assert_equal(len(ab.heavy_keys), 0)
+    assert_equal(ab.heavy_key_output, None)
+    mg.del_catalog()
+
+
+@raises(AssertionError)
+def test_ab_block_tables_heavy_keys_invalid_policy():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', max_pairs_per_key=6,
+                                             heavy_key_policy='stream', verbose=False)
+
+
+def test_ab_soundex():
+    for value, code in [('Robert', 'R163'), ('Rupert', 'R163'), ('Ashcraft', 'A261'), ('Tymczak', 'T522'),
+                        ('Pfister', 'P236'), ('Lee', 'L000')]:
+        assert_equal(mg.blocker.block_keys.soundex(value), code)
+    assert_equal(np.isnan(mg.blocker.block_keys.soundex('123')), True)
+
+
+def test_ab_block_tables_composite_key():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    l_attrs = ['zipcode', mg.prefix_key('name', 1)]
+    C = ab.block_tables(A, B, l_attrs, ['zipcode', mg.prefix_key('name', 1)], verbose=False)
+    expected = [(l, r) for l, lz, ln in zip(A.ID, A.zipcode, A.name) for r, rz, rn in zip(B.ID, B.zipcode, B.name)
+                if lz == rz and ln[0].lower() == rn[0].lower()]
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), expected)
+    D = ab.block_tables(A, B, l_attrs, ['zipcode', mg.prefix_key('name', 1)], num_partitions=2, verbose=False)
+    assert_equal(C.equals(D), True)
+    ab.block_tables(A, B, l_attrs, l_attrs, max_pairs_per_key=0, verbose=False)
+    assert_equal(ab.heavy_keys[(94122, 'm')], 1)
+    E = ab.block_candset(ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False), l_attrs, l_attrs,
+                         verbose=False, show_progress=False)
+    assert_equal(list(zip(E.ltable_ID, E.rtable_ID)), expected)
+    F = ab.block_tables(A, B, mg.soundex_key('name'), mg.soundex_key('name'), verbose=False)
+    assert_equal(list(zip(F.ltable_ID, F.rtable_ID)), [('a2', 'b6'), ('a5', 'b5')])
+    mg.del_catalog()
@@ -0,0 +1,204 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import magellan as mg
+from magellan.blocker.black_box_blocker import BlackBoxBlocker
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def _birth_year_differs(l, r):
+    return l['birth_year'] != r['birth_year']
+
+
+def test_bb_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(_birth_year_differs)
+    C = bb.block_tables(A, B, l_output_attrs=['name'], verbose=False, show_progress=False)
+    expected = [(l, r) for l, ly in zip(A.ID, A.birth_year) for r, ry in zip(B.ID, B.birth_year) if ly == ry]
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), expected)
+    assert_equal(mg.get_property(C, 'fk_rtable'), 'rtable_ID')
+    mg.del_catalog()
+
+
+def test_bb_block_tables_n_jobs():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: l['zipcode'] != r['zipcode'])
+    C = bb.block_tables(A, B, verbose=False, show_progress=False)
+    D = bb.block_tables(A, B, n_jobs=2, verbose=False, show_progress=False)
+    assert_equal(C.equals(D), True)
+    tiles = bb.get_tiles(5, 6, 2, max_tile_pairs=4)
+    assert_equal(all((l1 - l0) * (r1 - r0) <= 4 for (l0, l1), (r0, r1) in tiles), True)
+    assert_equal(sum((l1 - l0) * (r1 - r0) for (l0, l1), (r0, r1) in tiles), 30)
+    mg.del_catalog()
+
+
+def test_bb_block_tables_nested():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(_birth_year_differs)
+    inner = BlackBoxBlocker()
+    inner.set_black_box_function(lambda l, r: l['zipcode'] != r['zipcode'])
+    C = bb.block_tables(A, B, verbose=False, show_progress=False)
+    D = inner.block_tables(A, B, verbose=False, show_progress=False)
+    # #each chunk of the outer call starts another (serial or parallel) call before the outer one resumes
+    chunks, inner_outputs = [], []
+
+    def write(chunk):
+        chunks.append(chunk)
+        for n_jobs in [1, 2]:
+            inner_outputs.append(inner.block_tables(A, B, n_jobs=n_jobs, verbose=False, show_progress=False))
+
+    for n_jobs in [1, 2]:
+        num_rows = bb.block_tables(A, B, sink=mg.CallbackSink(write), n_jobs=n_jobs, verbose=False,
+                                   show_progress=False)
+        assert_equal(num_rows, len(C))
+        pairs = [pair for c in chunks for pair in zip(c.ltable_ID, c.rtable_ID)]
+        assert_equal(pairs, list(zip(C.ltable_ID, C.rtable_ID)))
+        assert_equal(all(E.equals(D) for E in inner_outputs), True)
+        del chunks[:], inner_outputs[:]
+    mg.del_catalog()
+
+
+def test_bb_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(_birth_year_differs)
+    expected = bb.block_tables(A, B, verbose=False, show_progress=False)
+    for n_jobs in [1, 2]:
+        D = bb.block_candset(C, n_jobs=n_jobs, verbose=False, show_progress=False)
+        assert_equal(set(zip(D.ltable_ID, D.rtable_ID)),
+                     set(zip(C.ltable_ID, C.rtable_ID)) & set(zip(expected.ltable_ID, expected.rtable_ID)))
+        assert_equal(mg.get_key(D), '_id')
+    mg.del_catalog()
+
+
+def test_bb_row_types():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(_birth_year_differs)
+    C = bb.block_tables(A, B, verbose=False, show_progress=False)
+    bb.set_black_box_function(_birth_year_differs, l_attrs=['birth_year'], r_attrs=['birth_year'], row_type='dict')
+    assert_equal(bb.get_tuples(A, 'ID', bb.l_attrs)[0], {'birth_year': 1989})
+    D = bb.block_tables(A, B, verbose=False, show_progress=False)
+    assert_equal(C.equals(D), True)
+    bb.set_black_box_function(lambda l, r: l.birth_year != r.birth_year, l_attrs=['birth_year'],
+                              r_attrs=['birth_year'], row_type='namedtuple')
+    D = bb.block_tables(A, B, n_jobs=2, verbose=False, show_progress=False)
+    assert_equal(C.equals(D), True)
+    E = bb.block_candset(C, verbose=False, show_progress=False)
+    assert_equal(C.equals(E), True)
+    mg.del_catalog()
+
+
+def test_bb_batch_function():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: abs(l['birth_year'] - r['birth_year']) > 1)
+    C = bb.block_tables(A, B, verbose=False, show_progress=False)
+    D = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    E = bb.block_candset(D, verbose=False, show_progress=False)
+    bb.set_batch_black_box_function(lambda l, r: np.abs(l['birth_year'] - r['birth_year']) > 1,
+                                    l_attrs=['birth_year'], r_attrs=['birth_year'])
+    for n_jobs in [1, 2]:
+        assert_equal(C.equals(bb.block_tables(A, B, n_jobs=n_jobs, verbose=False, show_progress=False)), True)
+        assert_equal(E.equals(bb.block_candset(D, n_jobs=n_jobs, verbose=False, show_progress=False)), True)
+    assert_equal(bb.block_tuples(A.iloc[0], B.iloc[0]), True)
+    mg.del_catalog()
+
+
+def test_bb_decision_cache():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = mg.DecisionCache(cache_dir)
+        bb = BlackBoxBlocker()
+        bb.set_black_box_function(_birth_year_differs, l_attrs=['birth_year'], r_attrs=['birth_year'],
+                                  row_type='dict')
+        bb.set_decision_cache(cache)
+        expected = bb.block_candset(C, verbose=False, show_progress=False)
+        assert_equal((cache.hits, cache.misses), (0, len(C)))
+
+        # #a re-run reads all the decisions from the cache
+        D = bb.block_candset(C, verbose=False, show_progress=False)
+        assert_equal(D.equals(expected), True)
+        assert_equal((cache.hits, cache.misses), (len(C), len(C)))
+
+        # #a changed value is evaluated again
+        A.loc[A.ID == C.ltable_ID.iloc[0], 'birth_year'] += 100
+        D = bb.block_candset(C, verbose=False, show_progress=False)
+        assert_equal(cache.misses > len(C), True)
+        assert_equal(C.ltable_ID.iloc[0] in set(D.ltable_ID), False)
+
+        # #so is every pair once the function changes
+        bb.set_black_box_function(lambda l, r: l['birth_year'] == r['birth_year'], l_attrs=['birth_year'],
+                                  r_attrs=['birth_year'], row_type='dict')
+        misses = cache.misses
+        bb.block_candset(C, verbose=False, show_progress=False)
+        assert_equal(cache.misses - misses, len(C))
+    finally:
+        shutil.rmtree(cache_dir)
+    mg.del_catalog()
+
+
+def test_decision_cache_limits():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = mg.DecisionCache(cache_dir, max_size=3, max_functions=1)
+        cache.update('f', np.arange(5, dtype=np.uint64), np.ones(5, dtype=bool))
+        found, valid = cache.lookup('f', np.arange(5, dtype=np.uint64))
+        assert_equal(found.sum(), 3)
+        cache.update('g', np.arange(2, dtype=np.uint64), np.zeros(2, dtype=bool))
+        assert_equal(cache.lookup('f', np.arange(5, dtype=np.uint64))[0].sum(), 0)
+        assert_equal(list(cache.lookup('g', np.arange(3, dtype=np.uint64))[0]), [True, True, False])
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_bb_series_rows_projected():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(_birth_year_differs, l_attrs=['birth_year'])
+    rows = bb.get_tuples(A, 'ID', ['birth_year'])
+    assert_equal([r.name for r in rows], list(A.ID))
+    assert_equal(list(rows[0].index), ['birth_year'])
+    A.loc[1, 'name'] = np.nan
+    assert_equal(list(bb.rem_nan(A, 'name').ID), ['a1', 'a3', 'a4', 'a5'])
+    assert_equal(list(bb.get_not_null_positions(A, 'name')), [0, 2, 3, 4])
+    mg.del_catalog()
+
+
+def test_decision_cache_lookup_does_not_write():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = mg.DecisionCache(cache_dir)
+        cache.update('f', np.arange(5, dtype=np.uint64), np.ones(5, dtype=bool))
+        file_name = os.path.join(cache_dir, 'f.npz')
+        os.utime(file_name, (0, 0))
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        found, valid = cache.lookup('f', np.arange(3, dtype=np.uint64))
+        cache.update('f', np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool))
+        assert_equal(found.all(), True)
+        with open(file_name, 'rb') as f:
+            assert_equal(f.read() == content, True)
+        # #the file is marked as used, for the eviction of functions
+        assert_equal(os.path.getmtime(file_name) > 0, True)
+    finally:
+        shutil.rmtree(cache_dir)
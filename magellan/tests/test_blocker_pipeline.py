@@ -0,0 +1,93 @@
+from nose.tools import *
+import os
+import shutil
+import tempfile
+
+import magellan as mg
+from magellan.blocker.black_box_blocker import BlackBoxBlocker
+from magellan.blocker.overlap_blocker import OverlapBlocker
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def _get_pipeline():
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: abs(l['birth_year'] - r['birth_year']) > 2)
+    pipeline = mg.BlockerPipeline(random_state=0)
+    pipeline.add_blocker(bb, name='birth_year')
+    pipeline.add_blocker(OverlapBlocker(), 'address', 'address', overlap_size=2)
+    pipeline.add_blocker(mg.AttrEquivalenceBlocker(), 'zipcode', 'zipcode')
+    return pipeline
+
+
+def test_pipeline_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    pipeline = _get_pipeline()
+    C = pipeline.block_tables(A, B, l_output_attrs=['name'], verbose=False, show_progress=False)
+
+    bb = pipeline.steps[0]['blocker']
+    D = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    D = OverlapBlocker().block_candset(D, 'address', 'address', overlap_size=2, verbose=False, show_progress=False)
+    D = bb.block_candset(D, verbose=False, show_progress=False)
+    assert_equal(set(zip(C.ltable_ID, C.rtable_ID)), set(zip(D.ltable_ID, D.rtable_ID)))
+    assert_equal('ltable_name' in C.columns, True)
+    assert_equal(mg.get_property(C, 'fk_ltable'), 'ltable_ID')
+
+    plan = pipeline.plan
+    assert_equal(len(plan), 3)
+    assert_equal(list(plan.method), ['block_tables', 'block_candset', 'block_candset'])
+    assert_equal(plan.input_pairs[0], len(A) * len(B))
+    mg.del_catalog()
+
+
+def test_pipeline_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    pipeline = _get_pipeline()
+    C = pipeline.block_tables(A, B, verbose=False, show_progress=False)
+    D = BlackBoxBlocker()
+    D.set_black_box_function(lambda l, r: False)
+    D = D.block_tables(A, B, verbose=False, show_progress=False)
+    E = pipeline.block_candset(D, verbose=False, show_progress=False)
+    assert_equal(set(zip(C.ltable_ID, C.rtable_ID)), set(zip(E.ltable_ID, E.rtable_ID)))
+    assert_equal(list(pipeline.plan.method), ['block_candset'] * 3)
+    assert_equal(mg.is_dfinfo_present(D), True)
+    mg.del_catalog()
+
+
+def test_pipeline_get_plan():
+    pipeline = _get_pipeline()
+    sample = dict(n_l=100, n_r=100)
+    estimates = [dict(sample, pair_cost=1e-5, selectivity=0.5, tables_time=0.05),
+                 dict(sample, pair_cost=1e-4, selectivity=0.01, tables_time=0.01),
+                 dict(sample, pair_cost=1e-6, selectivity=0.1, tables_time=0.01)]
+    # the black box blocker would enumerate the cartesian product
+    assert_equal(pipeline.get_plan(estimates, 10000, 10000), [1, 2, 0])
+    assert_equal(pipeline.get_filter_order(estimates, [0, 1, 2]), [2, 0, 1])
+
+
+def test_pipeline_estimate_steps_no_side_effects():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    pipeline = _get_pipeline()
+    bb = pipeline.steps[0]['blocker']
+    path = tempfile.mkdtemp()
+    received = []
+    mg.add_stats_callback(received.append)
+    try:
+        cache = mg.DecisionCache(path)
+        bb.set_decision_cache(cache)
+        stats = bb.stats
+        estimates = pipeline.estimate_steps(A, B, 'ID', 'ID', True)
+        assert_equal(len(estimates), 3)
+        assert_equal(received, [])
+        assert_equal(bb.stats is stats, True)
+        assert_equal(bb.decision_cache is cache, True)
+        assert_equal((cache.hits, cache.misses), (0, 0))
+        assert_equal(os.listdir(path), [])
+    finally:
+        mg.remove_stats_callback(received.append)
+        shutil.rmtree(path)
+    mg.del_catalog()
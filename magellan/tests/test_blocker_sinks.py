@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+import pandas as pd
+
+import magellan as mg
+from magellan.blocker.overlap_blocker import OverlapBlocker
+from magellan.blocker.black_box_blocker import BlackBoxBlocker
+
+p = mg.get_install_path()
+path_for_A = os.sep.join([p, 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([p, 'datasets', 'table_B.csv'])
+
+
+def _block_with_each_blocker(A, B, **kwargs):
+    ab = mg.AttrEquivalenceBlocker()
+    yield ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], r_output_attrs=['name'],
+                          verbose=False, **kwargs)
+    ob = OverlapBlocker()
+    yield ob.block_tables(A, B, 'address', 'address', overlap_size=3, l_output_attrs=['name'],
+                          r_output_attrs=['name'], verbose=False, show_progress=False, **kwargs)
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: l['birth_year'] != r['birth_year'])
+    yield bb.block_tables(A, B, l_output_attrs=['name'], r_output_attrs=['name'], verbose=False,
+                          show_progress=False, **kwargs)
+
+
+def test_callback_sink():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    expected = list(_block_with_each_blocker(A, B))
+    chunks = []
+    sink = mg.CallbackSink(chunks.append)
+    for i, num_rows in enumerate(_block_with_each_blocker(A, B, sink=sink, chunk_size=4)):
+        C = expected[i]
+        assert_equal(num_rows, len(C))
+        assert_equal(all(len(c) <= 4 for c in chunks), True)
+        assert_equal(mg.get_property(chunks[0], 'fk_ltable'), 'ltable_ID')
+        D = pd.concat(chunks, ignore_index=True)
+        assert_equal(D.equals(C), True)
+        del chunks[:]
+    mg.del_catalog()
+
+
+def test_csv_and_binary_sinks():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], verbose=False)
+    path = tempfile.mkdtemp()
+    try:
+        csv_path = os.sep.join([path, 'C.csv'])
+        num_rows = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'],
+                                   sink=mg.CsvSink(csv_path), chunk_size=4, verbose=False)
+        assert_equal(num_rows, len(C))
+        D = mg.read_csv_metadata(csv_path, ltable=A, rtable=B)
+        assert_equal(D.equals(C), True)
+        assert_equal(mg.get_key(D), '_id')
+        assert_equal(mg.get_property(D, 'fk_rtable'), 'rtable_ID')
+
+        bin_path = os.sep.join([path, 'C.pkl'])
+        ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], sink=mg.BinarySink(bin_path),
+                        chunk_size=4, verbose=False)
+        chunks = list(mg.read_candset_chunks(bin_path))
+        assert_equal(all(len(c) <= 4 for c in chunks), True)
+        assert_equal(pd.concat(chunks, ignore_index=True).equals(C), True)
+        assert_equal(os.path.isfile(os.sep.join([path, 'C.metadata'])), True)
+    finally:
+        shutil.rmtree(path)
+    mg.del_catalog()
+
+
+def test_csv_and_binary_sinks_abort():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+
+    def fn(l, r):
+        if l['ID'] == 'a4':
+            raise ValueError('black box failure')
+        return False
+
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(fn)
+    path = tempfile.mkdtemp()
+    try:
+        for sink in [mg.CsvSink(os.sep.join([path, 'C.csv'])), mg.BinarySink(os.sep.join([path, 'C.pkl']))]:
+            assert_raises(ValueError, bb.block_tables, A, B, sink=sink, chunk_size=2, verbose=False,
+                          show_progress=False)
+            assert_equal(sink.num_rows, 0)
+            assert_equal(os.listdir(path), [])
+        bb.set_black_box_function(lambda l, r: False)
+        sink = mg.BinarySink(os.sep.join([path, 'C.pkl']))
+        bb.block_tables(A, B, sink=sink, chunk_size=2, verbose=False, show_progress=False)
+        assert_equal(sink.file, None)
+    finally:
+        shutil.rmtree(path)
+    mg.del_catalog()
+
+
+def test_lazy_sink():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    for C, L in zip(_block_with_each_blocker(A, B), _block_with_each_blocker(A, B, sink=mg.LazySink())):
+        assert_equal(isinstance(L, mg.LazyCandset), True)
+        assert_equal(L.l_pos.dtype, 'int32')
+        assert_equal(L.columns, list(C.columns))
+        assert_equal(len(L), len(C))
+        assert_equal(L.to_dataframe().equals(C), True)
+        assert_equal(mg.get_key(L), '_id')
+        assert_equal(mg.get_property(L, 'fk_ltable'), 'ltable_ID')
+        chunks = list(L.iter_chunks(4))
+        assert_equal(pd.concat(chunks).reset_index(drop=True).equals(C), True)
+        assert_equal(mg.get_property(chunks[0], 'ltable') is A, True)
+    mg.del_catalog()
+
+
+def test_lazy_candset_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    C = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], verbose=False)
+    L = ab.block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'], verbose=False, sink=mg.LazySink())
+    ob = OverlapBlocker()
+    D = ob.block_candset(C, 'address', 'address', overlap_size=2, verbose=False, show_progress=False)
+    M = ob.block_candset(L, 'address', 'address', overlap_size=2, verbose=False, show_progress=False)
+    assert_equal(isinstance(M, mg.LazyCandset), True)
+    assert_equal(M.to_dataframe().equals(D.reset_index(drop=True)), True)
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: l['birth_year'] != r['birth_year'])
+    E = bb.block_candset(M, verbose=False, show_progress=False)
+    F = ab.block_candset(M, 'birth_year', 'birth_year', verbose=False, show_progress=False)
+    assert_equal(list(E['_id']), list(F['_id']))
+    assert_equal(list(E['ltable_name']), list(bb.block_candset(D, verbose=False, show_progress=False).ltable_name))
+    mg.del_catalog()
+
+
+def test_lazy_candset_block_candset_empty():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ab = mg.AttrEquivalenceBlocker()
+    L = ab.block_tables(A, B, 'zipcode', 'zipcode', verbose=False, sink=mg.LazySink())
+    E = L[[False] * len(L)]
+    assert_equal(len(E), 0)
+    mg.core.catalog.set_candset_properties(E, '_id', 'ltable_ID', 'rtable_ID', A, B)
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: False)
+    for out_table in [ab.block_candset(E, 'birth_year', 'birth_year', verbose=False, show_progress=False),
+                      OverlapBlocker().block_candset(E, 'address', 'address', verbose=False, show_progress=False),
+                      bb.block_candset(E, verbose=False, show_progress=False)]:
+        assert_equal(isinstance(out_table, mg.LazyCandset), True)
+        assert_equal(len(out_table), 0)
+        assert_equal(out_table.columns, L.columns)
+    mg.del_catalog()
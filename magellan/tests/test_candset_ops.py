@@ -0,0 +1,51 @@
+from nose.tools import *
+import os
+
+import magellan as mg
+from magellan.blocker.overlap_blocker import OverlapBlocker
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def _get_candsets():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C1 = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', l_output_attrs=['name'],
+                                                  verbose=False)
+    C2 = OverlapBlocker().block_tables(A, B, 'address', 'address', overlap_size=2, r_output_attrs=['name'],
+                                       verbose=False, show_progress=False)
+    return C1, C2
+
+
+def _pairs(C):
+    return list(zip(C.ltable_ID, C.rtable_ID))
+
+
+def test_union_candsets():
+    C1, C2 = _get_candsets()
+    C = mg.union_candsets([C1, C2], verbose=False)
+    expected = _pairs(C1) + [p for p in _pairs(C2) if p not in set(_pairs(C1))]
+    assert_equal(_pairs(C), expected)
+    assert_equal(list(C.columns), ['_id', 'ltable_ID', 'rtable_ID', 'ltable_name', 'rtable_name'])
+    assert_equal(list(C._id), list(range(len(C))))
+    assert_equal(mg.get_key(C), '_id')
+    assert_equal(mg.get_property(C, 'ltable') is mg.get_property(C1, 'ltable'), True)
+    A = mg.get_property(C, 'ltable')
+    assert_equal(list(C.ltable_name), list(A.set_index('ID').name[C.ltable_ID]))
+    mg.del_catalog()
+
+
+def test_intersect_and_diff_candsets():
+    C1, C2 = _get_candsets()
+    C = mg.intersect_candsets([C1, C2], verbose=False)
+    assert_equal(_pairs(C), [p for p in _pairs(C1) if p in set(_pairs(C2))])
+    assert_equal(list(C.columns), ['_id', 'ltable_ID', 'rtable_ID', 'ltable_name', 'rtable_name'])
+    D = mg.diff_candsets(C1, C2, verbose=False)
+    assert_equal(_pairs(D), [p for p in _pairs(C1) if p not in set(_pairs(C2))])
+    assert_equal(list(D.columns), list(C1.columns))
+    assert_equal(list(D.ltable_name), [n for p, n in zip(_pairs(C1), C1.ltable_name) if p not in set(_pairs(C2))])
+    E = mg.diff_candsets(C1, C1, verbose=False)
+    assert_equal(len(E), 0)
+    assert_equal(mg.get_property(E, 'fk_rtable'), 'rtable_ID')
+    mg.del_catalog()
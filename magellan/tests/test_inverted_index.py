@@ -0,0 +1,71 @@
+from nose.tools import *
+import numpy as np
+
+import magellan as mg
+
+
+def test_ii_from_token_lists():
+    index = mg.InvertedIndex.from_token_lists([['a', 'b'], ['b', 'c', 'b'], [], ['b']])
+    assert_equal(index.num_rows, 4)
+    # tokens are ordered by increasing document frequency
+    assert_equal(index.tokens, ['a', 'c', 'b'])
+    assert_equal(list(index.get_posting_lengths()), [1, 1, 3])
+    assert_equal(list(index.get_postings([index.token_ids['b']])), [0, 1, 3])
+    assert_equal(list(index.get_postings([0, 1])), [0, 1])
+    assert_equal(list(index.record_offsets), [0, 2, 4, 4, 5])
+    assert_equal(list(index.record_token_ids), [0, 2, 1, 2, 2])
+
+
+def test_ii_probe():
+    index = mg.InvertedIndex.from_token_lists([['a', 'b', 'c'], ['b', 'c'], ['c', 'd'], ['d']])
+    offsets, token_ids = index.encode([['b', 'c', 'x'], ['d'], ['y']])
+    assert_equal(list(offsets), [0, 2, 3, 3])
+    for prefix_filter in [False, True]:
+        l_pos, r_pos = index.probe(offsets, token_ids, 2, prefix_filter)
+        assert_equal(list(zip(l_pos, r_pos)), [(0, 0), (1, 0)])
+        l_pos, r_pos = index.probe(offsets, token_ids, 1, prefix_filter)
+        assert_equal(list(zip(l_pos, r_pos)), [(0, 0), (1, 0), (2, 0), (2, 1), (3, 1)])
+
+
+def test_ii_probe_empty_index():
+    index = mg.InvertedIndex.from_token_lists([])
+    offsets, token_ids = index.encode([['a']])
+    l_pos, r_pos = index.probe(offsets, token_ids, 1)
+    assert_equal(len(l_pos), 0)
+    assert_equal(len(r_pos), 0)
+
+
+def test_ii_prune():
+    index = mg.InvertedIndex.from_token_lists([['a', 'b', 'c'], ['b', 'c'], ['c', 'd'], ['c']])
+    pruned, dropped = index.prune(max_posting_len=2)
+    assert_equal(list(dropped.items()), [('c', 4)])
+    assert_equal(pruned.tokens, ['a', 'd', 'b'])
+    assert_equal(list(pruned.record_offsets), [0, 2, 3, 4, 4])
+    assert_equal(list(pruned.get_postings([pruned.token_ids['b']])), [0, 1])
+    offsets, token_ids = pruned.encode([['b', 'c'], ['c']])
+    l_pos, r_pos = pruned.probe(offsets, token_ids, 1)
+    assert_equal(list(zip(l_pos, r_pos)), [(0, 0), (1, 0)])
+
+    pruned, dropped = index.prune(max_doc_freq_ratio=0.25)
+    assert_equal(list(dropped.keys()), ['c', 'b'])
+    assert_equal(pruned.tokens, ['a', 'd'])
+
+
+def test_ii_probe_top_k():
+    index = mg.InvertedIndex.from_token_lists([['a', 'b', 'c'], ['b', 'c'], ['c', 'd'], ['a', 'b', 'c', 'd']])
+    offsets, token_ids = index.encode([['a', 'b', 'c', 'd'], ['c'], ['x']])
+    l_pos, r_pos = index.probe_top_k(offsets, token_ids, 2)
+    assert_equal(list(zip(l_pos, r_pos)), [(0, 0), (3, 0), (0, 1), (1, 1)])
+    l_pos, r_pos = index.probe_top_k(offsets, token_ids, 3, overlap_size=2)
+    assert_equal(list(zip(l_pos, r_pos)), [(0, 0), (1, 0), (3, 0)])
+
+
+def test_ii_probe_top_k_early_stop():
+    # #the probe shares its rare tokens with one record and its frequent token with all of them
+    index = mg.InvertedIndex.from_token_lists([['a', 'b', 'c', 'z']] + [['z']] * 20)
+    offsets, token_ids = index.encode([['a', 'b', 'c', 'z']])
+    index.probe(offsets, token_ids, 1)
+    num_postings = index.num_postings_read
+    l_pos, r_pos = index.probe_top_k(offsets, token_ids, 1)
+    assert_equal(list(zip(l_pos, r_pos)), [(0, 0)])
+    assert_equal(index.num_postings_read - num_postings < num_postings, True)
@@ -0,0 +1,46 @@
+# coding=utf-8
+from nose.tools import *
+import os
+
+import magellan as mg
+from magellan.blocker.overlap_blocker import OverlapBlocker
+from magellan.external.py_stringmatching.tokenizers import delimiter, qgram, whitespace
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def test_normalizer_normalize():
+    n = mg.Normalizer()
+    assert_equal(n.normalize(u' Café, au LAIT! '), 'caf au lait')
+    assert_equal(n.normalize(' Caf\xc3\xa9, au LAIT! '), 'caf au lait')
+    assert_equal(n.normalize(12), '12')
+    assert_equal(n.normalize_column(['A.b', u'C-d']), ['ab', 'cd'])
+    assert_equal(n.normalize_column(['A.b', ' C-d ']), ['ab', 'cd'])
+    assert_equal(n.normalize_column(['A.b', 1.5, None]), ['ab', '15', 'none'])
+    n = mg.Normalizer(ascii_fold=False, punctuation='!')
+    assert_equal(n.normalize(u'Café, LAIT!'), u'café, lait')
+    n = mg.Normalizer(case_fold=False, punctuation=None, stop_words=['au'])
+    assert_equal(n.get_tokens(u'Café, au LAIT!'), ['Caf,', 'LAIT!'])
+
+
+def test_normalizer_tokenizers():
+    n = mg.Normalizer(stop_words=['of'])
+    assert_equal(qgram('Bank of Data', 4, normalizer=n), ['bank', 'ank ', 'nk d', 'k da', ' dat', 'data'])
+    assert_equal(whitespace('Bank of  Data!', normalizer=n), ['bank', 'data'])
+    assert_equal(delimiter('Bank,of,Data', ',', normalizer=mg.Normalizer(punctuation='.')),
+                 ['bank', 'of', 'data'])
+
+
+def test_normalizer_ob_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C = OverlapBlocker().block_tables(A, B, 'address', 'address', rem_stop_words=True, verbose=False,
+                                      show_progress=False)
+    ob = OverlapBlocker(normalizer=mg.Normalizer(stop_words=OverlapBlocker().stop_words))
+    D = ob.block_tables(A, B, 'address', 'address', verbose=False, show_progress=False)
+    assert_equal(C.equals(D), True)
+    index = OverlapBlocker().build_index(A, 'address', verbose=False)
+    assert_raises(AssertionError, ob.block_tables, A, B, 'address', 'address', l_index=index, verbose=False,
+                  show_progress=False)
+    mg.del_catalog()
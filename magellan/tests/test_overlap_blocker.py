@@ -0,0 +1,200 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+
+import magellan as mg
+from magellan.blocker.overlap_blocker import OverlapBlocker
+
+p = mg.get_install_path()
+path_for_A = os.sep.join([p, 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([p, 'datasets', 'table_B.csv'])
+
+
+def test_ob_block_tables_word_level():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'name', 'name', verbose=False, show_progress=False)
+    assert_equal(list(C.columns), ['_id', 'ltable_ID', 'rtable_ID'])
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), [('a3', 'b2'), ('a2', 'b3'), ('a5', 'b5'), ('a2', 'b6')])
+    assert_equal(mg.get_key(C), '_id')
+    assert_equal(mg.get_property(C, 'fk_ltable'), 'ltable_ID')
+    assert_equal(mg.get_property(C, 'fk_rtable'), 'rtable_ID')
+    mg.del_catalog()
+
+
+def test_ob_block_tables_output_attrs():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'address', 'address', overlap_size=3,
+                        l_output_attrs=['name', 'zipcode'], r_output_attrs='name',
+                        verbose=False, show_progress=False)
+    assert_equal(list(C.columns), ['_id', 'ltable_ID', 'rtable_ID', 'ltable_name', 'ltable_zipcode',
+                                   'rtable_name'])
+    assert_equal(len(C), 18)
+    assert_equal(C.ltable_zipcode.dtype, A.zipcode.dtype)
+    row = C[(C.ltable_ID == 'a5') & (C.rtable_ID == 'b6')].iloc[0]
+    assert_equal(row['ltable_name'], 'Alphonse Kemper')
+    assert_equal(row['rtable_name'], 'Michael Brodie')
+    mg.del_catalog()
+
+
+def test_ob_block_tables_empty_output():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'name', 'name', overlap_size=10, l_output_attrs=['name'],
+                        verbose=False, show_progress=False)
+    assert_equal(len(C), 0)
+    assert_equal(list(C.columns), ['_id', 'ltable_ID', 'rtable_ID', 'ltable_name'])
+    mg.del_catalog()
+
+
+def test_ob_block_tables_prefix_filter_same_output():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    for overlap_size in [1, 2, 3, 4]:
+        C1 = ob.block_tables(A, B, 'address', 'address', overlap_size=overlap_size,
+                             l_output_attrs=['name'], verbose=False, show_progress=False)
+        C2 = ob.block_tables(A, B, 'address', 'address', overlap_size=overlap_size,
+                             l_output_attrs=['name'], prefix_filter=True, verbose=False, show_progress=False)
+        assert_equal(C1.equals(C2), True)
+    mg.del_catalog()
+
+
+def test_ob_block_tables_n_jobs_same_output():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    for prefix_filter in [False, True]:
+        C1 = ob.block_tables(A, B, 'address', 'address', overlap_size=2, r_output_attrs=['address'],
+                             prefix_filter=prefix_filter, verbose=False, show_progress=False)
+        C2 = ob.block_tables(A, B, 'address', 'address', overlap_size=2, r_output_attrs=['address'],
+                             prefix_filter=prefix_filter, n_jobs=2, verbose=False, show_progress=False)
+        assert_equal(C1.equals(C2), True)
+        assert_equal(mg.get_key(C2), '_id')
+        assert_equal(mg.get_property(C2, 'fk_rtable'), 'rtable_ID')
+    mg.del_catalog()
+
+
+def test_ob_block_tables_prebuilt_index():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C1 = ob.block_tables(A, B, 'name', 'name', q_val=3, word_level=False, overlap_size=2,
+                         l_output_attrs=['address'], verbose=False, show_progress=False)
+    index = ob.build_index(A, 'name', q_val=3, word_level=False, verbose=False)
+    path = tempfile.mkdtemp()
+    try:
+        index.save(path)
+        index = mg.InvertedIndex.load(path)
+        assert_equal(index.settings['q_val'], 3)
+        assert_equal(index.settings['word_level'], False)
+        assert_equal(index.settings['rem_stop_words'], False)
+        C2 = ob.block_tables(A, B, 'name', 'name', q_val=3, word_level=False, overlap_size=2,
+                             l_output_attrs=['address'], l_index=index, verbose=False, show_progress=False)
+        assert_equal(C1.equals(C2), True)
+    finally:
+        shutil.rmtree(path)
+    mg.del_catalog()
+
+
+@raises(AssertionError)
+def test_ob_block_tables_prebuilt_index_invalid_settings():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    index = ob.build_index(A, 'name', verbose=False)
+    ob.block_tables(A, B, 'name', 'name', rem_stop_words=True, l_index=index, verbose=False, show_progress=False)
+
+
+@raises(AssertionError)
+def test_ob_block_tables_prebuilt_index_shuffled_table():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    index = ob.build_index(A, 'name', verbose=False)
+    A2 = A.iloc[::-1].reset_index(drop=True)
+    mg.set_key(A2, 'ID')
+    ob.block_tables(A2, B, 'name', 'name', l_index=index, verbose=False, show_progress=False)
+
+
+def test_ob_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'address', 'address', l_output_attrs=['name'], verbose=False, show_progress=False)
+    D = ob.block_candset(C, 'address', 'address', overlap_size=3, verbose=False, show_progress=False)
+    E = ob.block_tables(A, B, 'address', 'address', overlap_size=3, verbose=False, show_progress=False)
+    assert_equal(list(zip(D.ltable_ID, D.rtable_ID)), list(zip(E.ltable_ID, E.rtable_ID)))
+    assert_equal(list(D.columns), list(C.columns))
+    assert_equal(mg.get_key(D), '_id')
+    assert_equal(mg.get_property(D, 'ltable') is A, True)
+    mg.del_catalog()
+
+
+def test_ob_block_tables_prune_frequent_tokens():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'address', 'address', max_doc_freq_ratio=0.5, verbose=False, show_progress=False)
+    assert_equal(set(ob.pruned_tokens.keys()), set(['san', 'francisco', 'st']))
+    assert_equal(ob.pruned_tokens['san'], 5)
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), [('a3', 'b2'), ('a2', 'b3'), ('a5', 'b5'), ('a5', 'b6')])
+    for prefix_filter in [False, True]:
+        D = ob.block_tables(A, B, 'address', 'address', max_posting_len=3, prefix_filter=prefix_filter,
+                            verbose=False, show_progress=False)
+        assert_equal(C.equals(D), True)
+    mg.del_catalog()
+
+
+def test_ob_block_tables_top_k():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'address', 'address', top_k=1, verbose=False, show_progress=False)
+    assert_equal(list(zip(C.ltable_ID, C.rtable_ID)), [('a1', 'b1'), ('a3', 'b2'), ('a2', 'b3'), ('a1', 'b4'),
+                                                        ('a1', 'b5'), ('a5', 'b6')])
+    mg.del_catalog()
+
+
+@raises(SyntaxError)
+def test_ob_block_tables_top_k_and_prefix_filter():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    ob.block_tables(A, B, 'address', 'address', top_k=1, prefix_filter=True, verbose=False, show_progress=False)
+
+
+@raises(AssertionError)
+def test_ob_block_tables_top_k_invalid():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    ob.block_tables(A, B, 'address', 'address', top_k=0, verbose=False, show_progress=False)
+
+
+def test_ob_block_tables_multiple_attrs():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, ['name', 'address'], ['name', 'address'], overlap_size=5, verbose=False,
+                        show_progress=False)
+    assert_equal(set(zip(C.ltable_ID, C.rtable_ID)), set([('a3', 'b2'), ('a2', 'b3')]))
+    D = ob.block_tables(A, B, ['name', 'address'], ['name', 'address'], q_val=[None, 2], word_level=False,
+                        overlap_size=5, verbose=False, show_progress=False)
+    assert_equal(set(zip(C.ltable_ID, C.rtable_ID)).issubset(zip(D.ltable_ID, D.rtable_ID)), True)
+    E = ob.block_candset(D, ['name', 'address'], ['name', 'address'], overlap_size=5, verbose=False,
+                         show_progress=False)
+    assert_equal(set(zip(E.ltable_ID, E.rtable_ID)), set(zip(C.ltable_ID, C.rtable_ID)))
+    mg.del_catalog()
+
+
+@raises(AssertionError)
+def test_ob_block_tables_multiple_attrs_invalid():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    OverlapBlocker().block_tables(A, B, ['name', 'address'], ['name'], verbose=False, show_progress=False)
@@ -0,0 +1,72 @@
+from nose.tools import *
+import os
+
+import magellan as mg
+from magellan.blocker.black_box_blocker import BlackBoxBlocker
+from magellan.blocker.overlap_blocker import OverlapBlocker
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def test_stats_nested_stages():
+    stats = mg.BlockerStats('test')
+    with stats.stage('outer'):
+        for i in stats.iter_stage('inner', range(3)):
+            stats.add('items')
+    assert_equal(stats.stages['inner']['calls'], 4)
+    assert_equal(stats.stages['outer']['calls'], 1)
+    assert_equal(stats.counters['items'], 3)
+    assert_equal(list(stats.get_stages().stage), ['inner', 'outer'])
+    assert_equal(stats.to_dict()['inner.calls'], 4)
+
+
+def test_stats_ob_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    received = []
+    mg.add_stats_callback(received.append)
+    try:
+        ob = OverlapBlocker()
+        C = ob.block_tables(A, B, 'address', 'address', overlap_size=2, verbose=False, show_progress=False)
+        D = ob.block_candset(C, 'name', 'name', verbose=False, show_progress=False)
+    finally:
+        mg.remove_stats_callback(received.append)
+    assert_equal([stats.name for stats in received], ['OverlapBlocker.block_tables',
+                                                      'OverlapBlocker.block_candset'])
+    stats = received[0]
+    assert_equal(set(['validate', 'tokenize', 'build_index', 'index', 'probe', 'assemble']) <=
+                 set(stats.stages.keys()), True)
+    assert_equal(stats.counters['rows_tokenized'], len(A) + len(B))
+    assert_equal(stats.counters['postings_scanned'] > 0, True)
+    assert_equal(stats.counters['pairs_emitted'], len(C))
+    assert_equal(stats.wall_time >= sum(s['wall_time'] for s in stats.stages.values()) - 1e-6, True)
+    assert_equal(ob.stats.counters['pairs_in'], len(C))
+    assert_equal(ob.stats.counters['pairs_emitted'], len(D))
+    mg.del_catalog()
+
+
+def test_stats_ob_postings_scanned():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    scanned = []
+    for kwargs in [dict(), dict(prefix_filter=True), dict(top_k=1)]:
+        ob.block_tables(A, B, 'address', 'address', overlap_size=3, verbose=False, show_progress=False, **kwargs)
+        scanned.append(ob.stats.counters['postings_scanned'])
+    assert_equal(scanned[1] < scanned[0], True)
+    assert_equal(scanned[2] < scanned[0], True)
+    mg.del_catalog()
+
+
+def test_stats_bb_block_candset():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    C = mg.AttrEquivalenceBlocker().block_tables(A, B, 'zipcode', 'zipcode', verbose=False)
+    bb = BlackBoxBlocker()
+    bb.set_black_box_function(lambda l, r: l['birth_year'] != r['birth_year'])
+    D = bb.block_candset(C, verbose=False, show_progress=False)
+    assert_equal(bb.stats.counters['pairs_evaluated'], len(C))
+    assert_equal(bb.stats.counters['pairs_emitted'], len(D))
+    assert_equal('black_box' in bb.stats.stages, True)
+    mg.del_catalog()
@@ -0,0 +1,104 @@
+from nose.tools import *
+import os
+
+import numpy as np
+import pandas as pd
+
+import magellan as mg
+from magellan.blocker.overlap_blocker import OverlapBlocker
+from magellan.external.py_stringmatching.tokenizers import qgram
+from magellan.utils.tokencache import TokenCache
+
+path_for_A = os.sep.join([mg.get_install_path(), 'datasets', 'table_A.csv'])
+path_for_B = os.sep.join([mg.get_install_path(), 'datasets', 'table_B.csv'])
+
+
+def test_token_cache_lru_eviction():
+    cache = TokenCache(max_size=2)
+    calls = []
+    tokenize = lambda s: calls.append(s) or s.split()
+    assert_equal(cache.get_value_tokens('a b', 'ws', tokenize), ['a', 'b'])
+    cache.get_value_tokens('c d', 'ws', tokenize)
+    cache.get_value_tokens('a b', 'ws', tokenize)
+    cache.get_value_tokens('e f', 'ws', tokenize)
+    assert_equal(len(cache), 2)
+    cache.get_value_tokens('a b', 'ws', tokenize)
+    cache.get_value_tokens('c d', 'ws', tokenize)
+    assert_equal(calls, ['a b', 'c d', 'e f', 'c d'])
+    cache.set_max_size(0)
+    assert_equal(len(cache), 0)
+
+
+def test_token_cache_ob_block_tables():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    C = ob.block_tables(A, B, 'address', 'address', verbose=False, show_progress=False)
+    cache = mg.get_token_cache()
+    cache.set_max_size(1000)
+    try:
+        D = ob.block_tables(A, B, 'address', 'address', verbose=False, show_progress=False)
+        misses = cache.misses
+        E = ob.block_tables(A, B, 'address', 'address', verbose=False, show_progress=False)
+        assert_equal(cache.misses, misses)
+        F = ob.block_tables(A, B, 'address', 'address', rem_stop_words=True, verbose=False, show_progress=False)
+        assert_equal(cache.misses, misses + 2)
+        G = ob.block_candset(C, 'address', 'address', overlap_size=2, verbose=False, show_progress=False)
+        assert_equal(cache.misses, misses + 2)
+        A['address'] = A['address'].str.upper()
+        ob.block_tables(A, B, 'address', 'address', verbose=False, show_progress=False)
+        assert_equal(cache.misses, misses + 3)
+    finally:
+        cache.set_max_size(0)
+        cache.clear()
+    assert_equal(C.equals(D), True)
+    assert_equal(C.equals(E), True)
+    assert_equal(len(G), len(ob.block_tables(A, B, 'address', 'address', overlap_size=2, verbose=False,
+                                             show_progress=False)))
+    mg.del_catalog()
+
+
+def test_token_cache_ob_block_tables_two_attrs():
+    A = mg.read_csv_metadata(path_for_A, key='ID')
+    B = mg.read_csv_metadata(path_for_B, key='ID')
+    ob = OverlapBlocker()
+    cache = mg.get_token_cache()
+    # #room for the column entries of both attributes only
+    cache.set_max_size(2 * (len(A) + len(B)))
+    try:
+        for attr in ['name', 'address']:
+            ob.block_tables(A, B, attr, attr, q_val=3, word_level=False, verbose=False, show_progress=False)
+        misses = cache.misses
+        ob.block_tables(A, B, 'name', 'name', q_val=3, word_level=False, verbose=False, show_progress=False)
+        assert_equal(cache.misses, misses)
+    finally:
+        cache.set_max_size(0)
+        cache.clear()
+    mg.del_catalog()
+
+
+def test_token_cache_tokenizers():
+    cache = mg.get_token_cache()
+    cache.set_max_size(10)
+    hits = cache.hits
+    try:
+        tokens = qgram('data', 2)
+        tokens.append('xx')
+        assert_equal(qgram('data', 2), ['da', 'at', 'ta'])
+        assert_equal(qgram('data', 3), ['dat', 'ata'])
+        assert_equal(cache.hits, hits + 1)
+    finally:
+        cache.set_max_size(0)
+        cache.clear()
+
+
+def test_token_cache_reassigned_column():
+    A = pd.DataFrame({'ID': range(5), 'address': ['x'] * 5})
+    tokenize = lambda table, attr: [table[attr].iloc[0]]
+    cache = TokenCache(max_size=1000)
+    # #reassign the column twice between lookups, so that the new array tends to reuse the id of the cached one
+    for i in range(50):
+        cache.get_column_tokens(A, 'address', 'settings', tokenize)
+        A['address'] = np.array(['tmp'] * len(A), dtype=object)
+        A['address'] = np.array(['value %d' % i] * len(A), dtype=object)
+        assert_equal(cache.get_column_tokens(A, 'address', 'settings', tokenize), ['value %d' % i])
@@ -1,7 +1,11 @@
 import logging
+import multiprocessing
 import os
 
+import numpy as np
+
 from magellan.utils import install_path
+from magellan.utils.normalizer import Normalizer
 
 
 logger = logging.getLogger(__name__)
@@ -22,8 +26,8 @@ def get_install_path():
     return os.sep.join(plist[0:len(plist)-1])
 
 
-def add_key_column(table, key):
-    table.insert(0, key, range(0, len(table)))
+def add_key_column(table, key, start=0):
+    table.insert(0, key, range(start, start + len(table)))
     return table
 
 
@@ -56,11 +60,67 @@ def check_attrs_present(table, attrs):
     return status
 
 
+# get the number of processes to use for the given n_jobs (-1 means all cpus, -2 all but one, etc.);
+# never use more processes than there are items to process.
+def get_num_procs(n_jobs, num_items):
+    n_cpus = multiprocessing.cpu_count()
+    if n_jobs < 0:
+        n_procs = n_cpus + 1 + n_jobs
+    else:
+        n_procs = n_jobs
+    return max(1, min(n_procs, num_items))
+
+
+# pool of n_procs worker processes holding the given state (a dict). the state is passed to the pool
+# initializer, so the (forked) workers inherit it without pickling, and each pool has its own state, so calls
+# whose pools overlap do not clash. map (function, item) pairs over the pool with call_with_worker_state,
+# which calls function(state, item) in the worker.
+def get_worker_pool(n_procs, state):
+    return multiprocessing.Pool(n_procs, _set_worker_state, (state,))
+
+
+def call_with_worker_state(args):
+    function, item = args
+    return function(_worker_state, item)
+
+
+# the state of the pool of a worker process (set in the worker by the pool initializer)
+_worker_state = None
+
+
+def _set_worker_state(state):
+    global _worker_state
+    _worker_state = state
+
+
+# split range(0, n) into (at most) n_chunks contiguous (begin, end) ranges of nearly equal size
+def split_into_chunks(n, n_chunks):
+    n_chunks = max(1, min(n_chunks, n))
+    bounds = [(n * i) // n_chunks for i in range(n_chunks + 1)]
+    return [(bounds[i], bounds[i+1]) for i in range(n_chunks) if bounds[i+1] > bounds[i]]
+
+
+# split a sequence of items with the given (non-negative) volumes into contiguous (begin, end) ranges whose
+# total volume stays within max_volume; an item whose volume alone exceeds max_volume gets its own range.
+def split_by_volume(volumes, max_volume):
+    n = len(volumes)
+    cum_volume = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(volumes, out=cum_volume[1:])
+    ranges = []
+    begin = 0
+    while begin < n:
+        end = int(np.searchsorted(cum_volume, cum_volume[begin] + max_volume, side='right')) - 1
+        end = min(max(end, begin + 1), n)
+        ranges.append((begin, end))
+        begin = end
+    return ranges
+
+
 # remove non-ascii characters from string
 def remove_non_ascii(s):
-    s = ''.join(i for i in s if ord(i) < 128)
-    s = str(s)
-    return str.strip(s)
+    return _ascii_normalizer.normalize(s)
+
+_ascii_normalizer = Normalizer(case_fold=False, punctuation=None)
 
 # find the list difference
 def diff(a, b):
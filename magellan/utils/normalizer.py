@@ -0,0 +1,99 @@
+import string
+
+
+# the bytes that are not ascii characters
+_non_ascii_chars = ''.join(chr(i) for i in range(128, 256))
+
+
+class Normalizer(object):
+    """
+    String normalizer used by the blockers (e.g. OverlapBlocker) and the string matching tokenizers before
+    tokenizing a string.
+
+    The string level steps (ascii folding, case folding and punctuation removal) are done with a single
+    translation table, so normalizing a value is one pass in C instead of a pass per step; normalize_column
+    applies it to a whole column. Stop words are removed from the tokens, after the string is split.
+
+    Args:
+        ascii_fold (boolean): Drop the non-ascii characters (defaults to True)
+        case_fold (boolean): Convert the string to lower case (defaults to True)
+        punctuation (str): Characters to remove (defaults to string.punctuation; None or '' keeps them)
+        stop_words (list): Tokens to remove (defaults to None, which removes nothing)
+
+    Examples:
+        >>> import magellan as mg
+        >>> mg.Normalizer().normalize(u'Caf\xe9 au Lait!')
+        'caf au lait'
+        >>> mg.Normalizer(stop_words=['au']).get_tokens(u'Caf\xe9 au Lait!')
+        ['caf', 'lait']
+    """
+
+    def __init__(self, ascii_fold=True, case_fold=True, punctuation=string.punctuation, stop_words=None):
+        self.ascii_fold = ascii_fold
+        self.case_fold = case_fold
+        self.punctuation = punctuation if punctuation else ''
+        self.stop_words = list(stop_words) if stop_words else []
+
+        # translation table and characters to delete, for byte strings
+        self._table = string.maketrans(string.ascii_uppercase, string.ascii_lowercase) if case_fold else None
+        self._delete_chars = str(self.punctuation) + (_non_ascii_chars if ascii_fold else '')
+        # translation table, for unicode strings that are not ascii folded
+        self._unicode_table = dict((ord(c), None) for c in unicode(self.punctuation))
+
+    def get_settings(self):
+        """
+        Hashable description of the normalizer (used to key the token cache and to validate saved indexes).
+        """
+        return ('Normalizer', self.ascii_fold, self.case_fold, self.punctuation, tuple(self.stop_words))
+
+    def normalize(self, value):
+        """
+        Normalize a string (non-string values are converted to strings first).
+        """
+        if isinstance(value, unicode):
+            if self.ascii_fold:
+                value = value.encode('ascii', 'ignore')
+            else:
+                value = value.translate(self._unicode_table)
+                return (value.lower() if self.case_fold else value).strip()
+        elif not isinstance(value, str):
+            value = str(value)
+        return value.translate(self._table, self._delete_chars).strip()
+
+    def normalize_column(self, values):
+        """
+        Normalize all the values of a column (list, numpy array or pandas series). A column of byte strings
+        is translated directly, without the per-value type dispatch of normalize; other columns (unicode,
+        numbers, missing values) go through normalize.
+        """
+        table, delete_chars = self._table, self._delete_chars
+        try:
+            return [val.translate(table, delete_chars).strip() for val in values]
+        except (TypeError, AttributeError):
+            # #not all byte strings (unicode.translate takes one argument, numbers have no translate)
+            normalize = self.normalize
+            return [normalize(val) for val in values]
+
+    def rem_stop_words(self, tokens):
+        """
+        Remove the stop words from a token list.
+        """
+        if not self.stop_words:
+            return tokens
+        stop_words = set(self.stop_words)
+        return [t for t in tokens if t not in stop_words]
+
+    def rem_stop_words_column(self, token_lists):
+        """
+        Remove the stop words from each token list of a column.
+        """
+        if not self.stop_words:
+            return token_lists
+        stop_words = set(self.stop_words)
+        return [[t for t in tokens if t not in stop_words] for tokens in token_lists]
+
+    def get_tokens(self, value):
+        """
+        Normalize a string, split it on white space and remove the stop words.
+        """
+        return self.rem_stop_words(self.normalize(value).split())
@@ -0,0 +1,186 @@
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlockerStats(object):
+    """
+    Timings and counters of a blocker call (e.g. OverlapBlocker.block_tables), kept in blocker.stats after
+    the call and passed to the stats callbacks (see add_stats_callback).
+
+    The call is split into named stages (e.g. 'validate', 'tokenize', 'index', 'probe', 'assemble'); the wall
+    and cpu time of each stage, and the number of times it was entered, are recorded. The times are
+    exclusive: the time spent in a stage nested in another one (e.g. probing the index while the candset is
+    assembled from the probed pairs) is counted in the inner stage only. The cpu time is that of the calling
+    process, so the work of the worker processes (n_jobs > 1) shows up in the wall time only. The counters
+    hold quantities such as the rows tokenized, the postings scanned and the pairs emitted.
+
+    Attributes:
+        name (str): Name of the call (e.g. 'OverlapBlocker.block_tables')
+        wall_time, cpu_time (float): Total times of the call, in seconds
+        stages (OrderedDict): Stage name -> dict with wall_time, cpu_time and calls
+        counters (OrderedDict): Counter name -> value
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        # the stages that are entered, innermost last, with the time spent in their nested stages
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the time of a block of code as a stage.
+
+        Examples:
+            >>> with stats.stage('tokenize'):
+            ...     tokens = tokenize(table)
+        """
+        frame = [time.time(), time.clock(), 0.0, 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            wall_time = time.time() - frame[0]
+            cpu_time = time.clock() - frame[1]
+            s = self.stages.get(name, None)
+            if s is None:
+                s = self.stages[name] = dict(wall_time=0.0, cpu_time=0.0, calls=0)
+            s['wall_time'] += wall_time - frame[2]
+            s['cpu_time'] += cpu_time - frame[3]
+            s['calls'] += 1
+            if len(self._stack) > 0:
+                self._stack[-1][2] += wall_time
+                self._stack[-1][3] += cpu_time
+
+    def iter_stage(self, name, iterable):
+        """
+        Generate the items of an iterable, recording the time spent producing them as a stage (so the work of
+        a generator is recorded where it is done, and not in the stage that consumes it).
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, value=1):
+        """
+        Add a value to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_stages(self):
+        """
+        The stages as a dataframe, with one row per stage and the columns stage, wall_time, cpu_time and calls.
+        """
+        rows = [dict(s, stage=name) for name, s in self.stages.items()]
+        return pd.DataFrame(rows, columns=['stage', 'wall_time', 'cpu_time', 'calls'])
+
+    def to_dict(self):
+        """
+        The stats as a flat dict (e.g. to send to a metrics system): the total times, '<stage>.wall_time',
+        '<stage>.cpu_time' and '<stage>.calls' for each stage, and the counters.
+        """
+        d = OrderedDict([('wall_time', self.wall_time), ('cpu_time', self.cpu_time)])
+        for name, s in self.stages.items():
+            for field in ['wall_time', 'cpu_time', 'calls']:
+                d[name + '.' + field] = s[field]
+        d.update(self.counters)
+        return d
+
+    def __repr__(self):
+        stages = ', '.join('%s=%.3fs' % (name, s['wall_time']) for name, s in self.stages.items())
+        counters = ', '.join('%s=%s' % (name, value) for name, value in self.counters.items())
+        return '%s: %.3fs (cpu %.3fs); %s; %s' % (self.name, self.wall_time, self.cpu_time, stages, counters)
+
+
+class _NullStats(BlockerStats):
+    # stats that are not recorded, for the blocker methods called outside of a recorded call
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def iter_stage(self, name, iterable):
+        return iterable
+
+    def add(self, name, value=1):
+        pass
+
+
+_null_stats = _NullStats('')
+
+# the functions called with the stats of each recorded blocker call
+_stats_callbacks = []
+
+
+def add_stats_callback(callback):
+    """
+    Add a function to call with the stats (BlockerStats) of each blocker call, e.g. to push them to a metrics
+    system. log_stats is a callback that logs them.
+
+    Examples:
+        >>> import magellan as mg
+        >>> mg.add_stats_callback(mg.log_stats)
+        >>> mg.add_stats_callback(lambda stats: metrics.send(stats.name, stats.to_dict()))
+    """
+    _stats_callbacks.append(callback)
+
+
+def remove_stats_callback(callback):
+    """
+    Remove a function added with add_stats_callback.
+    """
+    _stats_callbacks.remove(callback)
+
+
+def log_stats(stats):
+    """
+    Stats callback that logs the stats of a blocker call (at the info level, to the magellan.utils.stats
+    logger).
+    """
+    logger.info(repr(stats))
+
+
+def record_stats(method):
+    """
+    Decorator of the blocker methods whose calls are recorded: the method runs with a fresh BlockerStats in
+    self.stats, whose total times are set and which is passed to the stats callbacks when it returns. A
+    recorded method called from another one (e.g. build_index from block_tables) records into the stats of
+    the outer call.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is not _null_stats and self.stats._stack:
+            with self.stats.stage(method.__name__):
+                return method(self, *args, **kwargs)
+
+        stats = BlockerStats(type(self).__name__ + '.' + method.__name__)
+        self.stats = stats
+        start_wall, start_cpu = time.time(), time.clock()
+        with stats.stage('other'):
+            result = method(self, *args, **kwargs)
+        stats.wall_time = time.time() - start_wall
+        stats.cpu_time = time.clock() - start_cpu
+        for callback in _stats_callbacks:
+            callback(stats)
+        return result
+    # the undecorated method, e.g. to inspect its arguments
+    wrapper.__wrapped__ = method
+    return wrapper
@@ -0,0 +1,121 @@
+import weakref
+from collections import OrderedDict
+
+
+class TokenCache(object):
+    """
+    Bounded LRU cache of tokenization results, shared by the blockers and the string matching tokenizers.
+
+    Two kinds of entries are kept:
+
+        column entries: the tokens of every value of a table column, keyed by the table, the attribute and
+            the tokenizer settings (e.g. q_val and rem_stop_words); see get_column_tokens
+        value entries: the tokens of a single string, keyed by the string and the tokenizer settings; see
+            get_value_tokens. They are made by the string matching tokenizers when called directly (the
+            blockers tokenize their values without them, so they cannot evict the column entries)
+
+    The size of the cache is the number of token lists it holds (a column entry counts one per value), and
+    the least recently used entries are evicted once it exceeds max_size. The cache is disabled
+    (max_size=0) by default.
+
+    Tables are identified by their id (as in the catalog), together with weak references to the table and to
+    the column's value array, so a table that was garbage collected or a column that was re-assigned is
+    tokenized again (ids alone are not enough, since the id of a freed array can be reused). Values modified
+    in place are not detected; call clear in that case.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def is_enabled(self):
+        return self.max_size > 0
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_column_tokens(self, table, attr, settings, tokenize_column):
+        """
+        Get the tokens of the values in table[attr], computing them with tokenize_column(table, attr) on a
+        miss. settings must be a hashable description of the tokenizer (everything the tokens depend on).
+        """
+        if not self.is_enabled():
+            return tokenize_column(table, attr)
+
+        key = ('column', id(table), attr, settings)
+        entry = self._entries.get(key, None)
+        col_values = table[attr].values
+        if entry is not None:
+            table_ref, col_ref, value, size = entry
+            if table_ref() is table and col_ref() is col_values:
+                self.hits += 1
+                self._entries[key] = self._entries.pop(key)
+                return value
+            self._remove(key)
+
+        self.misses += 1
+        value = tokenize_column(table, attr)
+        self._put(key, (weakref.ref(table), weakref.ref(col_values), value, len(table)), len(table))
+        return value
+
+    def get_value_tokens(self, value, settings, tokenize_value):
+        """
+        Get the tokens of a single value, computing them with tokenize_value(value) on a miss. The cached
+        list must not be modified by the caller.
+        """
+        if not self.is_enabled():
+            return tokenize_value(value)
+
+        key = ('value', value, settings)
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self.hits += 1
+            self._entries[key] = self._entries.pop(key)
+            return entry[0]
+
+        self.misses += 1
+        tokens = tokenize_value(value)
+        self._put(key, (tokens, 1), 1)
+        return tokens
+
+    def _put(self, key, entry, size):
+        if size > self.max_size:
+            return
+        self._entries[key] = entry
+        self.size += size
+        self._evict()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[-1]
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._entries) > 0:
+            key, entry = self._entries.popitem(last=False)
+            self.size -= entry[-1]
+
+
+# the cache shared by the blockers and the tokenizers
+_token_cache = TokenCache()
+
+
+def get_token_cache():
+    """
+    Get the tokenization cache shared by the blockers and the string matching tokenizers.
+
+    Examples:
+        >>> import magellan as mg
+        >>> mg.get_token_cache().set_max_size(10000000)   # enable the cache
+    """
+    return _token_cache
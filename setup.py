@@ -31,8 +31,8 @@ setup(
     license=['MIT'],
     packages=['magellan'],
     install_requires=['JPype1>=0.5.7',
-                      'pandas >= 0.16.0',
-                      'numpy >= 1.7.0',
+                      'pandas >= 0.21.0',
+                      'numpy >= 1.13.0',
                       'six',
                       'scikit-learn >= 0.16.1',
                       'cloud >= 2.8.5',